@@ -0,0 +1,103 @@
+"""Share the remote change summaries between server bindings."""
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+class ChangeFeed(object):
+    """Multiplex the change summary polling of the bindings of a same user
+
+    Several local folders can be bound to the same Nuxeo server with the same
+    account: the change summary returned by the server is the same for all of
+    them as it covers all the synchronization roots of the user.
+
+    During a synchronization cycle the server is polled only once per
+    (server_url, user) and the summary is fanned out to the matching bindings
+    that each keep their own checkpoint. Outside of a cycle, the server is
+    polled directly.
+
+    A binding lagging more than max_lag milliseconds behind the most recent
+    checkpoint of its group (e.g. a folder that was offline) polls on its own
+    instead of making the whole group fetch its backlog: once caught up, it
+    shares the polls of the group again.
+    """
+
+    max_lag = 60 * 1000
+
+    def __init__(self, get_remote_client):
+        self._get_remote_client = get_remote_client
+        self._groups = None
+        self._summaries = None
+
+    def start_cycle(self, server_bindings):
+        """Group the bindings polling the same change feed"""
+        sync_dates = {}
+        for sb in server_bindings:
+            key = self._get_key(sb)
+            sync_dates.setdefault(key, [])
+            if sb.last_sync_date is not None:
+                sync_dates[key].append(sb.last_sync_date)
+        # Oldest checkpoint polled by each group, None if no binding of the
+        # group has any
+        self._groups = {}
+        self._summaries = {}
+        for key, dates in sync_dates.items():
+            shared_dates = [d for d in dates if d >= max(dates) - self.max_lag]
+            self._groups[key] = min(shared_dates) if shared_dates else None
+
+    def end_cycle(self):
+        self._groups = None
+        self._summaries = None
+
+    def get_changes(self, server_binding):
+        """Return the change summary to apply to the given binding"""
+        sb = server_binding
+        key = self._get_key(sb)
+        if self._groups is None or key not in self._groups:
+            return self._poll(sb, sb.last_sync_date)
+
+        last_sync_date = self._groups[key]
+        if (sb.last_sync_date is not None and last_sync_date is not None
+            and sb.last_sync_date < last_sync_date):
+            log.debug("%s lags behind the other bindings of user '%s' on %s,"
+                      " polling its changes on its own", sb.local_folder,
+                      sb.remote_user, sb.server_url)
+            return self._poll(sb, sb.last_sync_date)
+
+        summary = self._summaries.get(key)
+        if summary is None:
+            # Poll from the oldest checkpoint of the group so that the
+            # summary holds the changes needed by each binding. Bindings
+            # without any checkpoint perform a full remote scan anyway.
+            summary = self._poll(sb, last_sync_date)
+            self._summaries[key] = summary
+        else:
+            log.trace("Reusing change summary of %s for user '%s' in %s",
+                      sb.server_url, sb.remote_user, sb.local_folder)
+        return self._filter_changes(summary, sb.last_sync_date)
+
+    def _get_key(self, server_binding):
+        # Bindings of the same user normally share the same root
+        # definitions: keep them apart otherwise as the server computes the
+        # root registration changes from the definitions passed by the client
+        sb = server_binding
+        return sb.server_url, sb.remote_user, sb.last_root_definitions
+
+    def _poll(self, server_binding, last_sync_date):
+        remote_client = self._get_remote_client(server_binding)
+        return remote_client.get_changes(
+            last_sync_date=last_sync_date,
+            last_root_definitions=server_binding.last_root_definitions)
+
+    def _filter_changes(self, summary, last_sync_date):
+        """Drop the changes already processed by a more recent binding"""
+        if last_sync_date is None:
+            return summary
+        changes = summary['fileSystemChanges']
+        filtered = [c for c in changes if c['eventDate'] >= last_sync_date]
+        if len(filtered) == len(changes):
+            return summary
+        summary = dict(summary)
+        summary['fileSystemChanges'] = filtered
+        return summary
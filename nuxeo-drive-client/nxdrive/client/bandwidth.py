@@ -0,0 +1,236 @@
+"""Bandwidth shaping of the uploads and downloads
+
+A token bucket per direction limits the throughput of all the transfers of
+a server binding together: concurrent transfers draw from the same bucket,
+so the limit applies to their combined throughput. The limits can differ
+during business hours and off hours, e.g. to leave room for the VoIP calls
+of a branch office during the day while the initial synchronization runs
+full speed at night.
+
+The clients call throttle for every block of data sent or received; the
+actual throughput is measured at the same time to be reported to the
+frontend.
+"""
+import time
+from collections import deque
+from datetime import datetime
+from threading import Lock
+
+from nxdrive.client.streaming import Body
+
+
+UPLOAD = 'upload'
+
+DOWNLOAD = 'download'
+
+# Local hours [start, end) and week days (Monday is 0) of the business hours
+BUSINESS_HOURS = (9, 18)
+BUSINESS_DAYS = frozenset([0, 1, 2, 3, 4])
+
+# Size of the blocks written or read by the throttled transfers, small
+# enough for them to be smooth at low rates
+THROTTLED_BLOCK_SIZE = 16 * 1024
+
+# Period in seconds over which the throughput is measured
+THROUGHPUT_WINDOW = 5
+
+
+class TokenBucket(object):
+    """Let rate bytes per second through on average
+
+    Tokens accumulate up to capacity bytes (one second of traffic by
+    default) when the bucket is not used. A consumer taking more tokens than
+    available borrows them and sleeps until the debt is paid back, which
+    also delays the next consumers: the bucket is thread safe and the rate
+    applies to all its consumers together. A rate of None means no limit.
+    """
+
+    def __init__(self, rate=None, capacity=None, clock=time.time,
+                 sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = Lock()
+        self._last = clock()
+        self.set_rate(rate, capacity=capacity)
+
+    def set_rate(self, rate, capacity=None):
+        with self._lock:
+            self.rate = rate
+            self.capacity = (capacity if capacity is not None
+                             else rate or 0)
+            self._tokens = self.capacity
+
+    def consume(self, n):
+        """Take n tokens, return the time waited for them in seconds"""
+        with self._lock:
+            if self.rate is None:
+                return 0
+            now = self.clock()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / float(self.rate) if self._tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+class ThroughputMeter(object):
+    """Average throughput in bytes per second over the last seconds"""
+
+    def __init__(self, window=THROUGHPUT_WINDOW, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self._lock = Lock()
+        # (second, bytes transferred during that second)
+        self._seconds = deque()
+
+    def record(self, n):
+        second = int(self.clock())
+        with self._lock:
+            if self._seconds and self._seconds[-1][0] == second:
+                self._seconds[-1][1] += n
+            else:
+                self._seconds.append([second, n])
+            self._expire(second)
+
+    def get_rate(self):
+        second = int(self.clock())
+        with self._lock:
+            self._expire(second)
+            return sum(n for _, n in self._seconds) / float(self.window)
+
+    def _expire(self, second):
+        while self._seconds and self._seconds[0][0] <= second - self.window:
+            self._seconds.popleft()
+
+
+class BandwidthLimits(object):
+    """Limits in bytes per second by direction, None meaning no limit
+
+    The off hours limits apply outside the business hours and days.
+    """
+
+    def __init__(self, upload=None, download=None, off_hours_upload=None,
+                 off_hours_download=None, business_hours=BUSINESS_HOURS,
+                 business_days=BUSINESS_DAYS):
+        self.business = {UPLOAD: upload, DOWNLOAD: download}
+        self.off_hours = {UPLOAD: off_hours_upload,
+                          DOWNLOAD: off_hours_download}
+        self.business_hours = business_hours
+        self.business_days = business_days
+
+    def is_business_time(self, now):
+        start, end = self.business_hours
+        return (now.weekday() in self.business_days
+                and start <= now.hour < end)
+
+    def get_limit(self, direction, now=None):
+        now = now if now is not None else datetime.now()
+        if self.is_business_time(now):
+            return self.business[direction]
+        return self.off_hours[direction]
+
+    def __repr__(self):
+        return "BandwidthLimits<business=%r, off_hours=%r>" % (
+            self.business, self.off_hours)
+
+
+class BandwidthLimiter(object):
+    """Token bucket and throughput meter per direction for a binding"""
+
+    def __init__(self, limits=None, clock=time.time, sleep=time.sleep,
+                 now=datetime.now):
+        self.limits = limits if limits is not None else BandwidthLimits()
+        self.now = now
+        self._buckets = dict((d, TokenBucket(clock=clock, sleep=sleep))
+                             for d in (UPLOAD, DOWNLOAD))
+        self._meters = dict((d, ThroughputMeter(clock=clock))
+                            for d in (UPLOAD, DOWNLOAD))
+
+    def set_limits(self, limits):
+        self.limits = limits
+
+    def get_limit(self, direction):
+        return self.limits.get_limit(direction, now=self.now())
+
+    def is_limited(self, direction):
+        return self.get_limit(direction) is not None
+
+    def throttle(self, direction, n):
+        """Account for n bytes transferred, waiting as much as needed"""
+        bucket = self._buckets[direction]
+        rate = self.get_limit(direction)
+        if rate != bucket.rate:
+            bucket.set_rate(rate)
+        self._meters[direction].record(n)
+        return bucket.consume(n)
+
+    def get_throughput(self, direction):
+        """Bytes per second transferred over the last seconds"""
+        return self._meters[direction].get_rate()
+
+
+class BandwidthLimiters(object):
+    """Bandwidth limiters shared by the clients of the same binding"""
+
+    def __init__(self):
+        self._limiters = {}
+        self._lock = Lock()
+
+    def get(self, key, get_limits=None):
+        """Return the limiter of key, created with get_limits() if new"""
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limits = get_limits() if get_limits is not None else None
+                limiter = BandwidthLimiter(limits)
+                self._limiters[key] = limiter
+            return limiter
+
+    def set_limits(self, key, limits):
+        self.get(key).set_limits(limits)
+
+    def discard(self, key):
+        with self._lock:
+            self._limiters.pop(key, None)
+
+
+class _ThrottledSocket(object):
+    """Socket whose writes are throttled by a bandwidth limiter"""
+
+    def __init__(self, sock, limiter):
+        self._sock = sock
+        self._limiter = limiter
+
+    def sendall(self, data):
+        view = memoryview(data)
+        for offset in xrange(0, len(view), THROTTLED_BLOCK_SIZE):
+            chunk = view[offset:offset + THROTTLED_BLOCK_SIZE]
+            self._limiter.throttle(UPLOAD, len(chunk))
+            self._sock.sendall(chunk)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class ThrottledBody(Body):
+    """Request body uploaded within the limits of a bandwidth limiter
+
+    Zero copy sends are disabled: the kernel would bypass the limiter.
+    """
+
+    def __init__(self, body, limiter):
+        self.body = body
+        self.limiter = limiter
+        self.length = body.length
+        self.replayable = body.replayable
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.limiter.throttle(UPLOAD, len(chunk))
+            yield chunk
+
+    def send_to(self, sock, zero_copy=False):
+        self.body.send_to(_ThrottledSocket(sock, self.limiter))
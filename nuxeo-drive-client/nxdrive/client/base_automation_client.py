@@ -2,7 +2,7 @@
 
 import sys
 import base64
-import json
+import hashlib
 import urllib2
 import mimetypes
 import random
@@ -10,10 +10,24 @@ import time
 import os
 import tempfile
 from urllib import urlencode
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from poster.streaminghttp import get_handlers
 from nxdrive.logging_config import get_logger
+from nxdrive.logging_config import lazy
+from nxdrive.client import json_codec
+from nxdrive.client.bandwidth import ThrottledBody
+from nxdrive.client.compression import DecompressionHandler
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.connection_pool import get_handlers
+from nxdrive.client.operation_registry import OperationRegistry
+from nxdrive.client.retry import CircuitBreakers
+from nxdrive.client.retry import IDEMPOTENT_OPERATIONS
+from nxdrive.client.retry import OVERLOAD_HTTP_STATUS
+from nxdrive.client.retry import RetryPolicy
+from nxdrive.client.retry import ServerOverloaded
+from nxdrive.client.retry import get_retry_after
+from nxdrive.client.retry import is_transient_error
+from nxdrive.client.streaming import FileBody
+from nxdrive.client.streaming import MultipartBody
+from nxdrive.client.streaming import to_body
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
 from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
 from nxdrive.client.common import safe_filename
@@ -32,9 +46,6 @@ DEVICE_DESCRIPTIONS = {
     'win32': 'Windows Desktop',
 }
 
-DEFAULT_STREAMING_BUFFER_SIZE = 4096
-
-
 def get_proxies_for_handler(proxy_settings):
     """Return a pair containing proxy string and exceptions list"""
     if proxy_settings.config == 'None':
@@ -96,6 +107,76 @@ class Unauthorized(Exception):
                 " the provided credentials" % (self.user_id, self.server_url))
 
 
+# Files larger than this are uploaded in chunks of this size, so that an
+# interrupted upload resumes from the last chunk acknowledged by the server
+DEFAULT_UPLOAD_CHUNK_SIZE = 20 * 1024 * 1024
+
+# Files up to this size are sent inline with the operation in a single
+# multipart request instead of a batch upload followed by its execution.
+# Chosen with tools/benchmarks/small_uploads.py: on a 50 ms, 10 MB/s link
+# the round trip saved halves the upload time of small files and still saves
+# a third of it at 1 MB, while larger requests would be parsed in memory by
+# the Automation servlet and could not be resumed.
+DEFAULT_INLINE_UPLOAD_MAX_SIZE = 1024 * 1024
+
+
+class ChunkedUpload(object):
+    """Progress of a file upload in chunks through an Automation batch
+
+    Only the chunks not acknowledged yet are sent: keeping this object, or
+    its attributes, across attempts resumes an interrupted upload. on_save,
+    if any, is called with the upload after each chunk to persist it.
+
+    If digest_algorithm is set (e.g. 'md5'), content_digest is the digest
+    of the content computed while uploading it, once uploaded.
+    """
+
+    def __init__(self, batch_id=None, file_size=None,
+                 chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE, uploaded_chunks=0,
+                 on_save=None, digest_algorithm=None):
+        self.batch_id = batch_id
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.uploaded_chunks = uploaded_chunks
+        self.on_save = on_save
+        self.digest_algorithm = digest_algorithm
+        self.content_digest = None
+
+    @property
+    def chunk_count(self):
+        if self.file_size is None:
+            return None
+        return max(1, -(-self.file_size // self.chunk_size))
+
+    def start(self, batch_id, file_size):
+        self.batch_id = batch_id
+        self.file_size = file_size
+        self.uploaded_chunks = 0
+
+    def is_started(self, file_size):
+        """Tell whether a batch was started for a file of this size"""
+        return self.batch_id is not None and self.file_size == file_size
+
+    def new_hasher(self):
+        digester = getattr(hashlib, self.digest_algorithm or '', None)
+        return digester() if digester is not None else None
+
+    def reset(self):
+        self.batch_id = None
+        self.file_size = None
+        self.uploaded_chunks = 0
+        self.content_digest = None
+        self.save()
+
+    def save(self):
+        if self.on_save is not None:
+            self.on_save(self)
+
+    def __repr__(self):
+        return "ChunkedUpload<batch_id=%r, uploaded=%r/%r>" % (
+            self.batch_id, self.uploaded_chunks, self.chunk_count)
+
+
 class BaseAutomationClient(object):
     """Client for the Nuxeo Content Automation HTTP API
 
@@ -122,6 +203,12 @@ class BaseAutomationClient(object):
     # Used for testing network errors
     _error = None
 
+    # Size of the chunks of the file uploads, see ChunkedUpload
+    upload_chunk_size = DEFAULT_UPLOAD_CHUNK_SIZE
+
+    # Files up to this size are uploaded along with the operation
+    inline_upload_max_size = DEFAULT_INLINE_UPLOAD_MAX_SIZE
+
     # Parameters used when negotiating authentication token:
     application_name = 'Nuxeo Drive'
 
@@ -132,7 +219,9 @@ class BaseAutomationClient(object):
                  password=None, token=None, repository="default",
                  ignored_prefixes=None, ignored_suffixes=None,
                  timeout=20, blob_timeout=None, cookie_jar=None,
-                 upload_tmp_dir=None):
+                 upload_tmp_dir=None, connection_pool=None,
+                 registry_cache=None, circuit_breakers=None,
+                 retry_policy=None, bandwidth_limiter=None):
         self.timeout = timeout
         self.blob_timeout = blob_timeout
         if ignored_prefixes is not None:
@@ -169,11 +258,34 @@ class BaseAutomationClient(object):
                                           proxy_exceptions=proxy_exceptions,
                                           url=self.server_url)
 
-        # Build URL openers
-        self.opener = urllib2.build_opener(cookie_processor, proxy_handler)
-        self.streaming_opener = urllib2.build_opener(cookie_processor,
-                                                     proxy_handler,
-                                                     *get_handlers())
+        # Reuse persistent HTTP connections, possibly shared with the other
+        # clients of the same controller
+        self.connection_pool = (connection_pool if connection_pool is not None
+                                else ConnectionPool())
+
+        # Negotiate compressed responses and keep track of the bytes
+        # received on the wire
+        self.decompression_handler = DecompressionHandler()
+
+        # Build URL openers: the keep alive handlers also stream iterable
+        # request bodies so the same opener is used for uploads
+        self.opener = urllib2.build_opener(cookie_processor, proxy_handler,
+                                           self.decompression_handler,
+                                           *get_handlers(self.connection_pool))
+        self.streaming_opener = self.opener
+
+        # Retry transient failures of idempotent calls and stop calling the
+        # server while it is down, possibly in sync with the other clients
+        self.retry_policy = (retry_policy if retry_policy is not None
+                             else RetryPolicy())
+        if circuit_breakers is None:
+            circuit_breakers = CircuitBreakers()
+        self.circuit_breaker = circuit_breakers.get(self.server_url)
+        self.backpressure = self.circuit_breaker.backpressure
+
+        # Keep the transfers within the bandwidth limits of the binding,
+        # shared with the other clients transferring at the same time
+        self.bandwidth_limiter = bandwidth_limiter
 
         # Set Proxy flag
         self.is_proxy = False
@@ -186,7 +298,17 @@ class BaseAutomationClient(object):
         self.batch_upload_url = 'batch/upload'
         self.batch_execute_url = 'batch/execute'
 
-        self.fetch_api()
+        # Reuse the operation registry already fetched by another client if
+        # any instead of downloading the whole catalogue again
+        self.registry_cache = registry_cache
+        self._registry_from_cache = False
+        if registry_cache is not None:
+            registry = registry_cache.get(self.server_url, client_version)
+            if registry is not None:
+                self._set_registry(registry)
+                self._registry_from_cache = True
+        if not self._registry_from_cache:
+            self.fetch_api()
 
     def make_raise(self, error):
         """Make next calls to server raise the provided exception"""
@@ -198,13 +320,12 @@ class BaseAutomationClient(object):
         ) % (self.server_url)
         url = self.automation_url
         headers = self._get_common_headers()
-        cookies = self._get_cookies()
         log.trace("Calling %s with headers %r and cookies %r",
-            url, headers, cookies)
+            url, headers, lazy(self._get_cookies))
         req = urllib2.Request(url, headers=headers)
         try:
-            response = json.loads(self.opener.open(
-                req, timeout=self.timeout).read())
+            response = json_codec.loads(self._open(
+                req, self.timeout, idempotent=True).read())
         except urllib2.HTTPError as e:
             if e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
@@ -238,13 +359,24 @@ class BaseAutomationClient(object):
                 msg = msg + ": " + e.msg
             e.msg = msg
             raise e
-        self.operations = {}
-        for operation in response["operations"]:
-            self.operations[operation['id']] = operation
+        registry = OperationRegistry(response["operations"])
+        self._set_registry(registry)
+        self._registry_from_cache = False
+        if self.registry_cache is not None:
+            self.registry_cache.put(self.server_url, self.client_version,
+                                    registry)
+
+    def _set_registry(self, registry):
+        self.registry = registry
+        self.operations = registry.operations
 
     def execute(self, command, op_input=None, timeout=-1,
-                check_params=True, void_op=False, **params):
-        """Execute an Automation operation"""
+                check_params=True, void_op=False, context=None, **params):
+        """Execute an Automation operation
+
+        context, if any, are the variables of the operation context (e.g.
+        currentDocument).
+        """
         if self._error is not None:
             # Simulate a configurable (e.g. network or server) error for the
             # tests
@@ -275,17 +407,19 @@ class BaseAutomationClient(object):
                 json_struct['params'][k] = v
         if op_input:
             json_struct['input'] = op_input
+        if context:
+            json_struct['context'] = context
         log.trace("Dumping JSON structure: %s", json_struct)
-        data = json.dumps(json_struct)
+        data = json_codec.dumps(json_struct)
 
-        cookies = self._get_cookies()
         log.trace("Calling %s with headers %r, cookies %r"
                   " and JSON payload %r",
-            url, headers, cookies,  data)
+            url, headers, lazy(self._get_cookies), data)
         req = urllib2.Request(url, data, headers)
         timeout = self.timeout if timeout == -1 else timeout
         try:
-            resp = self.opener.open(req, timeout=timeout)
+            resp = self._open(req, timeout,
+                              idempotent=command in IDEMPOTENT_OPERATIONS)
         except Exception as e:
             self._log_details(e)
             raise
@@ -295,12 +429,23 @@ class BaseAutomationClient(object):
     def execute_with_blob(self, command, blob_content, filename, **params):
         """Execute an Automation operation with a blob input
 
-        Beware that the whole content is loaded in memory when calling this.
+        blob_content can be any source accepted by streaming.to_body (e.g. an
+        in-memory buffer or a file-like object): it is streamed in a single
+        multipart request without being copied.
+        """
+        return self.execute_with_blobs(command, [(blob_content, filename)],
+                                       **params)
+
+    def execute_with_blobs(self, command, blobs, context=None, **params):
+        """Execute an Automation operation with blobs input
+
+        blobs are (blob_content, filename) pairs, all streamed in a single
+        multipart request as for execute_with_blob: the input of the
+        operation is a blob list if there are several of them.
         """
         self._check_params(command, params)
         url = self.automation_url.encode('ascii') + command
 
-        # Create data by hand :(
         boundary = "====Part=%s=%s===" % (str(time.time()).replace('.', '='),
                                           random.randint(0, 1000000000))
         headers = {
@@ -312,56 +457,40 @@ class BaseAutomationClient(object):
         }
         headers.update(self._get_common_headers())
 
-        container = MIMEMultipart("related",
-                type="application/json+nxrequest",
-                start="request")
-
-        d = {'params': params}
-        json_data = json.dumps(d)
-        json_part = MIMEBase("application", "json+nxrequest")
-        json_part.add_header("Content-ID", "request")
-        json_part.set_payload(json_data)
-        container.attach(json_part)
-
-        ctype, _ = mimetypes.guess_type(filename)
-        if ctype:
-            maintype, subtype = ctype.split('/', 1)
-        else:
-            maintype, subtype = "application", "octet-stream"
-        blob_part = MIMEBase(maintype, subtype)
-        blob_part.add_header("Content-ID", "input")
-        blob_part.add_header("Content-Transfer-Encoding", "binary")
-
-        # Quote UTF-8 filenames even though JAX-RS does not seem to be able
-        # to retrieve them as per: https://tools.ietf.org/html/rfc5987
-        filename = safe_filename(filename)
-        quoted_filename = urllib2.quote(filename.encode('utf-8'))
-        content_disposition = ("attachment; filename*=UTF-8''%s"
-                                % quoted_filename)
-        blob_part.add_header("Content-Disposition", content_disposition)
-        blob_part.set_payload(blob_content)
-        container.attach(blob_part)
-
-        data = (
-            "--%s\r\n"
-            "%s\r\n"
-            "--%s\r\n"
-            "%s\r\n"
-            "--%s--"
-        ) % (
-            boundary,
-            json_part.as_string(),
-            boundary,
-            blob_part.as_string(),
-            boundary,
-        )
-
-        cookies = self._get_cookies()
-        log.trace("Calling %s with headers %r and cookies %r for file %s",
-            url, headers, cookies, filename)
+        json_struct = {'params': params}
+        if context:
+            json_struct['context'] = context
+        json_data = json_codec.dumps(json_struct)
+        json_headers = [
+            ("Content-Type", "application/json+nxrequest"),
+            ("Content-ID", "request"),
+        ]
+
+        parts = [(json_headers, json_data)]
+        filenames = []
+        for index, (blob_content, filename) in enumerate(blobs):
+            ctype, _ = mimetypes.guess_type(filename)
+            # Quote UTF-8 filenames even though JAX-RS does not seem to be
+            # able to retrieve them as per: https://tools.ietf.org/html/rfc5987
+            filename = safe_filename(filename)
+            quoted_filename = urllib2.quote(filename.encode('utf-8'))
+            blob_headers = [
+                ("Content-Type", ctype or "application/octet-stream"),
+                ("Content-ID", "input%d" % index if index else "input"),
+                ("Content-Transfer-Encoding", "binary"),
+                ("Content-Disposition",
+                 "attachment; filename*=UTF-8''%s" % quoted_filename),
+            ]
+            parts.append((blob_headers, to_body(blob_content)))
+            filenames.append(filename)
+        data = self._throttle_upload(MultipartBody(boundary, parts))
+        headers["Content-Length"] = data.length
+
+        log.trace("Calling %s with headers %r and cookies %r for files %r",
+            url, headers, lazy(self._get_cookies), filenames)
         req = urllib2.Request(url, data, headers)
         try:
-            resp = self.opener.open(req, timeout=self.blob_timeout)
+            resp = self._open(req, self.blob_timeout)
         except Exception as e:
             self._log_details(e)
             raise
@@ -369,32 +498,125 @@ class BaseAutomationClient(object):
         return self._read_response(resp, url)
 
     def execute_with_blob_streaming(self, command, file_path, filename=None,
-                                    **params):
+                                    upload=None, **params):
+        """Execute an Automation operation using a batch upload as an input
+
+        Upload is streamed. Small files (see inline_upload_max_size) are
+        sent along with the operation in a single request. Files larger than
+        the chunk size are uploaded in chunks: pass the ChunkedUpload of a
+        previous attempt as upload to resume it. The content is hashed on
+        the way if upload has a digest algorithm.
+        """
+        if filename is None:
+            filename = os.path.basename(file_path)
+        if upload is None:
+            upload = ChunkedUpload(chunk_size=self.upload_chunk_size)
+        file_size = os.path.getsize(file_path)
+        if file_size <= upload.chunk_size:
+            body = FileBody(file_path, hasher=upload.new_hasher())
+            if file_size <= self.inline_upload_max_size:
+                result = self.execute_with_blob(command, body, filename,
+                                                **params)
+            else:
+                result = self.execute_with_body_streaming(
+                    command, body, filename, **params)
+            upload.content_digest = body.hexdigest()
+            return result
+        self.upload_chunked(upload, file_path, filename)
+        try:
+            return self.execute_batch(command, upload.batch_id, '0',
+                                      **params)
+        except urllib2.HTTPError as e:
+            if e.code not in OVERLOAD_HTTP_STATUS:
+                # The server might have lost the uploaded chunks (e.g. the
+                # batch expired): upload them all again next time
+                upload.reset()
+            raise
+
+    def execute_with_body_streaming(self, command, body, filename, **params):
         """Execute an Automation operation using a batch upload as an input
 
-        Upload is streamed.
+        body can be any source accepted by streaming.to_body: in-memory
+        content is uploaded as is, without any temporary file.
         """
+        body = to_body(body)
         batch_id = self._generate_unique_id()
-        upload_result = self.upload(batch_id, file_path, filename=filename)
+        upload_result = self.upload_body(batch_id, body, filename)
         if upload_result['uploaded'] == 'true':
             return self.execute_batch(command, batch_id, '0', **params)
         else:
             raise ValueError("Bad response from batch upload with id '%s'"
-                             " and file path '%s'" % (batch_id, file_path))
+                             " for file '%s'" % (batch_id, filename))
 
     def upload(self, batch_id, file_path, filename=None, file_index=0):
-        """Upload a file through an Automation batch
+        """Upload a file through an Automation batch"""
+        if filename is None:
+            filename = os.path.basename(file_path)
+        return self.upload_body(batch_id, FileBody(file_path), filename,
+                                file_index=file_index)
+
+    def upload_chunked(self, upload, file_path, filename=None, file_index=0):
+        """Upload a file chunk by chunk through an Automation batch
 
-        Uses poster.httpstreaming to stream the upload
-        and not load the whole file in memory.
+        upload is the ChunkedUpload tracking the progress: a new batch is
+        started unless upload has one for a file of the same size, in which
+        case the chunks already acknowledged are not sent again. A chunk is
+        an idempotent request: it is retried on transient errors.
+        """
+        if filename is None:
+            filename = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        if not upload.is_started(file_size):
+            upload.start(self._generate_unique_id(), file_size)
+            upload.save()
+        elif upload.uploaded_chunks:
+            log.debug("Resuming upload of %s from chunk %d/%d", file_path,
+                      upload.uploaded_chunks + 1, upload.chunk_count)
+        chunk_size = upload.chunk_size
+        hasher = upload.new_hasher()
+        if hasher is not None and upload.uploaded_chunks:
+            # Only the chunks uploaded by a previous attempt are read again
+            self._hash_file(file_path, hasher, min(
+                file_size, upload.uploaded_chunks * chunk_size))
+        for index in range(upload.uploaded_chunks, upload.chunk_count):
+            offset = index * chunk_size
+            body = FileBody(file_path, offset=offset,
+                            length=min(chunk_size, file_size - offset),
+                            hasher=hasher)
+            result = self.upload_body(
+                upload.batch_id, body, filename, file_index=file_index,
+                chunk_index=index, chunk_count=upload.chunk_count,
+                file_size=file_size)
+            if result.get('uploaded') != 'true':
+                raise ValueError("Bad response from batch upload with id"
+                                 " '%s' for chunk %d of file '%s'" % (
+                                     upload.batch_id, index, filename))
+            hasher = body.hasher
+            upload.uploaded_chunks = index + 1
+            upload.save()
+        if hasher is not None:
+            upload.content_digest = hasher.hexdigest()
+        return upload
+
+    def _hash_file(self, file_path, hasher, size):
+        with open(file_path, 'rb') as f:
+            for chunk in FileBody(f, length=size):
+                hasher.update(chunk)
+
+    def upload_body(self, batch_id, body, filename, file_index=0,
+                    chunk_index=None, chunk_count=None, file_size=None):
+        """Upload a streaming body through an Automation batch
+
+        The body is sent chunk by chunk through the keep alive handlers so
+        as not to load the whole content in memory.
+
+        If chunk_index is not None, body is the chunk of that index among
+        the chunk_count ones of a file of file_size bytes.
         """
         # Request URL
         url = self.automation_url.encode('ascii') + self.batch_upload_url
 
         # HTTP headers
-        if filename is None:
-            filename = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
         ctype, _ = mimetypes.guess_type(filename)
         if ctype:
             mime_type = ctype
@@ -408,36 +630,32 @@ class BaseAutomationClient(object):
             "X-Batch-Id": batch_id,
             "X-File-Idx": file_index,
             "X-File-Name": quoted_filename,
-            "X-File-Size": file_size,
+            "X-File-Size": body.length,
             "X-File-Type": mime_type,
             "Content-Type": "application/octet-stream",
-            "Content-Length": file_size,
+            "Content-Length": body.length,
         }
+        if chunk_index is not None:
+            headers.update({
+                "X-Upload-Type": "chunked",
+                "X-Upload-Chunk-Index": chunk_index,
+                "X-Upload-Chunk-Count": chunk_count,
+                "X-File-Size": file_size,
+            })
         headers.update(self._get_common_headers())
 
-        # Request data
-        input_file = open(file_path, 'rb')
-        # Use file system block size if available for streaming buffer
-        if sys.platform != 'win32':
-            fs_block_size = os.fstatvfs(input_file.fileno()).f_bsize
-        else:
-            fs_block_size = DEFAULT_STREAMING_BUFFER_SIZE
-        log.trace("Using file system block size"
-                  " for the streaming upload buffer: %u bytes", fs_block_size)
-        data = self._read_data(input_file, fs_block_size)
-
         # Execute request
-        cookies = self._get_cookies()
         log.trace("Calling %s with headers %r and cookies %r for file %s",
-            url, headers, cookies, file_path)
-        req = urllib2.Request(url, data, headers)
+            url, headers, lazy(self._get_cookies), filename)
+        req = urllib2.Request(url, self._throttle_upload(body), headers)
         try:
-            resp = self.streaming_opener.open(req, timeout=self.blob_timeout)
+            # Sending a chunk again overwrites it
+            resp = self._open(req, self.blob_timeout,
+                              idempotent=chunk_index is not None,
+                              opener=self.streaming_opener)
         except Exception as e:
             self._log_details(e)
             raise
-        finally:
-            input_file.close()
 
         return self._read_response(resp, url)
 
@@ -470,12 +688,11 @@ class BaseAutomationClient(object):
         url += urlencode(parameters)
 
         headers = self._get_common_headers()
-        cookies = self._get_cookies()
         log.trace("Calling %s with headers %r and cookies %r",
-                url, headers, cookies)
+                url, headers, lazy(self._get_cookies))
         req = urllib2.Request(url, headers=headers)
         try:
-            token = self.opener.open(req, timeout=self.timeout).read()
+            token = self._open(req, self.timeout, idempotent=True).read()
         except urllib2.HTTPError as e:
             if e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
@@ -489,8 +706,8 @@ class BaseAutomationClient(object):
             if hasattr(e, 'msg'):
                 e.msg = base_error_message + ": " + e.msg
             raise
-        cookies = self._get_cookies()
-        log.trace("Got token '%s' with cookies %r", token, cookies)
+        log.trace("Got token '%s' with cookies %r", token,
+                  lazy(self._get_cookies))
         # Use the (potentially re-newed) token from now on
         if not revoke:
             self._update_auth(token=token)
@@ -544,50 +761,109 @@ class BaseAutomationClient(object):
     def _get_cookies(self):
         return list(self.cookie_jar) if self.cookie_jar is not None else []
 
-    def _check_params(self, command, params):
-        if command not in self.operations:
-            raise ValueError("'%s' is not a registered operations." % command)
-        method = self.operations[command]
-        required_params = []
-        other_params = []
-        for param in method['params']:
-            if param['required']:
-                required_params.append(param['name'])
-            else:
-                other_params.append(param['name'])
+    def _open(self, req, timeout, idempotent=False, opener=None):
+        """Send req through the circuit breaker of the server
 
-        for param in params.keys():
-            if (not param in required_params
-                and not param in other_params):
-                raise ValueError("Unexpected param '%s' for operation '%s"
-                                 % (param, command))
-        for param in required_params:
-            if not param in params:
-                raise ValueError(
-                    "Missing required param '%s' for operation '%s'" % (
-                        param, command))
+        Transient errors are retried with backoff for idempotent requests
+        only. Raise CircuitOpenError without sending anything while the
+        server is considered down.
+        """
+        opener = opener if opener is not None else self.opener
+        breaker = self.circuit_breaker
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                try:
+                    response = opener.open(req, timeout=timeout)
+                except urllib2.HTTPError as e:
+                    if e.code not in OVERLOAD_HTTP_STATUS:
+                        self._handle_open_error(req, e, idempotent, attempt)
+                        attempt += 1
+                        continue
+                    # The server is up but asks to slow down
+                    breaker.on_success()
+                    e = self._overloaded(e)
+                    # Only wait for the server to be ready again if it is fast
+                    if not (idempotent
+                            and attempt + 1 < self.retry_policy.max_attempts
+                            and e.retry_after <= self.retry_policy.max_delay):
+                        raise e
+                    log.debug("Retrying %s in %ds as requested by the server",
+                              req.get_full_url(), e.retry_after)
+                    self.retry_policy.sleep(e.retry_after)
+                    attempt += 1
+                    continue
+                except Exception as e:
+                    self._handle_open_error(req, e, idempotent, attempt)
+                    attempt += 1
+                    continue
+                breaker.on_success()
+                return response
+            finally:
+                # Never leave a probe in flight, whatever the error
+                breaker.end_call()
+
+    def _handle_open_error(self, req, e, idempotent, attempt):
+        """Raise e unless the request should be sent again"""
+        breaker = self.circuit_breaker
+        if is_transient_error(e):
+            breaker.on_failure()
+        elif isinstance(e, urllib2.HTTPError):
+            # The server is up, even if it did not like the request
+            breaker.on_success()
+        if not (idempotent and self.retry_policy.should_retry(e, attempt)):
+            raise e
+        delay = self.retry_policy.get_delay(attempt)
+        log.debug("Retrying %s in %0.3fs after error: %r",
+                  req.get_full_url(), delay, e)
+        self.retry_policy.sleep(delay)
+
+    def _throttle_upload(self, body):
+        if self.bandwidth_limiter is None:
+            return body
+        return ThrottledBody(body, self.bandwidth_limiter)
+
+    def _overloaded(self, e):
+        """Record the slow down request of the server"""
+        retry_after = get_retry_after(e)
+        self.backpressure.slow_down(retry_after)
+        return ServerOverloaded(e, retry_after)
 
-        # TODO: add typechecking
+    def _check_params(self, command, params):
+        try:
+            self._validate_params(command, params)
+        except ValueError:
+            if not self._registry_from_cache:
+                raise
+            # The cached registry might be outdated, e.g. after a server
+            # upgrade: refresh it before checking again
+            log.debug("Refreshing the operation registry of %s to check"
+                      " the parameters of '%s'", self.server_url, command)
+            self.fetch_api()
+            self._validate_params(command, params)
+
+    def _validate_params(self, command, params):
+        self.registry.check_params(command, params)
 
     def _read_response(self, response, url):
         info = response.info()
         s = response.read()
         content_type = info.get('content-type', '')
-        cookies = self._get_cookies()
         if content_type.startswith("application/json"):
             log.trace("Response for '%s' with cookies %r and JSON payload: %r",
-                url, cookies, s)
-            return json.loads(s) if s else None
+                url, lazy(self._get_cookies), s)
+            return json_codec.loads(s) if s else None
         else:
             log.trace("Response for '%s' with cookies %r and content-type: %r",
-                url, cookies, content_type)
+                url, lazy(self._get_cookies), content_type)
             return s
 
     def _log_details(self, e):
         if hasattr(e, "fp"):
             detail = e.fp.read()
             try:
-                exc = json.loads(detail)
+                exc = json_codec.loads(detail)
                 log.debug(exc['message'])
                 log.debug(exc['stack'], exc_info=True)
             except:
@@ -599,10 +875,3 @@ class BaseAutomationClient(object):
         """Generate a unique id based on a timestamp and a random integer"""
 
         return str(time.time()) + '_' + str(random.randint(0, 1000000000))
-
-    def _read_data(self, file_object, buffer_size):
-        while True:
-            r = file_object.read(buffer_size)
-            if not r:
-                break
-            yield r
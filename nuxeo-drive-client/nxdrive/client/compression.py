@@ -0,0 +1,189 @@
+"""Transparent decompression of the HTTP responses of the Nuxeo server
+
+JSON responses (change summaries, children listings, operation registry) are
+highly compressible: the Automation clients advertise gzip and deflate
+support and decode the responses on the fly, chunk by chunk, so that large
+responses never need to be held twice in memory.
+
+Binary downloads only advertise compression for the content types that are
+worth it: most office documents, images and archives are already compressed.
+"""
+import mimetypes
+import socket
+import urllib2
+import zlib
+from urllib import addinfourl
+from urlparse import urlparse
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+ACCEPT_ENCODING = 'gzip, deflate'
+
+IDENTITY_ENCODING = 'identity'
+
+# Size of the chunks of compressed data read from the network
+READ_SIZE = 64 * 1024
+
+# Content types of the binary downloads worth compressing, in addition to
+# the text/* types
+COMPRESSIBLE_TYPES = frozenset([
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/x-sh',
+    'application/x-tex',
+    'application/postscript',
+    'application/rtf',
+    'application/x-msdos-program',
+    'image/svg+xml',
+    'image/bmp',
+    'image/x-ms-bmp',
+    'image/tiff',
+])
+
+
+def is_compressible(filename):
+    """Tell whether compressing the content of filename is worthwhile"""
+    ctype, encoding = mimetypes.guess_type(filename)
+    if ctype is None or encoding is not None:
+        # Unknown or already compressed (e.g. .tar.gz) content
+        return False
+    return ctype.startswith('text/') or ctype in COMPRESSIBLE_TYPES
+
+
+def accept_encoding_for(url):
+    """Accept-Encoding header value for a download URL"""
+    if is_compressible(urlparse(url).path):
+        return ACCEPT_ENCODING
+    return IDENTITY_ENCODING
+
+
+class _DecodingReader(object):
+    """Decode a response body while it is read from the network
+
+    Also count the bytes received on the wire and the decoded bytes to
+    report them once the response is consumed.
+    """
+
+    def __init__(self, response, encoding, url, handler):
+        self._response = response
+        self._encoding = encoding
+        self._url = url
+        self._handler = handler
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        else:
+            self._decoder = None
+        # Some servers send raw deflate streams without the zlib header
+        self._first_chunk = encoding == 'deflate'
+        self._pending = b''
+        self._eof = False
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def recv(self, amt=None):
+        if amt is None or amt < 0:
+            amt = READ_SIZE
+        data = b''
+        while not data and not self._eof:
+            data = self._decode(amt)
+        self.decoded_bytes += len(data)
+        if self._eof and not data:
+            self._report()
+        return data
+
+    read = recv
+
+    def close(self):
+        self._report()
+        self._response.close()
+
+    def _decode(self, amt):
+        if self._decoder is None:
+            data = self._read_raw(amt)
+            if not data:
+                self._eof = True
+            return data
+        if self._pending:
+            raw, self._pending = self._pending, b''
+        else:
+            raw = self._read_raw(READ_SIZE)
+        if not raw:
+            self._eof = True
+            return self._decoder.flush()
+        try:
+            data = self._decoder.decompress(raw, amt)
+        except zlib.error:
+            if not self._first_chunk:
+                raise
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decoder.decompress(raw, amt)
+        self._first_chunk = False
+        # Bound the decoded size of each read: keep the compressed data that
+        # was not decoded yet for the next reads
+        self._pending = self._decoder.unconsumed_tail
+        return data
+
+    def _read_raw(self, amt):
+        raw = self._response.read(amt)
+        self.wire_bytes += len(raw)
+        return raw
+
+    def _report(self):
+        if self._handler is None:
+            return
+        handler, self._handler = self._handler, None
+        handler.record(self._url, self._encoding, self.wire_bytes,
+                       self.decoded_bytes)
+
+
+class DecompressionHandler(urllib2.BaseHandler):
+    """Negotiate compressed responses and decode them transparently
+
+    Requests that already have an Accept-Encoding header (e.g. binary
+    downloads not worth compressing) are left untouched.
+    """
+
+    # Decode the error responses too, before HTTPErrorProcessor raises them
+    handler_order = 900
+
+    def __init__(self):
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-encoding', ACCEPT_ENCODING)
+        return req
+
+    https_request = http_request
+
+    def http_response(self, req, response):
+        encoding = response.info().get('Content-Encoding', IDENTITY_ENCODING)
+        encoding = encoding.strip().lower()
+        if encoding == 'x-gzip':
+            encoding = 'gzip'
+        if encoding not in ('gzip', 'deflate'):
+            encoding = IDENTITY_ENCODING
+        reader = _DecodingReader(response, encoding, req.get_full_url(),
+                                 self)
+        decoded = addinfourl(socket._fileobject(reader, close=True),
+                             response.info(), response.geturl(),
+                             response.code)
+        decoded.msg = response.msg
+        return decoded
+
+    https_response = http_response
+
+    def record(self, url, encoding, wire_bytes, decoded_bytes):
+        self.wire_bytes += wire_bytes
+        self.decoded_bytes += decoded_bytes
+        log.debug("Received %d bytes on the wire for %d decoded bytes"
+                  " (%s) from %s", wire_bytes, decoded_bytes, encoding, url)
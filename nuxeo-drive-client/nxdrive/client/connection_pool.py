@@ -0,0 +1,285 @@
+"""Persistent HTTP/1.1 connections shared by the Automation clients
+
+The default urllib2 handlers force a "Connection: close" header and open a
+new TCP connection (and TLS handshake) for each request. The handlers of this
+module keep the connections alive and park them in a pool once the response
+has been fully read so that the next request to the same host (or proxy)
+can reuse them.
+"""
+import httplib
+import select
+import socket
+import urllib2
+from threading import Lock
+from time import time
+from urllib import addinfourl
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Maximum number of idle connections kept per host
+DEFAULT_MAX_IDLE_PER_HOST = 4
+
+# Idle connections are closed after this delay in seconds to avoid reusing
+# connections already dropped by the server or by a proxy
+DEFAULT_IDLE_TIMEOUT = 30
+
+
+class ConnectionPool(object):
+    """Thread safe pool of idle HTTP connections indexed by host
+
+    A connection is only owned by the pool while idle: it is handed over to
+    a single thread for the duration of a request / response exchange.
+    """
+
+    def __init__(self, max_idle_per_host=DEFAULT_MAX_IDLE_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = Lock()
+
+    def acquire(self, key):
+        """Return a reusable idle connection for key or None"""
+        with self._lock:
+            connections = self._idle.get(key, [])
+            evicted = []
+            connection = None
+            now = time()
+            while connections:
+                conn, released = connections.pop()
+                if now - released > self.idle_timeout or _is_stale(conn):
+                    evicted.append(conn)
+                    continue
+                connection = conn
+                break
+            # Older idle connections are at the beginning of the list
+            while connections and now - connections[0][1] > self.idle_timeout:
+                evicted.append(connections.pop(0)[0])
+        for conn in evicted:
+            conn.close()
+        return connection
+
+    def release(self, key, conn):
+        """Park a connection whose last response has been fully read"""
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append((conn, time()))
+                return
+        conn.close()
+
+    def clear(self):
+        """Close all the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+
+def _is_stale(conn):
+    """Check whether the server has closed an idle connection"""
+    if conn.sock is None:
+        return True
+    try:
+        # An idle connection is not expected to receive anything: if it is
+        # readable then it has been closed by the peer
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        return bool(readable)
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class _StreamingMixin:
+    """Send iterable request bodies chunk by chunk
+
+    The bodies of the streaming module write themselves to the socket,
+    possibly with sendfile when zero_copy is set by the handler.
+    """
+
+    zero_copy = False
+
+    def connect(self):
+        self._connection_class.connect(self)
+        # Small requests on persistent connections must not wait for the
+        # acknowledgement of the previous segments
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data):
+        if isinstance(data, basestring) or hasattr(data, 'read'):
+            return httplib.HTTPConnection.send(self, data)
+        if self.sock is None:
+            if self.auto_open:
+                self.connect()
+            else:
+                raise httplib.NotConnected()
+        if hasattr(data, 'send_to'):
+            data.send_to(self.sock, zero_copy=self.zero_copy)
+            return
+        for chunk in data:
+            self.sock.sendall(chunk)
+
+
+class PooledHTTPConnection(_StreamingMixin, httplib.HTTPConnection):
+
+    _connection_class = httplib.HTTPConnection
+
+
+class PooledHTTPSConnection(_StreamingMixin, httplib.HTTPSConnection):
+
+    _connection_class = httplib.HTTPSConnection
+
+
+class _ResponseReader(object):
+    """Release the connection to the pool once the response is consumed"""
+
+    def __init__(self, response, release, discard):
+        self._response = response
+        self._release = release
+        self._discard = discard
+        self._done = False
+
+    def recv(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._finish()
+        return data
+
+    read = recv
+
+    def close(self):
+        self._response.close()
+        if not self._done:
+            # The response body was not fully read: the connection cannot be
+            # reused for another request
+            self._done = True
+            self._discard()
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            self._release()
+
+
+class _KeepAliveMixin:
+
+    # Whether request bodies can be written to the sockets without going
+    # through the socket object, i.e. plain HTTP
+    zero_copy = False
+
+    def do_request_(self, request):
+        data = request.get_data()
+        if (data is not None and not isinstance(data, basestring)
+            and not request.has_header('Content-length')):
+            raise ValueError("Content-Length is required to stream a request"
+                             " body to %s" % request.get_full_url())
+        return urllib2.AbstractHTTPHandler.do_request_(self, request)
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (http_class.__name__, host, req._tunnel_host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        proxy_auth_hdr = "Proxy-Authorization"
+        if req._tunnel_host and proxy_auth_hdr in headers:
+            # Proxy-Authorization should not be sent to origin server
+            tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        data = req.get_data()
+        # Iterable bodies cannot be sent again if a reused connection turns
+        # out to be broken, unless they can be iterated again (e.g. the
+        # replayable bodies of the streaming module)
+        replayable = (data is None or isinstance(data, basestring)
+                      or getattr(data, 'replayable', False))
+
+        response = None
+        conn = self._pool.acquire(key)
+        if conn is not None:
+            conn.timeout = req.timeout
+            if req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                conn.sock.settimeout(req.timeout)
+            try:
+                response = self._send(conn, req, headers, data)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if not replayable:
+                    raise urllib2.URLError(e)
+                log.trace("Reused connection to %s failed with %r:"
+                          " retrying with a new connection", host, e)
+                conn = None
+
+        if conn is None:
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            if req._tunnel_host:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            try:
+                response = self._send(conn, req, headers, data)
+            except socket.error as e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        if response.will_close:
+            # The connection is already handed over to the response
+            release = discard = lambda: None
+        else:
+            release = lambda: self._pool.release(key, conn)
+            discard = conn.close
+        reader = _ResponseReader(response, release, discard)
+        fp = socket._fileobject(reader, close=True)
+        resp = addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _send(self, conn, req, headers, data):
+        # Bodies sent to a proxy are written through the socket object too
+        conn.zero_copy = self.zero_copy and not req.has_proxy()
+        conn.request(req.get_method(), req.get_selector(), data, headers)
+        return conn.getresponse(buffering=True)
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, urllib2.HTTPHandler):
+
+    zero_copy = True
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel=debuglevel)
+        self._pool = pool
+
+    def http_open(self, req):
+        return self.do_open(PooledHTTPConnection, req)
+
+    def http_request(self, req):
+        return self.do_request_(req)
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, urllib2.HTTPSHandler):
+
+    def __init__(self, pool, debuglevel=0, context=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel=debuglevel,
+                                      context=context)
+        self._pool = pool
+
+    def https_open(self, req):
+        return self.do_open(PooledHTTPSConnection, req,
+                            context=self._context)
+
+    def https_request(self, req):
+        return self.do_request_(req)
+
+
+def get_handlers(pool):
+    """Return the urllib2 handlers reusing the connections of pool"""
+    return [KeepAliveHTTPHandler(pool), KeepAliveHTTPSHandler(pool)]
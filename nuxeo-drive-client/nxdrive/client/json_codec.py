@@ -0,0 +1,87 @@
+"""JSON codec used for the Automation requests and responses
+
+Decoding the change summaries and children listings is one of the main CPU
+costs of the synchronization loop. A C-accelerated implementation is used
+when one is installed, otherwise the standard library json module.
+
+simplejson is deliberately not used: on Python 2 it decodes ASCII strings
+as str instead of unicode, which the rest of the code does not expect.
+"""
+import json
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+class StdlibCodec(object):
+
+    name = 'json'
+
+    loads = staticmethod(json.loads)
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj)
+
+
+class UltraJSONCodec(object):
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        try:
+            ujson.dumps(u'/', escape_forward_slashes=False)
+        except TypeError:
+            # escape_forward_slashes came with ujson 1.34
+            raise ImportError("ujson %s is too old" % getattr(
+                ujson, '__version__', 'unknown'))
+        self._ujson = ujson
+        self.loads = ujson.loads
+
+    def dumps(self, obj):
+        # Keep the same output as the json module for URLs and paths
+        return self._ujson.dumps(obj, ensure_ascii=True,
+                                 escape_forward_slashes=False)
+
+
+# Codecs by order of preference
+CODECS = (
+    ('ujson', UltraJSONCodec),
+    ('json', StdlibCodec),
+)
+
+
+def get_codec(names=None):
+    """Return the first available codec among names (all by default)"""
+    for name, codec_class in CODECS:
+        if names is not None and name not in names:
+            continue
+        try:
+            return codec_class()
+        except ImportError:
+            log.trace("JSON codec %s is not available", name)
+    raise ValueError("No JSON codec available among %r" % (names,))
+
+
+_codec = get_codec()
+
+
+def set_codec(codec):
+    """Replace the codec used by loads and dumps, e.g. for benchmarks"""
+    global _codec
+    _codec = codec
+
+
+def get_current_codec():
+    return _codec
+
+
+def loads(s):
+    return _codec.loads(s)
+
+
+def dumps(obj):
+    return _codec.dumps(obj)
@@ -41,6 +41,7 @@ class FileInfo(object):
 
         # Function to use
         self._digest_func = digest_func.lower()
+        self._digest = None
 
         # Precompute base name once and for all are it's often useful in
         # practice
@@ -49,10 +50,21 @@ class FileInfo(object):
         self.filepath = os.path.join(
             root, path[1:].replace(u'/', os.path.sep))
 
+    def set_digest(self, digest, digest_func):
+        """Reuse a digest computed elsewhere, e.g. while downloading the file
+
+        The digest is ignored if not computed with the same function.
+        """
+        if (digest_func is not None
+            and digest_func.lower() == self._digest_func):
+            self._digest = digest
+
     def get_digest(self):
         """Lazy computation of the digest"""
         if self.folderish:
             return None
+        if self._digest is not None:
+            return self._digest
         digester = getattr(hashlib, self._digest_func, None)
         if digester is None:
             raise ValueError('Unknow digest method: ' + self.digest_func)
@@ -90,6 +102,10 @@ class LocalClient(object):
         self.base_folder = base_folder
         self._digest_func = digest_func
 
+    @property
+    def digest_func(self):
+        return self._digest_func
+
     # Getters
     def get_info(self, ref, raise_if_missing=True):
         os_path = self._abspath(ref)
@@ -0,0 +1,144 @@
+"""Materialize files from identical local content instead of downloading it
+
+A remote file often has the same content as a file already synchronized
+locally: copies across workspaces, documents created from a template, a
+restored version. Its content is then copied from the local file, cloned
+(reflink) when the file system supports it so that no block is actually
+written, and checked against the expected digest: the local file may have
+changed since it was last scanned, in which case the content is downloaded
+as usual.
+"""
+import errno
+import hashlib
+import os
+import sys
+import tempfile
+
+from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.local_client import FileInfo
+from nxdrive.client.remote_file_system_client import DOWNLOAD_TMP_FILE_PREFIX
+from nxdrive.logging_config import get_logger
+from nxdrive.utils import safe_long_path
+
+fcntl = None
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    pass
+
+
+log = get_logger(__name__)
+
+# ioctl sharing the blocks of a file with another one on Linux (btrfs, XFS)
+FICLONE = 0x40049409
+
+# Suffix of the temporary files the local copies are made into, not to
+# clash with the part files of the resumable downloads
+COPY_TMP_FILE_SUFFIX = '.copy'
+
+# Errors telling that the file system cannot clone files
+CLONE_NOT_SUPPORTED = frozenset([
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+])
+
+
+def clone_file(source_path, target_path):
+    """Make target_path a clone of source_path, sharing its blocks
+
+    Return False if the file system does not support it, target_path then
+    being left empty.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    with open(source_path, 'rb') as source:
+        with open(target_path, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            except IOError as e:
+                if e.errno in CLONE_NOT_SUPPORTED:
+                    return False
+                raise
+    return True
+
+
+def _copy_file(source_path, target_path, hasher):
+    with open(source_path, 'rb') as source:
+        with open(target_path, 'wb') as target:
+            while True:
+                buffer_ = source.read(BUFFER_SIZE)
+                if buffer_ == '':
+                    break
+                hasher.update(buffer_)
+                target.write(buffer_)
+
+
+class LocalCopy(object):
+    """Local file expected to have the content of a remote file
+
+    digest is the digest of the remote file computed with digest_func, the
+    digest function of the local client. Once materialized, size is the
+    number of bytes that did not have to be downloaded.
+    """
+
+    def __init__(self, source_path, digest, digest_func):
+        self.source_path = source_path
+        self.digest = digest
+        self.digest_func = digest_func
+        self.size = None
+
+    def materialize(self, file_path):
+        """Write the content to a temporary file next to file_path
+
+        Return the temporary file, as stream_content does, or None if the
+        content cannot be copied or does not have the expected digest. The
+        part file of an interrupted download of file_path is left as is.
+        """
+        digester = getattr(hashlib, self.digest_func, None)
+        if digester is None:
+            return None
+        hasher = digester()
+        source_path = safe_long_path(self.source_path)
+        folder, name = os.path.split(file_path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                suffix=COPY_TMP_FILE_SUFFIX,
+                prefix=DOWNLOAD_TMP_FILE_PREFIX + name + u'.', dir=folder)
+            os.close(fd)
+        except (IOError, OSError) as e:
+            log.debug("Could not create a temporary file in %s: %s", folder,
+                      e)
+            return None
+        try:
+            if clone_file(source_path, tmp_path):
+                # No data read while cloning: read the clone to check it
+                digest = FileInfo(folder, u'/' + os.path.basename(tmp_path),
+                                  False, None,
+                                  digest_func=self.digest_func).get_digest()
+            else:
+                _copy_file(source_path, tmp_path, hasher)
+                digest = hasher.hexdigest()
+        except (IOError, OSError) as e:
+            log.debug("Could not copy %s to %s: %s", source_path, tmp_path,
+                      e)
+            self._remove(tmp_path)
+            return None
+        if digest != self.digest:
+            log.debug("%s changed since it was scanned, not copying it",
+                      source_path)
+            self._remove(tmp_path)
+            return None
+        self.size = os.path.getsize(tmp_path)
+        log.debug("Copied %d bytes from %s to %s", self.size, source_path,
+                  tmp_path)
+        return tmp_path
+
+    def _remove(self, tmp_path):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return "LocalCopy<source_path=%r, digest=%r>" % (
+            self.source_path, self.digest)
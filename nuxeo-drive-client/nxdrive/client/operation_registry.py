@@ -0,0 +1,180 @@
+"""Automation operation registries of the Nuxeo servers
+
+Fetching and parsing the whole site/automation/ operation catalogue is by far
+the most expensive part of building an Automation client. The registry of each
+server is kept in memory, shared by all the clients of all the threads, and
+persisted in the configuration folder so that it survives restarts.
+
+The parameter validators of the operations are compiled once when a registry
+is loaded instead of on each call.
+"""
+import hashlib
+import os
+from datetime import datetime
+from threading import Lock
+
+from nxdrive.client import json_codec
+from nxdrive.logging_config import get_logger
+from nxdrive.utils import safe_long_path
+
+
+log = get_logger(__name__)
+
+
+# Python types accepted for the values of the Automation parameter types.
+# Scalar values are converted by the server to the expected type, values of
+# other parameter types are not checked.
+PARAM_TYPES = {
+    'string': (basestring, int, long, float, bool),
+    'boolean': (bool, basestring),
+    'integer': (int, long, basestring),
+    'long': (int, long, basestring),
+    'date': (datetime, int, long, basestring),
+    'properties': (dict, basestring),
+    'stringlist': (list, tuple, basestring),
+}
+
+
+class OperationValidator(object):
+    """Check the parameters of the calls to an operation"""
+
+    def __init__(self, operation):
+        self.operation_id = operation['id']
+        params = operation.get('params', ())
+        self.required = frozenset(p['name'] for p in params if p['required'])
+        self.allowed = frozenset(p['name'] for p in params)
+        self.types = dict((p['name'], PARAM_TYPES[p['type']])
+                          for p in params if p.get('type') in PARAM_TYPES)
+        self._checked_types = set()
+
+    def check(self, params):
+        names = params.viewkeys()
+        if not names <= self.allowed:
+            unexpected = sorted(names - self.allowed)[0]
+            raise ValueError("Unexpected param '%s' for operation '%s"
+                             % (unexpected, self.operation_id))
+        if not self.required <= names:
+            missing = sorted(self.required - names)[0]
+            raise ValueError(
+                "Missing required param '%s' for operation '%s'" % (
+                    missing, self.operation_id))
+        # Calls to an operation are made with the same few parameter types,
+        # only check each (name, type) pair once
+        checked = self._checked_types
+        for name, value in params.iteritems():
+            if (name, value.__class__) in checked:
+                continue
+            expected = self.types.get(name)
+            if (value is not None and expected is not None
+                and not isinstance(value, expected)):
+                raise ValueError(
+                    "Invalid type %s for param '%s' of operation '%s'" % (
+                        type(value).__name__, name, self.operation_id))
+            checked.add((name, value.__class__))
+
+
+class OperationRegistry(object):
+    """Operations of a server with their compiled validators"""
+
+    def __init__(self, operations):
+        self.operations = dict((op['id'], op) for op in operations)
+        self.validators = dict((op_id, OperationValidator(op))
+                               for op_id, op in self.operations.items())
+
+    def has_param(self, command, name):
+        """Tell whether the operation command accepts the param name"""
+        validator = self.validators.get(command)
+        return validator is not None and name in validator.allowed
+
+    def check_params(self, command, params):
+        validator = self.validators.get(command)
+        if validator is None:
+            raise ValueError("'%s' is not a registered operations." % command)
+        validator.check(params)
+
+
+class OperationRegistryCache(object):
+    """Operation registries indexed by server URL and client version
+
+    The registry of a server can only change when the server is upgraded,
+    which Automation clients detect lazily as a call to an unknown operation
+    or with unexpected parameters (see BaseAutomationClient._check_params).
+    Upgrading the client also invalidates the cached registries.
+    """
+
+    def __init__(self, cache_folder=None):
+        self.cache_folder = cache_folder
+        self._registries = {}
+        self._lock = Lock()
+
+    def get(self, server_url, client_version):
+        """Return the cached OperationRegistry or None"""
+        key = (server_url, client_version)
+        with self._lock:
+            registry = self._registries.get(key)
+            if registry is None:
+                registry = self._load(server_url, client_version)
+                if registry is not None:
+                    self._registries[key] = registry
+            return registry
+
+    def put(self, server_url, client_version, registry):
+        with self._lock:
+            self._registries[(server_url, client_version)] = registry
+            self._save(server_url, client_version, registry)
+
+    def invalidate(self, server_url, client_version):
+        with self._lock:
+            self._registries.pop((server_url, client_version), None)
+            path = self._get_path(server_url)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def _get_path(self, server_url):
+        if self.cache_folder is None:
+            return None
+        filename = hashlib.md5(server_url.encode('utf-8')).hexdigest()
+        return safe_long_path(
+            os.path.join(self.cache_folder, filename + '.json'))
+
+    def _load(self, server_url, client_version):
+        path = self._get_path(server_url)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                cached = json_codec.loads(f.read())
+        except (IOError, ValueError) as e:
+            log.debug("Ignoring unreadable operation registry cache %s: %r",
+                      path, e)
+            return None
+        if (cached.get('server_url') != server_url
+            or cached.get('client_version') != client_version):
+            return None
+        log.trace("Loaded operation registry of %s from %s",
+                  server_url, path)
+        return OperationRegistry(cached['operations'])
+
+    def _save(self, server_url, client_version, registry):
+        path = self._get_path(server_url)
+        if path is None:
+            return
+        cached = {
+            'server_url': server_url,
+            'client_version': client_version,
+            'operations': registry.operations.values(),
+        }
+        try:
+            if not os.path.exists(self.cache_folder):
+                os.makedirs(self.cache_folder)
+            # Write to a temporary file first not to leave a truncated cache
+            # behind in case of failure
+            tmp_path = path + '.part'
+            with open(tmp_path, 'wb') as f:
+                f.write(json_codec.dumps(cached))
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.debug("Failed to save the operation registry cache %s: %r",
+                      path, e)
@@ -2,6 +2,7 @@
 
 import unicodedata
 from collections import namedtuple
+from itertools import islice
 from datetime import datetime
 import hashlib
 import os
@@ -22,7 +23,9 @@ FOLDER_TYPE = 'Folder'
 DEFAULT_TYPES = ('File', 'Workspace', 'Folder', 'SocialFolder')
 
 
-MAX_CHILDREN = 1000
+# Number of children fetched per Document.Query request when iterating over
+# the content of a folder
+CHILDREN_PAGE_SIZE = 1000
 
 # Data transfer objects
 
@@ -64,7 +67,9 @@ class RemoteDocumentClient(BaseAutomationClient):
                  password=None, token=None, repository="default",
                  ignored_prefixes=None, ignored_suffixes=None,
                  base_folder=None, timeout=20, blob_timeout=None,
-                 cookie_jar=None, upload_tmp_dir=None):
+                 cookie_jar=None, upload_tmp_dir=None, connection_pool=None,
+                 registry_cache=None, circuit_breakers=None,
+                 retry_policy=None, bandwidth_limiter=None):
         super(RemoteDocumentClient, self).__init__(
             server_url, user_id, device_id, client_version,
             proxies=proxies, proxy_exceptions=proxy_exceptions,
@@ -73,7 +78,12 @@ class RemoteDocumentClient(BaseAutomationClient):
             ignored_suffixes=ignored_suffixes,
             timeout=timeout, blob_timeout=blob_timeout,
             cookie_jar=cookie_jar,
-            upload_tmp_dir=upload_tmp_dir)
+            upload_tmp_dir=upload_tmp_dir,
+            connection_pool=connection_pool,
+            registry_cache=registry_cache,
+            circuit_breakers=circuit_breakers,
+            retry_policy=retry_policy,
+            bandwidth_limiter=bandwidth_limiter)
 
         # fetch the root folder ref
         self.base_folder = base_folder
@@ -89,14 +99,20 @@ class RemoteDocumentClient(BaseAutomationClient):
     #
     def get_info(self, ref, raise_if_missing=True, fetch_parent_uid=True,
                  use_trash=True, include_versions=False):
-        if not self.exists(ref, use_trash=use_trash,
-                           include_versions=include_versions):
+        ref = self._check_ref(ref)
+        try:
+            doc = self.fetch(ref)
+        except NotFound:
+            doc = None
+        if doc is not None and not self._is_visible(
+            doc, use_trash=use_trash, include_versions=include_versions):
+            doc = None
+        if doc is None:
             if raise_if_missing:
                 raise NotFound("Could not find '%s' on '%s'" % (
-                    self._check_ref(ref), self.server_url))
+                    ref, self.server_url))
             return None
-        return self._doc_to_info(self.fetch(self._check_ref(ref)),
-                                 fetch_parent_uid=fetch_parent_uid)
+        return self._doc_to_info(doc, fetch_parent_uid=fetch_parent_uid)
 
     def get_content(self, ref):
         """Download and return the binary content of a document
@@ -109,25 +125,50 @@ class RemoteDocumentClient(BaseAutomationClient):
     # TODO: allow getting content by streaming the response to an output file
     # See RemoteFileSystemClient.stream_content
 
-    def get_children_info(self, ref, types=DEFAULT_TYPES, limit=MAX_CHILDREN):
+    def get_children_info(self, ref, types=DEFAULT_TYPES, limit=None):
+        children = self.iter_children_info(ref, types=types)
+        if limit is not None:
+            children = islice(children, limit)
+        return list(children)
+
+    def iter_children_info(self, ref, types=DEFAULT_TYPES,
+                           page_size=CHILDREN_PAGE_SIZE):
+        """Generate the info of the children of a folder page by page
+
+        Only one page of results is held in memory at a time whatever the
+        number of children, unless the server cannot paginate queries: the
+        children are then all fetched at once.
+        """
         ref = self._check_ref(ref)
         query = (
             "SELECT * FROM Document"
             "       WHERE ecm:parentId = '%s'"
             "       AND ecm:primaryType IN ('%s')"
             "       AND ecm:currentLifeCycleState != 'deleted'"
-            "       ORDER BY dc:title, dc:created LIMIT %d"
-        ) % (ref, "', '".join(types), limit)
-
-        entries = self.query(query)[u'entries']
-        if len(entries) == MAX_CHILDREN:
-            # TODO: how to best handle this case? A warning and return an empty
-            # list, a dedicated exception?
-            raise RuntimeError("Folder %r on server %r has more than the"
-                               "maximum number of children: %d" % (
-                                   ref, self.server_url, MAX_CHILDREN))
-
-        return self._filtered_results(entries)
+            "       ORDER BY dc:title, dc:created, ecm:uuid"
+        ) % (ref, "', '".join(types))
+
+        if not self.registry.has_param("Document.Query", 'pageSize'):
+            entries = self.query(query)[u'entries']
+            for info in self._iter_filtered_results(entries, parent_uid=ref):
+                yield info
+            return
+
+        page_index = 0
+        while True:
+            results = self.query(query, page_size=page_size,
+                                 page_index=page_index)
+            entries = results[u'entries']
+            # All the children share the same parent: no need to resolve it
+            for info in self._iter_filtered_results(entries, parent_uid=ref):
+                yield info
+            has_next_page = results.get(u'isNextPageAvailable')
+            if has_next_page is None:
+                # Not a paginable result set
+                has_next_page = len(entries) >= page_size
+            if not has_next_page or not entries:
+                break
+            page_index += 1
 
     def make_folder(self, parent, name, doc_type=FOLDER_TYPE):
         # TODO: make it possible to configure context dependent:
@@ -164,7 +205,7 @@ class RemoteDocumentClient(BaseAutomationClient):
     def update_content(self, ref, content, filename=None):
         """Update a document with the given content
 
-        Creates a temporary file from the content then streams it.
+        The content (e.g. an in-memory buffer) is streamed as is.
         """
         if filename is None:
             filename = self.get_info(ref).name
@@ -210,6 +251,18 @@ class RemoteDocumentClient(BaseAutomationClient):
         results = self.query(query)
         return len(results[u'entries']) == 1
 
+    def _is_visible(self, doc, use_trash=True, include_versions=False):
+        """Apply the exists filters to an already fetched document"""
+        if use_trash and doc.get('state') == 'deleted':
+            return False
+        if include_versions:
+            return True
+        if 'isVersion' not in doc:
+            # Not sent by older servers, and no facet tells versions apart
+            # (published proxies are Immutable too): let the query tell
+            return self.exists(doc['uid'], use_trash=use_trash)
+        return not doc['isVersion']
+
     def check_writable(self, ref):
         # TODO: which operation can be used to perform a permission check?
         return True
@@ -249,7 +302,10 @@ class RemoteDocumentClient(BaseAutomationClient):
             else:
                 digest = blob.get('digest')
 
-        # XXX: we need another roundtrip just to fetch the parent uid...
+        # Recent servers provide the parent ref in the document description:
+        # only fall back to an additional roundtrip for older servers
+        if parent_uid is None:
+            parent_uid = doc.get('parentRef')
         if parent_uid is None and fetch_parent_uid:
             parent_uid = self.fetch(os.path.dirname(doc['path']))['uid']
 
@@ -264,12 +320,23 @@ class RemoteDocumentClient(BaseAutomationClient):
 
     def _filtered_results(self, entries, fetch_parent_uid=True,
                           parent_uid=None):
+        return list(self._iter_filtered_results(
+            entries, fetch_parent_uid=fetch_parent_uid,
+            parent_uid=parent_uid))
+
+    def _iter_filtered_results(self, entries, fetch_parent_uid=True,
+                               parent_uid=None):
         # Filter out filenames that would be ignored by the file system client
         # so as to be consistent.
-        filtered = []
-        for info in [self._doc_to_info(d, fetch_parent_uid=fetch_parent_uid,
-                                       parent_uid=parent_uid)
-                     for d in entries]:
+        parent_uids = {}
+        if parent_uid is None and fetch_parent_uid:
+            parent_uids = self._resolve_parent_uids(entries)
+        for doc in entries:
+            doc_parent_uid = parent_uid
+            if doc_parent_uid is None:
+                doc_parent_uid = parent_uids.get(os.path.dirname(doc['path']))
+            info = self._doc_to_info(doc, fetch_parent_uid=fetch_parent_uid,
+                                     parent_uid=doc_parent_uid)
             ignore = False
 
             for suffix in self.ignored_suffixes:
@@ -283,9 +350,26 @@ class RemoteDocumentClient(BaseAutomationClient):
                     break
 
             if not ignore:
-                filtered.append(info)
+                yield info
+
+    def _resolve_parent_uids(self, entries):
+        """Map the parent paths of entries lacking a parentRef to their uid
 
-        return filtered
+        Use a single query for the whole result set instead of fetching the
+        parent of each entry.
+        """
+        parent_paths = set(os.path.dirname(d['path']) for d in entries
+                           if d.get('parentRef') is None)
+        if not parent_paths:
+            return {}
+        predicates = " OR ".join("ecm:path = '%s'" % self._escape(p)
+                                 for p in sorted(parent_paths))
+        query = "SELECT * FROM Document WHERE %s" % predicates
+        return dict((d['path'], d['uid'])
+                    for d in self.query(query)[u'entries'])
+
+    def _escape(self, value):
+        return value.replace("\\", "\\\\").replace("'", "\\'")
 
     #
     # Generic Automation features reused from nuxeolib
@@ -355,8 +439,16 @@ class RemoteDocumentClient(BaseAutomationClient):
                     ref, self.server_url))
             raise e
 
-    def query(self, query, language=None):
-        return self.execute("Document.Query", query=query, language=language)
+    def query(self, query, language=None, page_size=None, page_index=None):
+        params = {}
+        # Only send the pagination params when needed as they are not
+        # registered by older servers
+        if page_size is not None:
+            params['pageSize'] = page_size
+        if page_index is not None:
+            params['currentPageIndex'] = page_index
+        return self.execute("Document.Query", query=query, language=language,
+                            **params)
 
     # Blob category
 
@@ -365,9 +457,8 @@ class RemoteDocumentClient(BaseAutomationClient):
                             timeout=self.blob_timeout)
 
     def attach_blob(self, ref, blob, filename):
-        file_path = self.make_tmp_file(blob)
-        return self.execute_with_blob_streaming("Blob.Attach",
-            file_path, filename=filename, document=ref)
+        return self.execute_with_body_streaming("Blob.Attach",
+            blob, filename, document=ref)
 
     def delete_blob(self, ref, xpath=None):
         return self.execute("Blob.Remove", op_input="doc:" + ref, xpath=xpath)
@@ -1,5 +1,7 @@
 """API to access a remote file system for synchronization."""
 
+import hashlib
+import re
 import unicodedata
 from collections import namedtuple
 from datetime import datetime
@@ -8,8 +10,13 @@ import os
 from nxdrive.logging_config import get_logger
 from nxdrive.client.common import NotFound
 from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.bandwidth import DOWNLOAD
+from nxdrive.client.bandwidth import THROTTLED_BLOCK_SIZE
 from nxdrive.client.base_automation_client import Unauthorized
 from nxdrive.client.base_automation_client import BaseAutomationClient
+from nxdrive.client.compression import IDENTITY_ENCODING
+from nxdrive.client.compression import accept_encoding_for
+from nxdrive.client.streaming import FileBody
 
 
 log = get_logger(__name__)
@@ -17,6 +24,117 @@ log = get_logger(__name__)
 DOWNLOAD_TMP_FILE_PREFIX = '.'
 DOWNLOAD_TMP_FILE_SUFFIX = '.part'
 
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-\d+/(\d+)$')
+
+# Factory of the file system items of the documents with a blob
+FILE_ITEM_FACTORY = u'defaultFileSystemItemFactory'
+
+
+def split_fs_item_id(fs_item_id):
+    """Return the (factory, repository, doc id) of a document backed item
+
+    None for the items not backed by a document, e.g. the top level folder.
+    """
+    parts = fs_item_id.split(u'#')
+    if len(parts) != 3 or not parts[1] or not parts[2]:
+        return None
+    return tuple(parts)
+
+
+def get_download_tmp_path(file_path):
+    """Temporary file the content of file_path is downloaded into"""
+    return os.path.join(os.path.dirname(file_path), DOWNLOAD_TMP_FILE_PREFIX
+                        + os.path.basename(file_path)
+                        + DOWNLOAD_TMP_FILE_SUFFIX)
+
+
+class CorruptedFile(IOError):
+    """Downloaded content not matching the digest of the remote file"""
+
+
+class PartialDownload(object):
+    """Progress of the download of a file into its .part temporary file
+
+    The .part file is kept when the download is interrupted: the next
+    attempt resumes it with a Range request, as long as the remote file
+    still has the expected digest. on_save, if any, is called with the
+    download when the expected digest or size change to persist them.
+
+    Once downloaded, content_digest is the digest of the content computed
+    with digest_algorithm while downloading it, checked against the
+    expected digest.
+    """
+
+    def __init__(self, digest=None, size=None, on_save=None):
+        self.digest = digest
+        self.size = size
+        self.offset = 0
+        self.on_save = on_save
+        self.content_digest = None
+        self.digest_algorithm = None
+
+    def start(self, file_path, digest):
+        """Return the offset to resume the download of file_path from"""
+        if (digest is not None and digest == self.digest
+            and os.path.exists(file_path)):
+            self.offset = os.path.getsize(file_path)
+            if self.size is not None and self.offset > self.size:
+                self.offset = 0
+        else:
+            self.offset = 0
+            self.size = None
+            if digest != self.digest:
+                self.digest = digest
+                self.save()
+        return self.offset
+
+    def is_complete(self):
+        return self.offset > 0 and self.offset == self.size
+
+    def accept(self, response):
+        """Return the offset where to write the content of response
+
+        That is 0 if the server ignored the Range header, in which case the
+        whole content is downloaded again.
+        """
+        headers = response.info()
+        match = CONTENT_RANGE_PATTERN.match(
+            headers.get('Content-Range', '').strip())
+        if response.code == 206 and match is not None:
+            start, size = int(match.group(1)), int(match.group(2))
+            if start != self.offset:
+                raise IOError("Unexpected content range: %s" % (
+                    headers.get('Content-Range')))
+        else:
+            if self.offset:
+                log.debug("No range support, downloading %s again",
+                          response.geturl())
+            self.offset = 0
+            size = None
+            if ('Content-Length' in headers
+                and 'Content-Encoding' not in headers):
+                size = int(headers['Content-Length'])
+        if size != self.size:
+            self.size = size
+            self.save()
+        return self.offset
+
+    def reset(self):
+        self.digest = None
+        self.size = None
+        self.offset = 0
+        self.content_digest = None
+        self.save()
+
+    def save(self):
+        if self.on_save is not None:
+            self.on_save(self)
+
+    def __repr__(self):
+        return "PartialDownload<digest=%r, offset=%r, size=%r>" % (
+            self.digest, self.offset, self.size)
+
+
 # Data transfer objects
 
 BaseRemoteFileInfo = namedtuple('RemoteFileInfo', [
@@ -80,61 +198,198 @@ class RemoteFileSystemClient(BaseAutomationClient):
         content, _ = self._do_get(download_url)
         return content
 
-    def stream_content(self, fs_item_id, file_path):
+    def stream_content(self, fs_item_id, file_path, download=None,
+                       fs_item_info=None):
         """Stream the binary content of a file system item to a tmp file
 
+        The tmp file is kept if the download is interrupted: pass the
+        PartialDownload of the previous attempt as download to resume it.
+        The digest of the content is computed while downloading it, then
+        checked and kept in download.content_digest. fs_item_info, if any,
+        is the RemoteFileInfo of the item already fetched by the caller: it
+        is not fetched again.
+
         Raises NotFound if file system item with id fs_item_id
-        cannot be found
+        cannot be found, CorruptedFile if the digest does not match.
         """
-        fs_item_info = self.get_info(fs_item_id)
+        if fs_item_info is None:
+            fs_item_info = self.get_info(fs_item_id)
         download_url = self.server_url + fs_item_info.download_url
-        file_dir = os.path.dirname(file_path)
-        file_name = os.path.basename(file_path)
-        file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
-                                + DOWNLOAD_TMP_FILE_SUFFIX)
-        _, tmp_file = self._do_get(download_url, file_out=file_out)
-        return tmp_file
+        file_out = get_download_tmp_path(file_path)
+        if download is None:
+            download = PartialDownload()
+        if download.start(file_out, fs_item_info.digest):
+            log.debug("Resuming download of %s from byte %d", file_out,
+                      download.offset)
+        hasher = self._get_hasher(fs_item_info)
+        if download.is_complete():
+            # Only the digest of the content already downloaded is missing
+            self._open_part_file(file_out, download.offset, hasher).close()
+        else:
+            self._do_get(download_url, file_out=file_out, download=download,
+                         hasher=hasher)
+        self._check_digest(file_out, fs_item_info, download, hasher)
+        return file_out
+
+    def _get_hasher(self, fs_item_info):
+        digester = getattr(hashlib, fs_item_info.digest_algorithm or '', None)
+        if fs_item_info.digest is None or digester is None:
+            return None
+        return digester()
+
+    def _check_digest(self, file_path, fs_item_info, download, hasher):
+        if hasher is None:
+            return
+        digest = hasher.hexdigest()
+        if digest != fs_item_info.digest:
+            os.remove(file_path)
+            download.reset()
+            raise CorruptedFile("Digest of %s is %s instead of %s" % (
+                file_path, digest, fs_item_info.digest))
+        download.content_digest = digest
+        download.digest_algorithm = fs_item_info.digest_algorithm
+
+    def _open_part_file(self, file_path, offset, hasher=None):
+        """Open file_path to write the content downloaded from offset
+
+        The content already downloaded, if any, is read back into hasher:
+        only the beginning of a resumed download is read from the disk.
+        """
+        f = open(file_path, "r+b" if offset else "wb")
+        try:
+            if hasher is not None:
+                remaining = offset
+                while remaining > 0:
+                    buffer_ = f.read(min(BUFFER_SIZE, remaining))
+                    if buffer_ == '':
+                        break
+                    hasher.update(buffer_)
+                    remaining -= len(buffer_)
+            f.seek(offset)
+            f.truncate()
+        except:
+            f.close()
+            raise
+        return f
 
     def get_children_info(self, fs_item_id):
         children = self.execute("NuxeoDrive.GetChildren", id=fs_item_id)
         return [self.file_to_info(fs_item) for fs_item in children]
 
     def make_folder(self, parent_id, name):
-        fs_item = self.execute("NuxeoDrive.CreateFolder",
-            parentId=parent_id, name=name)
-        return fs_item['id']
+        return self.create_folder(parent_id, name).uid
+
+    def create_folder(self, parent_id, name):
+        """Create a folder, return its info"""
+        return self.file_to_info(self.execute("NuxeoDrive.CreateFolder",
+            parentId=parent_id, name=name))
 
     def make_file(self, parent_id, name, content):
         """Create a document with the given name and content
 
-        Creates a temporary file from the content then streams it.
+        The content (e.g. an in-memory buffer) is streamed as is.
         """
-        file_path = self.make_tmp_file(content)
-        fs_item = self.execute_with_blob_streaming("NuxeoDrive.CreateFile",
-            file_path, filename=name, parentId=parent_id)
+        fs_item = self.execute_with_body_streaming("NuxeoDrive.CreateFile",
+            content, name, parentId=parent_id)
         return fs_item['id']
 
-    def stream_file(self, parent_id, file_path, filename=None):
-        """Create a document by streaming the file with the given path"""
+    def stream_file(self, parent_id, file_path, filename=None, upload=None):
+        """Create a document by streaming the file with the given path
+
+        upload is the ChunkedUpload to resume, if any. Return the info of
+        the created file.
+        """
         fs_item = self.execute_with_blob_streaming("NuxeoDrive.CreateFile",
-            file_path, filename=filename, parentId=parent_id)
-        return fs_item['id']
+            file_path, filename=filename, upload=upload, parentId=parent_id)
+        return self.file_to_info(fs_item)
+
+    def stream_files(self, parent_id, file_paths, filenames=None,
+                     uploads=None):
+        """Create documents from many small files in the folder parent_id
+
+        The files are imported together by one FileManager.Import operation:
+        sent along with it in a single request if they fit in the inline
+        upload size, else uploaded in a single batch first, one request per
+        file plus one instead of two per file with stream_file. The folder
+        must be backed by a document. uploads, if any, are the ChunkedUpload
+        of the files to hash their content on the way.
+
+        Return the info of the created files, in the order of file_paths:
+        the operation only returns documents, each one is then fetched as a
+        file system item. The info is None for the documents that cannot be
+        fetched, e.g. not adapted by the default factory.
+        """
+        parent = split_fs_item_id(parent_id)
+        if parent is None:
+            raise ValueError("Cannot import files into %s" % parent_id)
+        _, repository, parent_doc_id = parent
+        context = {'currentDocument': parent_doc_id}
+        if filenames is None:
+            filenames = [os.path.basename(p) for p in file_paths]
+        bodies = [FileBody(file_path, hasher=uploads[index].new_hasher()
+                           if uploads is not None else None)
+                  for index, file_path in enumerate(file_paths)]
+        if sum(b.length for b in bodies) <= self.inline_upload_max_size:
+            docs = self.execute_with_blobs(
+                "FileManager.Import", zip(bodies, filenames),
+                context=context)
+        else:
+            batch_id = self._generate_unique_id()
+            for index, body in enumerate(bodies):
+                result = self.upload_body(batch_id, body, filenames[index],
+                                          file_index=index)
+                if result.get('uploaded') != 'true':
+                    raise ValueError(
+                        "Bad response from batch upload with id '%s' for"
+                        " file '%s'" % (batch_id, filenames[index]))
+            docs = self.execute_batch("FileManager.Import", batch_id, None,
+                                      context=context)
+        if uploads is not None:
+            for upload, body in zip(uploads, bodies):
+                upload.content_digest = body.hexdigest()
+        return [self.get_info(u'#'.join((FILE_ITEM_FACTORY, repository,
+                                         doc['uid'])),
+                              raise_if_missing=False)
+                for doc in docs['entries']]
 
     def update_content(self, fs_item_id, content, filename=None):
         """Update a document with the given content
 
-        Creates a temporary file from the content then streams it.
+        The content (e.g. an in-memory buffer) is streamed as is.
         """
-        file_path = self.make_tmp_file(content)
         if filename is None:
             filename = self.get_info(fs_item_id).name
-        self.execute_with_blob_streaming('NuxeoDrive.UpdateFile',
-            file_path, filename=filename, id=fs_item_id)
+        self.execute_with_body_streaming('NuxeoDrive.UpdateFile',
+            content, filename, id=fs_item_id)
 
-    def stream_update(self, fs_item_id, file_path, filename=None):
-        """Update a document by streaming the file with the given path"""
-        self.execute_with_blob_streaming('NuxeoDrive.UpdateFile',
-            file_path, filename=filename, id=fs_item_id)
+    def stream_update(self, fs_item_id, file_path, filename=None,
+                      upload=None):
+        """Update a document by streaming the file with the given path
+
+        upload is the ChunkedUpload to resume, if any. Return the info of
+        the updated file.
+        """
+        fs_item = self.execute_with_blob_streaming('NuxeoDrive.UpdateFile',
+            file_path, filename=filename, upload=upload, id=fs_item_id)
+        return self.file_to_info(fs_item)
+
+    def copy(self, fs_item_id, parent_id, name=None):
+        """Copy a file server side into parent_id, renamed to name if any
+
+        Return the info of the copy, or None if the items are not backed by
+        documents of the same repository: the content has to be uploaded
+        then.
+        """
+        source = split_fs_item_id(fs_item_id)
+        target = split_fs_item_id(parent_id)
+        if source is None or target is None or source[1] != target[1]:
+            return None
+        doc = self.execute("Document.Copy", op_input="doc:" + source[2],
+                           target=target[2])
+        copy_id = u'#'.join((source[0], source[1], doc['uid']))
+        if name is not None:
+            return self.rename(copy_id, name)
+        return self.get_info(copy_id)
 
     def delete(self, fs_item_id):
         self.execute("NuxeoDrive.Delete", id=fs_item_id)
@@ -192,34 +447,66 @@ class RemoteFileSystemClient(BaseAutomationClient):
             download_url, fs_item['canRename'], fs_item['canDelete'],
             can_update, can_create_child)
 
-    def _do_get(self, url, file_out=None):
+    def _do_get(self, url, file_out=None, download=None, hasher=None):
+        """Download url, to file_out if not None
+
+        If download is a PartialDownload with an offset, only the rest of
+        the content is requested and appended to file_out, unless the
+        server does not support range requests. hasher, if any, is updated
+        with the whole content of file_out.
+        """
         if self._error is not None:
             # Simulate a configurable (e.g. network or server) error for the
             # tests
             raise self._error
 
         headers = self._get_common_headers()
+        # Only ask for compressed content when it is worth it
+        headers['Accept-Encoding'] = accept_encoding_for(url)
+        offset = download.offset if download is not None else 0
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            # Ranges of compressed content cannot be appended
+            headers['Accept-Encoding'] = IDENTITY_ENCODING
         base_error_message = (
             "Failed to connect to Nuxeo server %r with user %r"
         ) % (self.server_url, self.user_id)
         try:
             log.trace("Calling '%s' with headers: %r", url, headers)
             req = urllib2.Request(url, headers=headers)
-            response = self.opener.open(req, timeout=self.blob_timeout)
+            response = self._open(req, self.blob_timeout, idempotent=True)
 
             if file_out is not None:
-                with open(file_out, "wb") as f:
+                if download is not None:
+                    offset = download.accept(response)
+                limiter = self.bandwidth_limiter
+                block_size = BUFFER_SIZE
+                if limiter is not None and limiter.is_limited(DOWNLOAD):
+                    block_size = THROTTLED_BLOCK_SIZE
+                with self._open_part_file(file_out, offset, hasher) as f:
                     while True:
-                        buffer_ = response.read(BUFFER_SIZE)
+                        buffer_ = response.read(block_size)
                         if buffer_ == '':
                             break
+                        if limiter is not None:
+                            limiter.throttle(DOWNLOAD, len(buffer_))
+                        if hasher is not None:
+                            hasher.update(buffer_)
                         f.write(buffer_)
                 return None, file_out
             else:
-                return response.read(), None
+                content = response.read()
+                if self.bandwidth_limiter is not None:
+                    self.bandwidth_limiter.throttle(DOWNLOAD, len(content))
+                return content, None
         except urllib2.HTTPError as e:
             if e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
+            elif e.code == 416 and offset:
+                # Range not satisfiable: the file was already complete
+                log.debug("Nothing left to download from %s", url)
+                self._open_part_file(file_out, offset, hasher).close()
+                return None, file_out
             else:
                 e.msg = base_error_message + ": HTTP error %d" % e.code
                 raise e
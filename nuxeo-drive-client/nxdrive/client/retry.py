@@ -0,0 +1,268 @@
+"""Retry policy and circuit breakers for the calls to the Nuxeo servers
+
+Transient network errors on idempotent calls are retried a few times with a
+jittered exponential backoff so that thousands of clients do not retry in
+lockstep. A circuit breaker per server URL stops calling a server that keeps
+failing: calls fail fast until a single probe call is let through after a
+(growing) cool down period.
+
+Overloaded servers answer 429 or 503, possibly with a Retry-After header, or
+suggest a polling delay in the change summary: these slow down signals are
+kept per server URL (Backpressure) for the synchronization loop to adapt its
+pace.
+"""
+import email.utils
+import httplib
+import random
+import socket
+import time
+import urllib2
+from threading import Lock
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Read only Automation operations that can safely be sent again
+IDEMPOTENT_OPERATIONS = frozenset([
+    'Blob.Get',
+    'Document.Fetch',
+    'Document.GetChildren',
+    'Document.GetParent',
+    'Document.GetVersions',
+    'Document.Query',
+    'GetRepositories',
+    'NuxeoDrive.CanMove',
+    'NuxeoDrive.FileSystemItemExists',
+    'NuxeoDrive.GetChangeSummary',
+    'NuxeoDrive.GetChildren',
+    'NuxeoDrive.GetFileSystemItem',
+    'NuxeoDrive.GetRoots',
+    'NuxeoDrive.GetTopLevelChildren',
+    'NuxeoDrive.GetTopLevelFolder',
+])
+
+# HTTP status codes of gateways and proxies failing to reach the server
+TRANSIENT_HTTP_STATUS = frozenset([502, 504])
+
+# HTTP status codes of a server asking its clients to slow down
+OVERLOAD_HTTP_STATUS = frozenset([429, 503])
+
+# Delay in seconds before calling an overloaded server again when it does
+# not specify any Retry-After
+DEFAULT_RETRY_AFTER = 30
+
+# Time in seconds during which the clients keep a reduced pace after the last
+# slow down signal of a server
+SLOW_DOWN_COOL_DOWN = 60
+
+
+class CircuitOpenError(urllib2.URLError):
+    """Call not even attempted since the server is known to be down"""
+
+    def __init__(self, server_url, retry_in):
+        urllib2.URLError.__init__(
+            self, "Circuit open for %s, next attempt in %0.1fs" % (
+                server_url, retry_in))
+        self.server_url = server_url
+        self.retry_in = retry_in
+
+
+class ServerOverloaded(urllib2.HTTPError):
+    """429 or 503 response asking to wait retry_after seconds"""
+
+    def __init__(self, error, retry_after):
+        urllib2.HTTPError.__init__(self, error.filename, error.code,
+                                   error.msg, error.hdrs, error.fp)
+        self.retry_after = retry_after
+
+
+def get_retry_after(error, default=DEFAULT_RETRY_AFTER):
+    """Delay in seconds from the Retry-After header of an HTTP error
+
+    Both the delay-seconds and the HTTP-date forms are supported.
+    """
+    value = error.hdrs.get('Retry-After') if error.hdrs is not None else None
+    if value is None:
+        return default
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return default
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def is_transient_error(error):
+    """Tell whether error is a network or gateway failure"""
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in TRANSIENT_HTTP_STATUS
+    if isinstance(error, CircuitOpenError):
+        return False
+    return isinstance(error, (urllib2.URLError, httplib.HTTPException,
+                              socket.error))
+
+
+class RetryPolicy(object):
+    """Jittered exponential backoff for transient errors
+
+    Uses "full jitter": the delay before the n-th retry is drawn uniformly
+    between 0 and min(max_delay, base_delay * 2 ** n).
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0,
+                 sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+    def get_delay(self, attempt):
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, cap)
+
+    def should_retry(self, error, attempt):
+        return attempt + 1 < self.max_attempts and is_transient_error(error)
+
+
+class Backpressure(object):
+    """Slow down signals received from a server
+
+    retry_after comes from the 429 / 503 responses: the server must not be
+    polled before it is elapsed. suggested_delay is the minimum polling
+    interval the server suggested in its last change summary, if any.
+    """
+
+    def __init__(self, server_url, clock=time.time):
+        self.server_url = server_url
+        self.clock = clock
+        self.suggested_delay = None
+        self._until = 0
+        self._lock = Lock()
+
+    def slow_down(self, retry_after):
+        with self._lock:
+            until = self.clock() + retry_after
+            if until > self._until:
+                log.info("Server %s asked to slow down for %ds",
+                         self.server_url, retry_after)
+                self._until = until
+
+    def suggest_delay(self, delay):
+        self.suggested_delay = delay
+
+    def get_wait(self):
+        """Seconds to wait before calling the server again"""
+        with self._lock:
+            return max(0, self._until - self.clock())
+
+    def is_slowed_down(self):
+        with self._lock:
+            recent = self.clock() < self._until + SLOW_DOWN_COOL_DOWN
+        return recent or bool(self.suggested_delay)
+
+
+class CircuitBreaker(object):
+    """Fail fast when a server keeps failing
+
+    After failure_threshold consecutive failures the circuit opens: calls
+    raise CircuitOpenError without touching the network. Once reset_timeout
+    is elapsed, one probe call is let through: success closes the circuit,
+    failure opens it again for twice as long, up to max_reset_timeout.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, server_url, failure_threshold=5, reset_timeout=30,
+                 max_reset_timeout=300, clock=time.time):
+        self.server_url = server_url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self._failures = 0
+        self._current_timeout = reset_timeout
+        self._opened_at = None
+        self._lock = Lock()
+        self.backpressure = Backpressure(server_url, clock=clock)
+
+    def before_call(self):
+        """Raise CircuitOpenError unless the call can be attempted"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            retry_in = self._opened_at + self._current_timeout - self.clock()
+            if self.state == self.OPEN and retry_in <= 0:
+                log.debug("Probing %s after %0.1fs", self.server_url,
+                          self._current_timeout)
+                self.state = self.HALF_OPEN
+                return
+            # Only one probe at a time
+            raise CircuitOpenError(self.server_url, max(retry_in, 0))
+
+    def on_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log.info("Server %s is back, closing circuit",
+                         self.server_url)
+            self.state = self.CLOSED
+            self._failures = 0
+            self._current_timeout = self.reset_timeout
+
+    def on_failure(self):
+        with self._lock:
+            self._fail()
+
+    def end_call(self):
+        """Resolve a probe that ended without success nor failure
+
+        e.g. on an unexpected error: the circuit opens again rather than
+        waiting forever for the probe to complete.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._fail()
+
+    def _fail(self):
+        self._failures += 1
+        if self.state == self.HALF_OPEN:
+            self._current_timeout = min(self._current_timeout * 2,
+                                        self.max_reset_timeout)
+        elif (self.state == self.CLOSED
+              and self._failures < self.failure_threshold):
+            return
+        # Spread the probes of the clients over time
+        if self.state == self.CLOSED:
+            log.info("Server %s failed %d times in a row, opening"
+                     " circuit for %ds", self.server_url,
+                     self._failures, self._current_timeout)
+        self.state = self.OPEN
+        self._opened_at = self.clock() + random.uniform(
+            0, self._current_timeout * 0.1)
+
+    def is_open(self):
+        with self._lock:
+            return self.state != self.CLOSED
+
+
+class CircuitBreakers(object):
+    """Circuit breakers shared by all the clients, one per server URL"""
+
+    def __init__(self, **options):
+        self.options = options
+        self._breakers = {}
+        self._lock = Lock()
+
+    def get(self, server_url):
+        with self._lock:
+            breaker = self._breakers.get(server_url)
+            if breaker is None:
+                breaker = CircuitBreaker(server_url, **self.options)
+                self._breakers[server_url] = breaker
+            return breaker
@@ -0,0 +1,306 @@
+"""Streaming request bodies for the uploads to the Nuxeo server
+
+A body knows its length up front, for the Content-Length header, and yields
+its content chunk by chunk to the keep alive handlers (see connection_pool):
+files, file-like objects, in-memory buffers and arbitrary iterables are sent
+without any temporary file nor copy of the payload. In-memory buffers are
+sliced with memoryview objects.
+
+Bodies that can be iterated again (replayable) can be sent again on a new
+connection when a reused persistent connection turns out to be broken.
+
+Files are sent with sendfile when pysendfile is installed and the connection
+allows it (plain HTTP without proxy), the kernel then copies the file to the
+socket directly. Otherwise they are read into a single reused buffer.
+"""
+import errno
+import os
+import select
+import socket
+
+from nxdrive.logging_config import get_logger
+
+sendfile = None
+try:
+    # Python 2 has no os.sendfile
+    from sendfile import sendfile
+except ImportError:
+    pass
+
+
+log = get_logger(__name__)
+
+
+# Size of the socket writes of the uploads. Chosen with
+# tools/benchmarks/upload_buffer_size.py: the throughput stops improving
+# past a few hundreds of KB while larger buffers only waste memory.
+UPLOAD_BUFFER_SIZE = 256 * 1024
+
+CRLF = b'\r\n'
+
+
+def _wait_writable(sock):
+    """Wait for a socket with a timeout, hence non-blocking, to be ready"""
+    timeout = sock.gettimeout()
+    _, writable, _ = select.select([], [sock], [], timeout)
+    if not writable:
+        raise socket.timeout("timed out")
+
+
+class Body(object):
+    """Request body of known length sent chunk by chunk
+
+    Subclasses yield str or memoryview chunks. Bodies must not have a read
+    method: httplib would then read them by blocks of 8 KB itself.
+    """
+
+    length = 0
+
+    replayable = True
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        raise NotImplementedError()
+
+    def send_to(self, sock, zero_copy=False):
+        """Write the body to sock
+
+        zero_copy tells whether the data can bypass the socket object (e.g.
+        no TLS layer in between).
+        """
+        for chunk in self:
+            sock.sendall(chunk)
+
+    def getvalue(self):
+        """Return the whole content, e.g. for tests: beware of the size"""
+        return b''.join(c.tobytes() if isinstance(c, memoryview) else c
+                        for c in self)
+
+
+class BufferBody(Body):
+    """Content of an in-memory str, bytearray or memoryview
+
+    Chunks are views over the buffer, no copy is made.
+    """
+
+    def __init__(self, data, chunk_size=UPLOAD_BUFFER_SIZE):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._view = memoryview(data)
+        self.length = len(self._view)
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        view = self._view
+        chunk_size = self.chunk_size
+        for offset in xrange(0, self.length, chunk_size):
+            yield view[offset:offset + chunk_size]
+
+
+class FileBody(Body):
+    """Content of a file given by path or of an open file-like object
+
+    A file path is opened for each iteration only, which makes the body
+    replayable: offset then gives the position of the content in the file,
+    e.g. to upload a chunk of the file. A file-like object is read from its
+    current position: its length is computed with fstat when not given.
+
+    If hasher is a hashlib object, the content is hashed while being sent,
+    instead of using sendfile: once sent, the body hasher is a copy of it
+    updated with the content. Each pass starts from hasher again, as
+    replayable bodies can be sent more than once.
+    """
+
+    def __init__(self, source, length=None, buffer_size=UPLOAD_BUFFER_SIZE,
+                 offset=0, hasher=None):
+        self.buffer_size = buffer_size
+        self.offset = 0
+        self._start_hasher = hasher
+        self.hasher = None
+        if isinstance(source, basestring):
+            self.file_path = source
+            self._file = None
+            self.replayable = True
+            self.offset = offset
+            if length is None:
+                length = os.path.getsize(source) - offset
+        else:
+            self.file_path = getattr(source, 'name', None)
+            self._file = source
+            self.replayable = False
+            if length is None:
+                length = (os.fstat(source.fileno()).st_size
+                          - source.tell())
+        self.length = length
+
+    def __iter__(self):
+        if self._file is not None:
+            return self._read(self._file)
+        return self._read_path()
+
+    def _open(self):
+        f = open(self.file_path, 'rb')
+        if self.offset:
+            f.seek(self.offset)
+        return f
+
+    def _read_path(self):
+        with self._open() as f:
+            for chunk in self._read(f):
+                yield chunk
+
+    def hexdigest(self):
+        """Digest of the content sent, if hashed"""
+        return self.hasher.hexdigest() if self.hasher is not None else None
+
+    def _new_hasher(self):
+        if self._start_hasher is None:
+            return None
+        return self._start_hasher.copy()
+
+    def _read(self, file_object):
+        hasher = self._new_hasher()
+        remaining = self.length
+        while remaining > 0:
+            r = file_object.read(min(self.buffer_size, remaining))
+            if not r:
+                self._raise_truncated(remaining)
+            remaining -= len(r)
+            if hasher is not None:
+                hasher.update(r)
+            yield r
+        self.hasher = hasher
+
+    def send_to(self, sock, zero_copy=False):
+        if self._file is not None:
+            self._send_file(self._file, sock, zero_copy)
+            return
+        with self._open() as f:
+            self._send_file(f, sock, zero_copy)
+
+    def _send_file(self, file_object, sock, zero_copy):
+        if (zero_copy and sendfile is not None and self._start_hasher is None
+            and hasattr(file_object, 'fileno')):
+            self._sendfile(file_object, sock)
+        elif hasattr(file_object, 'readinto'):
+            self._send_buffered(file_object, sock)
+        else:
+            Body.send_to(self, sock)
+
+    def _sendfile(self, file_object, sock):
+        offset = file_object.tell()
+        remaining = self.length
+        while remaining > 0:
+            try:
+                sent = sendfile(sock.fileno(), file_object.fileno(), offset,
+                                min(self.buffer_size, remaining))
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                _wait_writable(sock)
+                continue
+            if not sent:
+                self._raise_truncated(remaining)
+            offset += sent
+            remaining -= sent
+        # Leave file objects where reading them would have left them
+        file_object.seek(offset)
+
+    def _send_buffered(self, file_object, sock):
+        # Reuse the same buffer for the whole file instead of allocating a
+        # new string for each chunk
+        view = memoryview(bytearray(min(self.buffer_size, self.length)))
+        hasher = self._new_hasher()
+        remaining = self.length
+        while remaining > 0:
+            if remaining < len(view):
+                view = view[:remaining]
+            n = file_object.readinto(view)
+            if not n:
+                self._raise_truncated(remaining)
+            if hasher is not None:
+                hasher.update(view[:n])
+            sock.sendall(view[:n])
+            remaining -= n
+        self.hasher = hasher
+
+    def _raise_truncated(self, remaining):
+        raise IOError("File %s is %d bytes shorter than expected" % (
+            self.file_path, remaining))
+
+
+class IterableBody(Body):
+    """Content yielded by any iterable of str chunks
+
+    The iterable can only be consumed once. The announced length is checked
+    as sending more or less data would corrupt the HTTP exchange.
+    """
+
+    replayable = False
+
+    def __init__(self, iterable, length):
+        self._iterable = iterable
+        self.length = length
+
+    def __iter__(self):
+        sent = 0
+        for chunk in self._iterable:
+            sent += len(chunk)
+            if sent > self.length:
+                raise IOError("Body is longer than %d bytes" % self.length)
+            yield chunk
+        if sent != self.length:
+            raise IOError("Body is %d bytes long instead of %d" % (
+                sent, self.length))
+
+
+class MultipartBody(Body):
+    """MIME multipart body streaming the content of its parts
+
+    parts is a list of (headers, body) pairs, headers being a list of
+    (name, value) pairs. Only the part headers and boundaries are built in
+    memory.
+    """
+
+    def __init__(self, boundary, parts):
+        self.boundary = boundary
+        self._chunks = []
+        delimiter = b'--' + boundary
+        for headers, body in parts:
+            preamble = [delimiter]
+            preamble.extend(b'%s: %s' % (name, value)
+                            for name, value in headers)
+            preamble.extend([b'', b''])
+            self._chunks.append(BufferBody(CRLF.join(preamble)))
+            self._chunks.append(to_body(body))
+            self._chunks.append(BufferBody(CRLF))
+        self._chunks.append(BufferBody(delimiter + b'--'))
+        self.length = sum(len(c) for c in self._chunks)
+        self.replayable = all(c.replayable for c in self._chunks)
+
+    def __iter__(self):
+        for body in self._chunks:
+            for chunk in body:
+                yield chunk
+
+    def send_to(self, sock, zero_copy=False):
+        for body in self._chunks:
+            body.send_to(sock, zero_copy=zero_copy)
+
+
+def to_body(source, length=None):
+    """Return a Body for an in-memory buffer, file-like object or iterable
+
+    The length is required for iterables. Use FileBody for file paths.
+    """
+    if isinstance(source, Body):
+        return source
+    if isinstance(source, (basestring, bytearray, memoryview)):
+        return BufferBody(source)
+    if hasattr(source, 'read'):
+        return FileBody(source, length=length)
+    if length is None:
+        raise ValueError("The length of an iterable body is required")
+    return IterableBody(source, length)
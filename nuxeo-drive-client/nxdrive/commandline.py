@@ -28,6 +28,8 @@ DEFAULT_DELAY = 5.0
 DEFAULT_MAX_SYNC_STEP = 10
 DEFAULT_HANDSHAKE_TIMEOUT = 60
 DEFAULT_TIMEOUT = 20
+DEFAULT_MAX_IDLE_CONNECTIONS = 4
+DEFAULT_TRANSFER_WORKERS = 4
 USAGE = """ndrive [command]
 
 If no command is provided, the graphical application is started along with a
@@ -41,6 +43,7 @@ Possible commands:
 - unbind-server
 - bind-root
 - unbind-root
+- set-bandwidth
 
 To get options for a specific command:
 
@@ -91,12 +94,21 @@ def make_cli_parser(add_subparsers=True):
         "--max-sync-step", default=DEFAULT_MAX_SYNC_STEP, type=int,
         help="Number of consecutive sync operations to perform"
         " without refreshing the internal state DB.")
+    common_parser.add_argument(
+        "--transfer-workers", default=DEFAULT_TRANSFER_WORKERS, type=int,
+        help="Number of file contents transferred concurrently, 0 to"
+        " transfer them one at a time.")
     common_parser.add_argument(
         "--handshake-timeout", default=DEFAULT_HANDSHAKE_TIMEOUT, type=int,
         help="HTTP request timeout in seconds for the handshake.")
     common_parser.add_argument(
         "--timeout", default=DEFAULT_TIMEOUT, type=int,
         help="HTTP request timeout in seconds for the sync Automation calls.")
+    common_parser.add_argument(
+        "--max-idle-connections", default=DEFAULT_MAX_IDLE_CONNECTIONS,
+        type=int,
+        help="Maximum number of idle HTTP connections kept alive per server"
+        " for reuse by the next requests.")
     common_parser.add_argument(
         # XXX: Make it true by default as the fault tolerant mode is not yet
         # implemented
@@ -189,6 +201,29 @@ def make_cli_parser(add_subparsers=True):
     unbind_root_parser.add_argument(
         "local_root", help="Local sub-folder to de-synchronize.")
 
+    # Limit the bandwidth of the transfers of a server binding
+    set_bandwidth_parser = subparsers.add_parser(
+        'set-bandwidth',
+        help='Limit the bandwidth used to transfer files with a server.',
+        parents=[common_parser],
+    )
+    set_bandwidth_parser.set_defaults(command='set_bandwidth')
+    set_bandwidth_parser.add_argument(
+        "--local-folder",
+        help="Local folder bound to the Nuxeo server.",
+        default=DEFAULT_NX_DRIVE_FOLDER,
+    )
+    for option, direction in (("upload", "uploads"),
+                              ("download", "downloads")):
+        set_bandwidth_parser.add_argument(
+            "--" + option, type=int,
+            help="Maximum throughput of the %s in KB/s during business"
+            " hours, no limit if not set." % direction)
+        set_bandwidth_parser.add_argument(
+            "--off-hours-" + option, type=int,
+            help="Maximum throughput of the %s in KB/s outside business"
+            " hours, no limit if not set." % direction)
+
     # Start / Stop the synchronization daemon
     start_parser = subparsers.add_parser(
         'start', help='Start the synchronization as a GUI-less daemon',
@@ -308,7 +343,9 @@ class CliHandler(object):
         if command != 'test':
             self.controller = Controller(options.nxdrive_home,
                                 handshake_timeout=options.handshake_timeout,
-                                timeout=options.timeout)
+                                timeout=options.timeout,
+                                max_idle_connections=(
+                                    options.max_idle_connections))
 
         # Find the command to execute based on the
         handler = getattr(self, command, None)
@@ -354,20 +391,25 @@ class CliHandler(object):
 
         self.controller = Controller(options.nxdrive_home,
                             handshake_timeout=options.handshake_timeout,
-                            timeout=options.timeout)
+                            timeout=options.timeout,
+                            max_idle_connections=options.max_idle_connections)
         self._configure_logger(options)
         self.log.debug("Synchronization daemon started.")
         self.controller.synchronizer.loop(
             delay=getattr(options, 'delay', DEFAULT_DELAY),
             max_sync_step=getattr(options, 'max_sync_step',
-                                  DEFAULT_MAX_SYNC_STEP))
+                                  DEFAULT_MAX_SYNC_STEP),
+            transfer_workers=getattr(options, 'transfer_workers',
+                                     DEFAULT_TRANSFER_WORKERS))
         return 0
 
     def console(self, options):
         self.controller.synchronizer.loop(
             delay=getattr(options, 'delay', DEFAULT_DELAY),
             max_sync_step=getattr(options, 'max_sync_step',
-                                  DEFAULT_MAX_SYNC_STEP))
+                                  DEFAULT_MAX_SYNC_STEP),
+            transfer_workers=getattr(options, 'transfer_workers',
+                                     DEFAULT_TRANSFER_WORKERS))
         return 0
 
     def stop(self, options=None):
@@ -410,6 +452,13 @@ class CliHandler(object):
         self.controller.unbind_root(options.local_root)
         return 0
 
+    def set_bandwidth(self, options):
+        limits = [None if limit is None else limit * 1024 for limit in (
+            options.upload, options.download, options.off_hours_upload,
+            options.off_hours_download)]
+        self.controller.set_bandwidth_limits(options.local_folder, *limits)
+        return 0
+
     def test(self, options):
         import nose
         # Monkeypatch nose usage message as it's complicated to include
@@ -436,6 +485,12 @@ class CliHandler(object):
         # List the test modules explicitly as recursive discovery is broken
         # when the app is frozen.
         argv += [
+            "nxdrive.tests.test_bandwidth",
+            "nxdrive.tests.test_change_feed",
+            "nxdrive.tests.test_compression",
+            "nxdrive.tests.test_connection_pool",
+            "nxdrive.tests.test_downloads",
+            "nxdrive.tests.test_fake_synchronization",
             "nxdrive.tests.test_integration_concurrent_synchronization",
             "nxdrive.tests.test_integration_copy",
             "nxdrive.tests.test_integration_encoding",
@@ -449,7 +504,14 @@ class CliHandler(object):
             "nxdrive.tests.test_integration_synchronization",
             "nxdrive.tests.test_integration_versioning",
             "nxdrive.tests.test_integration_windows",
+            "nxdrive.tests.test_json_codec",
+            "nxdrive.tests.test_logging_config",
+            "nxdrive.tests.test_operation_registry",
+            "nxdrive.tests.test_remote_document_client",
+            "nxdrive.tests.test_retry",
+            "nxdrive.tests.test_streaming",
             "nxdrive.tests.test_synchronizer",
+            "nxdrive.tests.test_transfer",
         ]
         return 0 if nose.run(argv=argv) else 1
 
@@ -20,11 +20,18 @@ from nxdrive.client import Unauthorized
 from nxdrive.client import LocalClient
 from nxdrive.client import RemoteFileSystemClient
 from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.bandwidth import BandwidthLimiters
+from nxdrive.client.bandwidth import BandwidthLimits
 from nxdrive.client.base_automation_client import get_proxies_for_handler
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.connection_pool import DEFAULT_MAX_IDLE_PER_HOST
+from nxdrive.client.retry import CircuitBreakers
+from nxdrive.client.operation_registry import OperationRegistryCache
 from nxdrive.client import NotFound
 from nxdrive.model import init_db
 from nxdrive.model import DeviceConfig
 from nxdrive.model import ServerBinding
+from nxdrive.model import BandwidthLimit
 from nxdrive.model import LastKnownState
 from nxdrive.synchronizer import Synchronizer
 from nxdrive.synchronizer import POSSIBLE_NETWORK_ERROR_TYPES
@@ -121,7 +128,8 @@ class Controller(object):
     remote_fs_client_factory = RemoteFileSystemClient
 
     def __init__(self, config_folder, echo=None, poolclass=None,
-                 handshake_timeout=60, timeout=20, page_size=None):
+                 handshake_timeout=60, timeout=20, page_size=None,
+                 max_idle_connections=DEFAULT_MAX_IDLE_PER_HOST):
         # Log the installation location for debug
         nxdrive_install_folder = os.path.dirname(nxdrive.__file__)
         nxdrive_install_folder = os.path.realpath(nxdrive_install_folder)
@@ -166,6 +174,23 @@ class Controller(object):
         # share cookies using threadsafe jar
         self.cookie_jar = CookieJar()
 
+        # Make all the automation client related to this controller reuse the
+        # same persistent HTTP connections
+        self.connection_pool = ConnectionPool(
+            max_idle_per_host=max_idle_connections)
+
+        # Share the operation registries between the automation clients of
+        # all threads and persist them across restarts
+        self.registry_cache = OperationRegistryCache(
+            os.path.join(self.config_folder, 'operations'))
+
+        # Stop calling the servers that are down from all the threads
+        self.circuit_breakers = CircuitBreakers()
+
+        # Keep the transfers of all the threads within the bandwidth limits
+        # of each binding
+        self.bandwidth_limiters = BandwidthLimiters()
+
     def get_session(self):
         """Reuse the thread local session for this controller
 
@@ -429,7 +454,8 @@ class Controller(object):
         nxclient = self.remote_doc_client_factory(
             server_url, username, self.device_id, self.version,
             proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
-            password=password, timeout=self.handshake_timeout)
+            password=password, timeout=self.handshake_timeout,
+            connection_pool=self.connection_pool)
         token = nxclient.request_token()
         if token is not None:
             # The server supports token based identification: do not store the
@@ -525,6 +551,7 @@ class Controller(object):
                  local_folder, binding.server_url, binding.remote_user)
         session.delete(binding)
         session.commit()
+        self.bandwidth_limiters.discard(local_folder)
 
     def unbind_all(self):
         """Unbind all server and revoke all tokens
@@ -613,6 +640,47 @@ class Controller(object):
                                     session=session)
         return pending[0] if len(pending) > 0 else None
 
+    def set_bandwidth_limits(self, local_folder, upload=None, download=None,
+                             off_hours_upload=None, off_hours_download=None,
+                             session=None):
+        """Limit the bandwidth of the transfers of a binding
+
+        Limits are in bytes per second, None meaning no limit. The off hours
+        limits apply outside the business hours. The running transfers
+        follow the new limits right away.
+        """
+        session = self.get_session() if session is None else session
+        local_folder = normalized_path(local_folder)
+        server_binding = self.get_server_binding(
+            local_folder, raise_if_missing=True, session=session)
+        limit = server_binding.bandwidth_limit
+        if limit is None:
+            limit = BandwidthLimit(local_folder)
+            session.add(limit)
+        limit.upload = upload
+        limit.download = download
+        limit.off_hours_upload = off_hours_upload
+        limit.off_hours_download = off_hours_download
+        session.commit()
+        log.info("Bandwidth limits of '%s' set to %r", local_folder, limit)
+        self.bandwidth_limiters.set_limits(
+            local_folder, self._get_bandwidth_limits(server_binding))
+
+    def get_bandwidth_limiter(self, server_binding):
+        """Return the limiter shared by the transfers of a binding"""
+        return self.bandwidth_limiters.get(
+            server_binding.local_folder,
+            lambda: self._get_bandwidth_limits(server_binding))
+
+    def _get_bandwidth_limits(self, server_binding):
+        limit = server_binding.bandwidth_limit
+        if limit is None:
+            return BandwidthLimits()
+        return BandwidthLimits(
+            upload=limit.upload, download=limit.download,
+            off_hours_upload=limit.off_hours_upload,
+            off_hours_download=limit.off_hours_download)
+
     def _get_client_cache(self):
         if not hasattr(self._local, 'remote_clients'):
             self._local.remote_clients = dict()
@@ -622,7 +690,9 @@ class Controller(object):
         """Return a client for the FileSystem abstraction."""
         cache = self._get_client_cache()
         sb = server_binding
-        cache_key = (sb.server_url, sb.remote_user, self.device_id)
+        # Each binding has its own bandwidth limiter
+        cache_key = (sb.server_url, sb.remote_user, self.device_id,
+                     sb.local_folder)
         remote_client_cache = cache.get(cache_key)
         if remote_client_cache is not None:
             remote_client = remote_client_cache[0]
@@ -635,7 +705,11 @@ class Controller(object):
                 self.version,
                 proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
                 password=sb.remote_password, token=sb.remote_token,
-                timeout=self.timeout, cookie_jar=self.cookie_jar)
+                timeout=self.timeout, cookie_jar=self.cookie_jar,
+                connection_pool=self.connection_pool,
+                registry_cache=self.registry_cache,
+                circuit_breakers=self.circuit_breakers,
+                bandwidth_limiter=self.get_bandwidth_limiter(sb))
             if client_cache_timestamp is None:
                 client_cache_timestamp = 0
                 self._client_cache_timestamps[cache_key] = 0
@@ -656,7 +730,10 @@ class Controller(object):
             proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
             password=sb.remote_password, token=sb.remote_token,
             repository=repository, base_folder=base_folder,
-            timeout=self.timeout, cookie_jar=self.cookie_jar)
+            timeout=self.timeout, cookie_jar=self.cookie_jar,
+            connection_pool=self.connection_pool,
+            registry_cache=self.registry_cache,
+            circuit_breakers=self.circuit_breakers)
 
     def invalidate_client_cache(self, server_url=None):
         for key in self._client_cache_timestamps:
@@ -725,6 +802,7 @@ class Controller(object):
         """Release all database resources"""
         self.get_session().close_all()
         self._engine.pool.dispose()
+        self.connection_pool.clear()
 
     def _normalize_url(self, url):
         """Ensure that user provided url always has a trailing '/'"""
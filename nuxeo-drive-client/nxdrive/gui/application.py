@@ -25,6 +25,15 @@ except ImportError:
     pass
 
 
+def format_size(n_bytes):
+    """Human readable size, e.g. for the transfer rates"""
+    for unit in ('B', 'KB', 'MB'):
+        if n_bytes < 1024:
+            return "%d %s" % (n_bytes, unit)
+        n_bytes /= 1024.0
+    return "%d GB" % n_bytes
+
+
 class Communicator(QObject):
     """Handle communication between sync and main GUI thread
 
@@ -46,6 +55,10 @@ class BindingInfo(object):
     n_pending = -1
     has_more_pending = False
 
+    # Transfer rates in bytes per second
+    upload_rate = 0
+    download_rate = 0
+
     def __init__(self, server_binding, repository='default'):
         self.folder_path = server_binding.local_folder
         self.short_name = os.path.basename(server_binding.local_folder)
@@ -65,8 +78,9 @@ class BindingInfo(object):
         # TODO: i18n
         if self.online:
             if self.n_pending > 0:
-                return "%d%s pending operations..." % (
-                    self.n_pending, '+' if self.has_more_pending else '')
+                return "%d%s pending operations...%s" % (
+                    self.n_pending, '+' if self.has_more_pending else '',
+                    self.get_throughput_message())
             elif self.n_pending == 0:
                 return "Folder up to date"
             else:
@@ -74,6 +88,12 @@ class BindingInfo(object):
         else:
             return "Offline"
 
+    def get_throughput_message(self):
+        if not self.upload_rate and not self.download_rate:
+            return ''
+        return " (up %s/s, down %s/s)" % (format_size(self.upload_rate),
+                                          format_size(self.download_rate))
+
     def __str__(self):
         return "%s: %s" % (self.short_name, self.get_status_message())
 
@@ -287,6 +307,14 @@ class Application(QApplication):
                 self.update_running_icon()
                 self.communicator.menu.emit()
 
+    def notify_throughput(self, server_binding, upload_rate, download_rate):
+        info = self.get_binding_info(server_binding)
+        if (upload_rate, download_rate) != (info.upload_rate,
+                                            info.download_rate):
+            info.upload_rate = upload_rate
+            info.download_rate = download_rate
+            self.communicator.menu.emit()
+
     def _setup_systray(self):
         self._tray_icon = QtGui.QSystemTrayIcon()
         self._tray_icon.setToolTip('Nuxeo Drive')
@@ -497,11 +525,13 @@ class Application(QApplication):
         if self.sync_thread is None or not self.sync_thread.isAlive():
             delay = getattr(self.options, 'delay', 5.0)
             max_sync_step = getattr(self.options, 'max_sync_step', 10)
+            transfer_workers = getattr(self.options, 'transfer_workers', 4)
             # Controller and its database session pool should be thread safe,
             # hence reuse it directly
             self.controller.synchronizer.register_frontend(self)
             self.controller.synchronizer.delay = delay
             self.controller.synchronizer.max_sync_step = max_sync_step
+            self.controller.synchronizer.transfer_workers = transfer_workers
 
             self.sync_thread = Thread(target=sync_loop,
                                       args=(self.controller,))
@@ -67,6 +67,52 @@ def configure(log_filename, file_level='INFO', console_level='INFO',
 
 def get_logger(name):
     logger = logging.getLogger(name)
-    trace = lambda *args, **kwargs: logger.log(TRACE, *args, **kwargs)
+
+    def trace(msg, *args, **kwargs):
+        if logger.isEnabledFor(TRACE):
+            logger._log(TRACE, msg, args, **kwargs)
+
     setattr(logger, 'trace', trace)
     return logger
+
+
+class lazy(object):
+    """Log message argument only computed if the message is emitted
+
+    Logging calls only format their message when the level is enabled but
+    their arguments are always evaluated: wrap the expensive ones, e.g.
+    log.trace("Cookies: %r", lazy(list, cookie_jar)).
+
+    The value is computed once even if the message is formatted by several
+    handlers.
+    """
+
+    __slots__ = ('func', 'args', '_value')
+
+    _unset = object()
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self._value = self._unset
+
+    def get_value(self):
+        if self._value is self._unset:
+            self._value = self.func(*self.args)
+        return self._value
+
+    def __str__(self):
+        value = self.get_value()
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def __unicode__(self):
+        return unicode(self.get_value())
+
+    def __repr__(self):
+        return repr(self.get_value())
+
+
+def format_date(date, date_format='%Y-%m-%d %H:%M:%S'):
+    return date.strftime(date_format) if date is not None else 'None'
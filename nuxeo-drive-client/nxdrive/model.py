@@ -22,6 +22,8 @@ from nxdrive import __version__
 from nxdrive.client import LocalClient
 from nxdrive.utils import normalized_path
 from nxdrive.logging_config import get_logger
+from nxdrive.logging_config import format_date
+from nxdrive.logging_config import lazy
 from sqlalchemy.types import Binary
 
 WindowsError = None
@@ -140,6 +142,36 @@ class ServerBinding(Base):
         return self.remote_password is None and self.remote_token is None
 
 
+class BandwidthLimit(Base):
+    """Bandwidth limits of the transfers of a server binding
+
+    Limits are in bytes per second, NULL meaning no limit. The off hours
+    limits apply outside the business hours (see client.bandwidth).
+    """
+    __tablename__ = 'bandwidth_limits'
+
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'),
+                          primary_key=True)
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref('bandwidth_limit', uselist=False,
+                        cascade='all, delete-orphan'))
+
+    upload = Column(Integer)
+    download = Column(Integer)
+    off_hours_upload = Column(Integer)
+    off_hours_download = Column(Integer)
+
+    def __init__(self, local_folder):
+        self.local_folder = local_folder
+
+    def __repr__(self):
+        return ("BandwidthLimit<local_folder=%r, upload=%r, download=%r,"
+                " off_hours_upload=%r, off_hours_download=%r>" % (
+                    self.local_folder, self.upload, self.download,
+                    self.off_hours_upload, self.off_hours_download))
+
+
 class LastKnownState(Base):
     """Aggregate state aggregated from last collected events."""
     __tablename__ = 'last_known_states'
@@ -391,11 +423,8 @@ class LastKnownState(Base):
         # Use last known modification time to detect updates
         log.trace("Use last known modification time to detect updates:"
                   " local DB, server = %r, %r",
-                  (self.last_remote_updated.strftime('%Y-%m-%d %H:%M:%S')
-                   if self.last_remote_updated else 'None'),
-                  (remote_info.last_modification_time.strftime(
-                                                    '%Y-%m-%d %H:%M:%S')
-                  if remote_info.last_modification_time else 'None'))
+                  lazy(format_date, self.last_remote_updated),
+                  lazy(format_date, remote_info.last_modification_time))
         if self.last_remote_updated is None:
             self.last_remote_updated = remote_info.last_modification_time
             log.trace("last_remote_updated is None for doc %s, set it to %s",
@@ -449,6 +478,63 @@ class LastKnownState(Base):
         return os.path.join(self.local_folder, relative_path)
 
 
+class UploadState(Base):
+    """Progress of the chunked upload of the content of a pair
+
+    Persisted after each chunk so that an interrupted upload resumes from
+    the last chunk acknowledged by the server, as long as the local digest
+    of the pair did not change in the meantime.
+    """
+    __tablename__ = 'upload_states'
+
+    pair_id = Column(Integer, ForeignKey('last_known_states.id'),
+                     primary_key=True)
+    pair = relationship(
+        'LastKnownState',
+        backref=backref('upload_state', uselist=False,
+                        cascade='all, delete-orphan'))
+
+    local_digest = Column(String)
+    batch_id = Column(String)
+    file_size = Column(Integer)
+    chunk_size = Column(Integer)
+    uploaded_chunks = Column(Integer, default=0)
+
+    def __init__(self, pair_id, local_digest=None):
+        self.pair_id = pair_id
+        self.local_digest = local_digest
+
+    def __repr__(self):
+        return ("UploadState<pair_id=%r, batch_id=%r, uploaded_chunks=%r>"
+                % (self.pair_id, self.batch_id, self.uploaded_chunks))
+
+
+class DownloadState(Base):
+    """Expected content of the .part file of a pair being downloaded
+
+    An interrupted download resumes from the end of the .part file as long
+    as the remote digest is still the expected one.
+    """
+    __tablename__ = 'download_states'
+
+    pair_id = Column(Integer, ForeignKey('last_known_states.id'),
+                     primary_key=True)
+    pair = relationship(
+        'LastKnownState',
+        backref=backref('download_state', uselist=False,
+                        cascade='all, delete-orphan'))
+
+    remote_digest = Column(String)
+    file_size = Column(Integer)
+
+    def __init__(self, pair_id):
+        self.pair_id = pair_id
+
+    def __repr__(self):
+        return ("DownloadState<pair_id=%r, remote_digest=%r, file_size=%r>"
+                % (self.pair_id, self.remote_digest, self.file_size))
+
+
 class FileEvent(Base):
     __tablename__ = 'fileevents'
 
@@ -4,6 +4,9 @@ import os.path
 from time import time
 from time import sleep
 from datetime import datetime
+from functools import partial
+from Queue import Empty
+from Queue import Queue
 import urllib2
 import socket
 import httplib
@@ -15,9 +18,24 @@ from nxdrive.client import DEDUPED_BASENAME_PATTERN
 from nxdrive.client import safe_filename
 from nxdrive.client import NotFound
 from nxdrive.client import Unauthorized
+from nxdrive.client.bandwidth import DOWNLOAD
+from nxdrive.client.bandwidth import UPLOAD
+from nxdrive.client.base_automation_client import ChunkedUpload
+from nxdrive.client.local_copy import LocalCopy
+from nxdrive.client.remote_file_system_client import PartialDownload
+from nxdrive.client.remote_file_system_client import split_fs_item_id
+from nxdrive.client.retry import CircuitOpenError
+from nxdrive.client.retry import ServerOverloaded
+from nxdrive.client.retry import is_transient_error
+from nxdrive.change_feed import ChangeFeed
+from nxdrive.model import DownloadState
 from nxdrive.model import ServerBinding
 from nxdrive.model import LastKnownState
+from nxdrive.model import UploadState
 from nxdrive.logging_config import get_logger
+from nxdrive.logging_config import lazy
+from nxdrive.transfer import Transfer
+from nxdrive.transfer import TransferEngine
 from nxdrive.utils import safe_long_path
 
 WindowsError = None
@@ -34,6 +52,10 @@ POSSIBLE_NETWORK_ERROR_TYPES = (
     socket.error,
 )
 
+# Key of the optional polling delay in seconds suggested by the server in the
+# change summary
+SUGGESTED_DELAY_KEY = 'suggestedDelay'
+
 UNEXPECTED_HTTP_STATUS = (
     500,
     403
@@ -44,11 +66,10 @@ log = get_logger(__name__)
 
 def _log_offline(exception, context):
     if isinstance(exception, urllib2.HTTPError):
-        msg = ("Client offline in %s: HTTP error with code %d"
-                % (context, exception.code))
+        log.trace("Client offline in %s: HTTP error with code %d",
+                  context, exception.code)
     else:
-        msg = "Client offline in %s: %s" % (context, exception)
-    log.trace(msg)
+        log.trace("Client offline in %s: %s", context, exception)
 
 
 def name_match(local_name, remote_name):
@@ -150,11 +171,15 @@ class Synchronizer(object):
     """Handle synchronization operations between the client FS and Nuxeo"""
 
     # Default delay in seconds that ensures that two consecutive scans
-    # won't happen too closely from one another.
-    # TODO: make this a value returned by the server so that it can tell the
-    # client to slow down when the server cannot keep up with the load
+    # won't happen too closely from one another. The servers can ask for a
+    # longer delay when they cannot keep up with the load (see
+    # _get_polling_delay)
     delay = 5
 
+    # Divide the number of consecutive sync operations and of concurrent
+    # transfers by this factor for the servers asking to slow down
+    slow_down_factor = 4
+
     # Default number of consecutive sync operations to perform
     # without refreshing the internal state DB.
     max_sync_step = 10
@@ -171,11 +196,41 @@ class Synchronizer(object):
     # Default page size for deleted items detection query in DB
     default_page_size = 100
 
+    # Number of threads transferring file contents concurrently, 0 to
+    # transfer them one at a time in the synchronization thread
+    transfer_workers = 0
+
+    # Maximum time in seconds to wait for a transfer to complete before
+    # checking the pending pairs again
+    transfer_poll_timeout = 1
+
+    # Minimum time in seconds between two reports of the transfer rates to
+    # the frontend
+    throughput_notification_period = 1
+
+    # Locally created files up to this size in bytes are uploaded together
+    # with the other small files pending creation in the same folder, up to
+    # bulk_upload_max_files at once (see RemoteFileSystemClient.stream_files)
+    bulk_upload_max_size = 256 * 1024
+    bulk_upload_max_files = 100
+
     def __init__(self, controller, page_size=None):
         self._controller = controller
         self._frontend = None
+        self._last_throughput_notification = 0
+        # Bytes copied from identical local files instead of being
+        # downloaded, by local folder
+        self.bytes_saved = {}
+        # Pairs created remotely along with the pair of a bulk creation,
+        # not counted yet as synchronized
+        self._bulk_followers = 0
         self.page_size = (page_size if page_size is not None
                           else self.default_page_size)
+        self._change_feed = ChangeFeed(self.get_remote_fs_client)
+        self._transfers = TransferEngine(self.transfer_workers)
+        # Progress of the transfers to be saved by the synchronization
+        # thread, see _save_transfer_states
+        self._transfer_states = Queue()
 
     def register_frontend(self, frontend):
         self._frontend = frontend
@@ -239,6 +294,37 @@ class Synchronizer(object):
 
         doc_pair.refresh_local(client=client, local_path=updated_path)
 
+    def _move_descendant_states(self, session, client, doc_pair,
+        updated_path):
+        """Re-parent the descendant states of a locally moved folder
+
+        The states created by the local scan for the new location are
+        discarded in favor of the previous states that hold the remote info.
+        """
+        local_children = session.query(LastKnownState).filter_by(
+            local_folder=doc_pair.local_folder,
+            local_parent_path=doc_pair.local_path).all()
+        for child in local_children:
+            child_path = updated_path + '/' + child.local_name
+            duplicates = session.query(LastKnownState).filter_by(
+                local_folder=doc_pair.local_folder,
+                local_path=child_path,
+                remote_ref=None).all()
+            for duplicate in duplicates:
+                if duplicate.id != child.id:
+                    self._delete_with_descendant_states(session, duplicate)
+            self._move_descendant_states(session, client, child, child_path)
+            local_info = child.refresh_local(client=client,
+                                             local_path=child_path)
+            if local_info is not None and child.local_state == 'deleted':
+                # The local scan has marked the state as deleted from its
+                # previous location
+                if (child.folderish
+                    or child.local_digest == child.remote_digest):
+                    child.update_state(local_state='synchronized')
+                else:
+                    child.update_state(local_state='modified')
+
     def _update_remote_parent_path_recursive(self, session, doc_pair,
         updated_path):
         """Update the remote parent path of the descendants of a moved doc"""
@@ -250,7 +336,7 @@ class Synchronizer(object):
             local_folder=doc_pair.local_folder,
             remote_parent_ref=doc_pair.remote_ref).all()
         for child in local_children:
-            child_path = updated_path + '/' + child.remote_ref
+            child_path = updated_path + '/' + doc_pair.remote_ref
             self._update_remote_parent_path_recursive(session, child,
                 child_path)
 
@@ -593,14 +679,50 @@ class Synchronizer(object):
         if doc_pair.remote_digest != doc_pair.local_digest:
             log.debug("Updating remote document '%s'.",
                       doc_pair.remote_name)
-            remote_client.stream_update(
+            upload = self._get_chunked_upload(doc_pair, session,
+                                              local_client, remote_client)
+            self._transfer(doc_pair, partial(
+                remote_client.stream_update,
                 doc_pair.remote_ref,
                 doc_pair.get_local_abspath(),
                 filename=doc_pair.remote_name,
-            )
-            doc_pair.refresh_remote(remote_client)
+                upload=upload,
+            ), partial(self._locally_modified_transferred, local_client,
+                       upload, doc_pair.remote_digest))
+            return
         doc_pair.update_state('synchronized', 'synchronized')
 
+    def _locally_modified_transferred(self, local_client, upload,
+                                      remote_digest, doc_pair, transfer):
+        remote_info = transfer.get_result()
+        self._clear_chunked_upload(doc_pair)
+        if doc_pair.remote_digest != remote_digest:
+            # A later scan found the remote document updated while it was
+            # being uploaded: let the next refresh compare both sides
+            log.debug("%r was remotely updated while being uploaded",
+                      doc_pair)
+            doc_pair.update_state('modified', 'modified')
+            return
+        doc_pair.update_remote(remote_info)
+        if self._is_uploaded_content(doc_pair, local_client, upload):
+            doc_pair.update_state('synchronized', 'synchronized')
+
+    def _is_uploaded_content(self, doc_pair, local_client, upload):
+        """Tell whether the file was uploaded as it was when last scanned
+
+        Otherwise it changed in the meantime, possibly while being
+        uploaded: its digest is computed again and the pair is marked as
+        locally modified to upload the new content.
+        """
+        if (upload.content_digest is None
+            or upload.content_digest == doc_pair.local_digest):
+            return True
+        log.debug("%r changed while being uploaded", doc_pair)
+        doc_pair.local_digest = None
+        doc_pair.refresh_local(local_client)
+        doc_pair.update_state('modified', 'synchronized')
+        return False
+
     def _synchronize_remotely_modified(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         try:
@@ -608,13 +730,16 @@ class Synchronizer(object):
                 log.debug("Updating content of local file '%s'.",
                           doc_pair.get_local_abspath())
                 os_path = local_client.get_info(doc_pair.local_path).filepath
-                tmp_file = remote_client.stream_content(
-                                            doc_pair.remote_ref, os_path)
-                # Delete original file and rename tmp file
-                local_client.delete(doc_pair.local_path)
-                local_client.rename(local_client.get_path(tmp_file),
-                                    doc_pair.local_name)
-                doc_pair.refresh_local(local_client)
+                download = self._get_partial_download(doc_pair, session)
+                local_copy = self._get_local_copy(doc_pair, session,
+                                                  local_client, remote_info)
+                self._transfer(doc_pair, partial(
+                    self._get_content, remote_client, remote_info, os_path,
+                    download, local_copy=local_copy),
+                    partial(self._remotely_modified_transferred,
+                            local_client, download, local_copy,
+                            self._get_queued_state(doc_pair)))
+                return
             else:
                 # digest agree so this might be a renaming and/or a move,
                 # and no need to transfer additional bytes over the network
@@ -657,6 +782,31 @@ class Synchronizer(object):
                 "content %r due to concurrent file access.",
                 doc_pair)
 
+    def _remotely_modified_transferred(self, local_client, download,
+                                       local_copy, queued_state, doc_pair,
+                                       transfer):
+        try:
+            tmp_file = transfer.get_result()
+            if not self._is_downloaded_content(doc_pair, local_client,
+                                               download, queued_state,
+                                               tmp_file):
+                doc_pair.update_state(remote_state='modified')
+                return
+            # Delete original file and rename tmp file
+            local_client.delete(doc_pair.local_path)
+            local_client.rename(local_client.get_path(tmp_file),
+                                doc_pair.local_name)
+            self._clear_partial_download(doc_pair)
+            doc_pair.update_local(self._get_downloaded_info(
+                local_client, doc_pair.local_path, download,
+                raise_if_missing=False))
+            doc_pair.update_state('synchronized', 'synchronized')
+            self._count_bytes_saved(doc_pair, local_copy)
+        except (IOError, WindowsError):
+            log.debug("Delaying update for remotely modified "
+                "content %r due to concurrent file access.",
+                doc_pair)
+
     def _is_remote_move(self, doc_pair, session):
         local_parent_pair = session.query(LastKnownState).filter_by(
             local_folder=doc_pair.local_folder,
@@ -696,13 +846,32 @@ class Synchronizer(object):
             if doc_pair.folderish:
                 log.debug("Creating remote folder '%s' in folder '%s'",
                           name, parent_pair.remote_name)
-                remote_ref = remote_client.make_folder(parent_ref, name)
+                remote_info = remote_client.create_folder(parent_ref, name)
             else:
+                copy_info = self._copy_remote_duplicate(
+                    doc_pair, session, remote_client, parent_ref, name)
+                if copy_info is not None:
+                    doc_pair.update_remote(copy_info)
+                    doc_pair.update_state('synchronized', 'synchronized')
+                    return
+                bulk_pairs = self._get_bulk_creations(doc_pair, session,
+                                                      parent_ref)
+                if bulk_pairs:
+                    self._create_in_bulk(bulk_pairs, local_client,
+                                         remote_client, parent_pair)
+                    return
                 log.debug("Creating remote document '%s' in folder '%s'",
                           name, parent_pair.remote_name)
-                remote_ref = remote_client.stream_file(
-                    parent_ref, doc_pair.get_local_abspath(), filename=name)
-            doc_pair.update_remote(remote_client.get_info(remote_ref))
+                upload = self._get_chunked_upload(doc_pair, session,
+                                                  local_client, remote_client)
+                self._transfer(doc_pair, partial(
+                    remote_client.stream_file, parent_ref,
+                    doc_pair.get_local_abspath(), filename=name,
+                    upload=upload),
+                    partial(self._locally_created_transferred,
+                            local_client, upload))
+                return
+            doc_pair.update_remote(remote_info)
             doc_pair.update_state('synchronized', 'synchronized')
         else:
             child_type = 'folder' if doc_pair.folderish else 'file'
@@ -716,6 +885,215 @@ class Synchronizer(object):
             # in the UI
             doc_pair.update_state('synchronized', 'synchronized')
 
+    def _copy_remote_duplicate(self, doc_pair, session, remote_client,
+                               parent_ref, name):
+        """Copy server side a synchronized file with the content of doc_pair
+
+        Return the info of the copy, or None if there is no such file in
+        the same binding or it cannot be copied: the content has to be
+        uploaded then.
+        """
+        if doc_pair.local_digest is None:
+            return None
+        source_pair = session.query(LastKnownState).filter(
+            LastKnownState.local_folder == doc_pair.local_folder,
+            LastKnownState.remote_digest == doc_pair.local_digest,
+            LastKnownState.pair_state == 'synchronized',
+            LastKnownState.folderish == False,
+            LastKnownState.remote_ref != None,
+            LastKnownState.id != doc_pair.id,
+        ).first()
+        if source_pair is None:
+            return None
+        new_name = name if name != source_pair.remote_name else None
+        try:
+            copy_info = remote_client.copy(source_pair.remote_ref,
+                                           parent_ref, name=new_name)
+        except NotFound:
+            copy_info = None
+        except urllib2.HTTPError as e:
+            if e.code not in (403, 404):
+                raise
+            log.debug("Could not copy remote %r: %s", source_pair, e)
+            copy_info = None
+        if copy_info is None:
+            return None
+        if copy_info.digest != doc_pair.local_digest:
+            # The remote file changed since it was last synchronized
+            log.debug("Deleting the copy of %r: its content changed",
+                      source_pair)
+            remote_client.delete(copy_info.uid)
+            return None
+        log.debug("Copied remote document '%s' to folder '%s' instead of"
+                  " uploading '%s'", source_pair.remote_name, parent_ref,
+                  doc_pair.get_local_abspath())
+        return copy_info
+
+    def _get_bulk_creations(self, doc_pair, session, parent_ref):
+        """Small files to create remotely together with doc_pair
+
+        Return doc_pair followed by the other small files pending creation
+        in the same folder, or an empty list if there are none: doc_pair is
+        then uploaded on its own. The files matching a deleted pair (local
+        move) or a synchronized remote file (remote copy) are left to be
+        handled one by one.
+        """
+        if (self.bulk_upload_max_files < 2
+            or split_fs_item_id(parent_ref) is None
+            or not self._is_small_file(doc_pair)):
+            return []
+        candidates = session.query(LastKnownState).filter(
+            LastKnownState.local_folder == doc_pair.local_folder,
+            LastKnownState.local_parent_path == doc_pair.local_parent_path,
+            # The creation might not have been detected yet (see
+            # synchronize_one)
+            LastKnownState.local_state.in_(('created', 'unknown')),
+            LastKnownState.folderish == False,
+            LastKnownState.remote_ref == None,
+            LastKnownState.local_digest != None,
+            LastKnownState.last_sync_error_date == None,
+            LastKnownState.id != doc_pair.id,
+        ).limit(self.bulk_upload_max_files - 1).all()
+        if not candidates:
+            return []
+        digests = set(p.local_digest for p in candidates)
+        known_digests = set(digest for digest, in session.query(
+            LastKnownState.local_digest).filter(
+                LastKnownState.local_folder == doc_pair.local_folder,
+                LastKnownState.local_state == 'deleted',
+                LastKnownState.local_digest.in_(digests)))
+        known_digests.update(digest for digest, in session.query(
+            LastKnownState.remote_digest).filter(
+                LastKnownState.local_folder == doc_pair.local_folder,
+                LastKnownState.pair_state == 'synchronized',
+                LastKnownState.remote_digest.in_(digests)))
+        pairs = [p for p in candidates
+                 if p.local_digest not in known_digests
+                 and not self._transfers.is_busy(self._get_transfer_keys(p))
+                 and self._is_small_file(p)]
+        if not pairs:
+            return []
+        return [doc_pair] + pairs
+
+    def _is_small_file(self, doc_pair):
+        try:
+            return (os.path.getsize(doc_pair.get_local_abspath())
+                    <= self.bulk_upload_max_size)
+        except OSError:
+            return False
+
+    def _create_in_bulk(self, doc_pairs, local_client, remote_client,
+                        parent_pair):
+        """Create the remote documents of many small files at once
+
+        The transfer is the one of the first pair, its keys covering all
+        the pairs.
+        """
+        log.debug("Creating %d remote documents in folder '%s'",
+                  len(doc_pairs), parent_pair.remote_name)
+        uploads = [ChunkedUpload(digest_algorithm=local_client.digest_func)
+                   for _ in doc_pairs]
+        keys = set()
+        for doc_pair in doc_pairs:
+            keys.update(self._get_transfer_keys(doc_pair))
+        names = [p.local_name for p in doc_pairs]
+        self._transfer(doc_pairs[0], partial(
+            remote_client.stream_files, parent_pair.remote_ref,
+            [p.get_local_abspath() for p in doc_pairs], filenames=names,
+            uploads=uploads),
+            partial(self._created_in_bulk_transferred, local_client,
+                    [p.id for p in doc_pairs], uploads),
+            keys=keys)
+
+    def _created_in_bulk_transferred(self, local_client, pair_ids, uploads,
+                                     doc_pair, transfer):
+        """Map the created remote documents back to their pairs
+
+        The pairs are updated in the transaction of the transfer. The pairs
+        of the documents that could not be fetched once created are
+        blacklisted instead of being uploaded again: the next remote scan
+        binds them to their document by name.
+        """
+        remote_infos = transfer.get_result()
+        session = self.get_session()
+        for pair_id, upload, remote_info in zip(pair_ids, uploads,
+                                                remote_infos):
+            pair = session.query(LastKnownState).get(pair_id)
+            if pair is None:
+                log.debug("Pair %d was deleted while being created", pair_id)
+                continue
+            if remote_info is None:
+                log.warning("Could not fetch the remote document created for"
+                            " %r", pair)
+                pair.last_sync_error_date = datetime.utcnow()
+                continue
+            if pair is not doc_pair:
+                self._bulk_followers += 1
+            pair.update_remote(remote_info)
+            if self._is_uploaded_content(pair, local_client, upload):
+                pair.update_state('synchronized', 'synchronized')
+
+    def _locally_created_transferred(self, local_client, upload, doc_pair,
+                                     transfer):
+        remote_info = transfer.get_result()
+        self._clear_chunked_upload(doc_pair)
+        doc_pair.update_remote(remote_info)
+        if self._is_uploaded_content(doc_pair, local_client, upload):
+            doc_pair.update_state('synchronized', 'synchronized')
+
+    def _get_chunked_upload(self, doc_pair, session, local_client,
+                            remote_client):
+        """Progress of the upload of doc_pair, resumed if interrupted
+
+        The progress is reported by the transfer itself after each chunk,
+        to be saved by the synchronization thread. The content is hashed
+        with the local digest function while being uploaded.
+        """
+        upload = ChunkedUpload(
+            chunk_size=remote_client.upload_chunk_size,
+            on_save=partial(self._save_chunked_upload, doc_pair.id,
+                            doc_pair.local_digest),
+            digest_algorithm=local_client.digest_func)
+        state = session.query(UploadState).get(doc_pair.id)
+        if state is None:
+            return upload
+        if (state.local_digest != doc_pair.local_digest
+            or state.chunk_size != upload.chunk_size):
+            log.debug("Discarding %r: the file changed since", state)
+            session.delete(state)
+            session.commit()
+            return upload
+        log.debug("Resuming %r", state)
+        upload.batch_id = state.batch_id
+        upload.file_size = state.file_size
+        upload.uploaded_chunks = state.uploaded_chunks
+        return upload
+
+    def _save_chunked_upload(self, pair_id, local_digest, upload):
+        # Called in the thread of the transfer: only snapshot the progress
+        self._transfer_states.put(partial(
+            self._save_upload_state, pair_id, local_digest, upload.batch_id,
+            upload.file_size, upload.chunk_size, upload.uploaded_chunks))
+
+    def _save_upload_state(self, pair_id, local_digest, batch_id, file_size,
+                           chunk_size, uploaded_chunks, session):
+        state = session.query(UploadState).get(pair_id)
+        if batch_id is None:
+            if state is not None:
+                session.delete(state)
+            return
+        if state is None:
+            state = UploadState(pair_id, local_digest)
+            session.add(state)
+        state.batch_id = batch_id
+        state.file_size = file_size
+        state.chunk_size = chunk_size
+        state.uploaded_chunks = uploaded_chunks
+
+    def _clear_chunked_upload(self, doc_pair):
+        self.get_session().query(UploadState).filter_by(
+            pair_id=doc_pair.id).delete()
+
     def _synchronize_remotely_created(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         name = remote_info.name
@@ -746,21 +1124,220 @@ class Synchronizer(object):
             self._scan_remote_recursive(session, remote_client, doc_pair,
                                         remote_info, force_recursion=False)
         else:
-            path, os_path, name = local_client.get_new_file(local_parent_path,
-                                                            name)
-            log.debug("Creating local file '%s' in '%s'", name,
+            _, os_path, deduped_name = local_client.get_new_file(
+                local_parent_path, name)
+            log.debug("Creating local file '%s' in '%s'", deduped_name,
                       parent_pair.get_local_abspath())
-            tmp_file = remote_client.stream_content(
-                                            doc_pair.remote_ref, os_path)
-            # Rename tmp file
-            local_client.rename(local_client.get_path(tmp_file), name)
+            download = self._get_partial_download(doc_pair, session)
+            local_copy = self._get_local_copy(doc_pair, session,
+                                              local_client, remote_info)
+            self._transfer(doc_pair, partial(
+                self._get_content, remote_client, remote_info, os_path,
+                download, local_copy=local_copy),
+                partial(self._remotely_created_transferred, local_client,
+                        local_parent_path, name, download, local_copy,
+                        self._get_queued_state(doc_pair)))
+            return
         doc_pair.update_local(local_client.get_info(path))
         doc_pair.update_state('synchronized', 'synchronized')
 
+    def _remotely_created_transferred(self, local_client, local_parent_path,
+                                      name, download, local_copy,
+                                      queued_state, doc_pair, transfer):
+        tmp_file = transfer.get_result()
+        if not self._is_downloaded_content(doc_pair, local_client, download,
+                                           queued_state, tmp_file):
+            doc_pair.update_state(remote_state='created')
+            return
+        # Deduplicate the name again: another file with the same name might
+        # have been created in the meantime
+        path, _, name = local_client.get_new_file(local_parent_path, name)
+        # Rename tmp file
+        local_client.rename(local_client.get_path(tmp_file), name)
+        self._clear_partial_download(doc_pair)
+        doc_pair.update_local(self._get_downloaded_info(local_client, path,
+                                                        download))
+        doc_pair.update_state('synchronized', 'synchronized')
+        self._count_bytes_saved(doc_pair, local_copy)
+
+    def _get_queued_state(self, doc_pair):
+        """State of doc_pair to be checked once its download is completed"""
+        return (doc_pair.local_state, doc_pair.local_digest,
+                doc_pair.remote_digest)
+
+    def _is_downloaded_content(self, doc_pair, local_client, download,
+                               queued_state, tmp_file):
+        """Tell whether the pair is unchanged since its download was queued
+
+        Otherwise the remote document was updated again, as found by a later
+        scan, or the local file was changed while the content was being
+        downloaded: the tmp file is dropped, leaving the pair remotely
+        modified, or conflicted in case of a local change.
+        """
+        local_state, local_digest, remote_digest = queued_state
+        if doc_pair.local_path is not None:
+            doc_pair.refresh_local(local_client)
+        digest = download.content_digest or remote_digest
+        if (doc_pair.local_state == local_state
+            and doc_pair.local_digest == local_digest
+            and doc_pair.remote_digest == digest):
+            return True
+        log.debug("%r changed while being downloaded", doc_pair)
+        os.remove(tmp_file)
+        self._clear_partial_download(doc_pair)
+        return False
+
+    def _get_local_copy(self, doc_pair, session, local_client, remote_info):
+        """Synchronized local file with the content of doc_pair, if any
+
+        The synchronized file pairs are looked up by local digest (indexed),
+        which has to be computed with the digest function of the remote
+        file.
+        """
+        if (doc_pair.remote_digest is None or remote_info is None
+            or (remote_info.digest_algorithm or '').lower()
+                != local_client.digest_func.lower()):
+            return None
+        source_pair = session.query(LastKnownState).filter(
+            LastKnownState.local_digest == doc_pair.remote_digest,
+            LastKnownState.pair_state == 'synchronized',
+            LastKnownState.folderish == False,
+            LastKnownState.local_path != None,
+            LastKnownState.id != doc_pair.id,
+        ).first()
+        if source_pair is None:
+            return None
+        log.debug("Content of %r available locally in %r", doc_pair,
+                  source_pair)
+        return LocalCopy(source_pair.get_local_abspath(),
+                         doc_pair.remote_digest, local_client.digest_func)
+
+    def _get_content(self, remote_client, remote_info, os_path, download,
+                     local_copy=None):
+        """Write the content of remote_info to the tmp file of os_path
+
+        The content is copied from local_copy if still valid, downloaded
+        otherwise, reusing remote_info for the download URL. Return the tmp
+        file.
+        """
+        if local_copy is not None:
+            tmp_file = local_copy.materialize(os_path)
+            if tmp_file is not None:
+                download.content_digest = local_copy.digest
+                download.digest_algorithm = local_copy.digest_func
+                return tmp_file
+        return remote_client.stream_content(remote_info.uid, os_path,
+                                            download=download,
+                                            fs_item_info=remote_info)
+
+    def _count_bytes_saved(self, doc_pair, local_copy):
+        if local_copy is None or local_copy.size is None:
+            return
+        self.bytes_saved[doc_pair.local_folder] = (
+            self.bytes_saved.get(doc_pair.local_folder, 0) + local_copy.size)
+
+    def _get_downloaded_info(self, local_client, path, download,
+                             raise_if_missing=True):
+        """Local info of a downloaded file
+
+        The digest computed while downloading the file is reused instead of
+        reading the file again.
+        """
+        info = local_client.get_info(path, raise_if_missing=raise_if_missing)
+        if info is not None and download.content_digest is not None:
+            info.set_digest(download.content_digest, download.digest_algorithm)
+        return info
+
+    def _get_partial_download(self, doc_pair, session):
+        """Progress of the download of doc_pair, resumed if interrupted
+
+        The expected digest and size are reported by the transfer itself,
+        to be saved by the synchronization thread.
+        """
+        download = PartialDownload(on_save=partial(
+            self._save_partial_download, doc_pair.id))
+        state = session.query(DownloadState).get(doc_pair.id)
+        if state is not None:
+            download.digest = state.remote_digest
+            download.size = state.file_size
+        return download
+
+    def _save_partial_download(self, pair_id, download):
+        # Called in the thread of the transfer: only snapshot the progress
+        self._transfer_states.put(partial(
+            self._save_download_state, pair_id, download.digest,
+            download.size))
+
+    def _save_download_state(self, pair_id, remote_digest, file_size,
+                             session):
+        state = session.query(DownloadState).get(pair_id)
+        if remote_digest is None:
+            if state is not None:
+                session.delete(state)
+            return
+        if state is None:
+            state = DownloadState(pair_id)
+            session.add(state)
+        state.remote_digest = remote_digest
+        state.file_size = file_size
+
+    def _save_transfer_states(self, session):
+        """Save the progress reported by the transfers since the last call
+
+        The transfer workers do not write to the database themselves: SQLite
+        would fail with concurrent writers. This must be called before
+        finishing a transfer, whose state would be overwritten otherwise.
+        """
+        saved = False
+        while True:
+            try:
+                save = self._transfer_states.get_nowait()
+            except Empty:
+                break
+            save(session)
+            saved = True
+        if saved:
+            session.commit()
+
+    def _clear_partial_download(self, doc_pair):
+        self.get_session().query(DownloadState).filter_by(
+            pair_id=doc_pair.id).delete()
+
+    def _transfer(self, doc_pair, work, finish, keys=None):
+        """Transfer the content of doc_pair, then finish its synchronization
+
+        With transfer workers, work is run concurrently and finish is called
+        by synchronize once the transfer is completed. Otherwise both are
+        called right away.
+        """
+        if keys is None:
+            keys = self._get_transfer_keys(doc_pair)
+        transfer = Transfer(doc_pair.id, work, finish, keys=keys)
+        if not self._transfers.submit(transfer):
+            self._save_transfer_states(self.get_session())
+            finish(doc_pair, transfer)
+
+    def _get_transfer_keys(self, doc_pair):
+        """Resources not to be touched by two transfers at the same time
+
+        Besides the pair itself, two documents with the same name in the
+        same folder would be downloaded to the same temporary file.
+        """
+        keys = [('pair', doc_pair.id)]
+        if doc_pair.remote_name is not None:
+            keys.append(('remote', doc_pair.local_folder,
+                         doc_pair.remote_parent_ref,
+                         doc_pair.remote_name.lower()))
+        if doc_pair.local_path is not None:
+            keys.append(('local', doc_pair.local_folder,
+                         doc_pair.local_path.lower()))
+        return keys
+
     def _synchronize_locally_deleted(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         if self._detect_resolve_local_move(doc_pair, session,
-            local_client, remote_client, local_info):
+            local_client, remote_client, local_info,
+            remote_info=remote_info):
             return
         if doc_pair.remote_ref is not None:
             if remote_info.can_delete:
@@ -806,8 +1383,8 @@ class Synchronizer(object):
     def _synchronize_deleted(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         # No need to store this information any further
-        log.debug('Deleting doc pair %s deleted on both sides' %
-                  doc_pair.get_local_abspath())
+        log.debug('Deleting doc pair %s deleted on both sides',
+                  lazy(doc_pair.get_local_abspath))
         self._delete_with_descendant_states(session, doc_pair)
 
     def _synchronize_conflicted(self, doc_pair, session,
@@ -905,12 +1482,13 @@ class Synchronizer(object):
         return source_doc_pair, target_doc_pair
 
     def _detect_resolve_local_move(self, doc_pair, session,
-        local_client, remote_client, local_info):
+        local_client, remote_client, local_info, remote_info=None):
         """Handle local move / renaming if doc_pair is detected as involved
 
         Detection is based on digest for files and content for folders.
         Resolution perform the matching remote action and update the local
-        state DB.
+        state DB. remote_info, if any, is the remote info of doc_pair just
+        refreshed: it is not fetched again if doc_pair is the source.
 
         If the doc_pair is not detected as being involved in a rename
         / move operation
@@ -929,8 +1507,9 @@ class Synchronizer(object):
         moved_or_renamed = False
         remote_ref = source_doc_pair.remote_ref
 
-        remote_info = remote_client.get_info(remote_ref,
-                                             raise_if_missing=False)
+        if source_doc_pair is not doc_pair or remote_info is None:
+            remote_info = remote_client.get_info(remote_ref,
+                                                 raise_if_missing=False)
         # check that the target still exists
         if remote_info is None:
             # Nothing to do: the regular deleted / created handling will
@@ -988,18 +1567,22 @@ class Synchronizer(object):
         if moved_or_renamed:
             target_doc_pair.update_state('synchronized', 'synchronized')
             if doc_pair.folderish:
-                # Delete the old local tree info that is now deprecated
-                self._delete_with_descendant_states(
-                    session, source_doc_pair, keep_root=False)
-
-                # Rescan the remote folder descendants to let them realign
-                # with the local files
-                # TODO: optimize me by updating the local DB and reuse the
-                # previous state info instead?
-                remote_folder_info = remote_client.get_info(
-                    target_doc_pair.remote_ref)
+                # Reuse the previous state info of the descendants instead of
+                # rescanning the whole remote tree: their remote refs are left
+                # unchanged by the move / renaming of their ancestor
+                self._move_descendant_states(session, local_client,
+                    source_doc_pair, target_doc_pair.local_path)
+                if (target_doc_pair.remote_parent_ref
+                    != source_doc_pair.remote_parent_ref):
+                    self._update_remote_parent_path_recursive(session,
+                        target_doc_pair, target_doc_pair.remote_parent_path)
+                session.delete(source_doc_pair)
+
+                # Lightweight verification of the direct children only to
+                # detect any concurrent remote change: recursion only happens
+                # on newly created remote children
                 self._scan_remote_recursive(session, remote_client,
-                    target_doc_pair, remote_folder_info)
+                    target_doc_pair, remote_info, force_recursion=False)
             else:
                 session.delete(source_doc_pair)
             session.commit()
@@ -1007,13 +1590,27 @@ class Synchronizer(object):
         return moved_or_renamed
 
     def synchronize(self, server_binding=None, limit=None):
-        """Synchronize one file at a time from the pending list."""
+        """Synchronize the pending pairs
+
+        Pairs are processed one at a time, but for the transfer of their
+        content which can run concurrently with the next pairs (see
+        transfer_workers): the number of pairs synchronized includes the
+        transfers completed in the meantime.
+        """
         local_folder = (server_binding.local_folder
                         if server_binding is not None else None)
         synchronized = 0
         session = self.get_session()
+        transfers = self._transfers
+        max_transfers = self._get_max_transfers(server_binding)
 
         while (limit is None or synchronized < limit):
+            self._notify_throughput(server_binding)
+            synchronized += self._finish_transfers(session)
+            synchronized += self._pop_bulk_followers()
+            if transfers.is_full(max_running=max_transfers):
+                synchronized += self._finish_transfers(session, block=True)
+                continue
 
             pending = self._controller.list_pending(
                 local_folder=local_folder,
@@ -1025,7 +1622,16 @@ class Synchronizer(object):
                 self._frontend.notify_pending(
                     server_binding, len(pending), or_more=or_more)
 
+            # Pairs being transferred are not processed twice
+            if transfers.count_running():
+                pending = [p for p in pending if not transfers.is_busy(
+                    self._get_transfer_keys(p))]
+
             if len(pending) == 0:
+                if transfers.count_running():
+                    synchronized += self._finish_transfers(session,
+                                                           block=True)
+                    continue
                 break
 
             # Look first for a pending pair state with local_path not None,
@@ -1044,32 +1650,99 @@ class Synchronizer(object):
                 pending_iterator = 0
             pair_state = pending[pending_iterator]
 
-            try:
-                self.synchronize_one(pair_state, session=session)
+            if (self._synchronize_step(pair_state, session, partial(
+                    self.synchronize_one, pair_state, session=session))
+                and not transfers.is_busy([('pair', pair_state.id)])):
                 synchronized += 1
-            except POSSIBLE_NETWORK_ERROR_TYPES as e:
-                if getattr(e, 'code', None) in UNEXPECTED_HTTP_STATUS:
-                    # This is an unexpected: blacklist doc_pair for
-                    # a cooldown period
-                    log.error("Failed to sync %r, blacklisting doc pair "
-                              "for %d seconds",
-                        pair_state, self.error_skip_period, exc_info=True)
-                    pair_state.last_sync_error_date = datetime.utcnow()
-                    session.commit()
-                else:
-                    # This is expected and should interrupt the sync process
-                    # for this local_folder and should be dealt with
-                    # in the main loop
-                    raise e
-            except Exception as e:
-                # Unexpected exception: blacklist for a cooldown period
+
+        self._notify_throughput(server_binding, force=True)
+        return synchronized + self._pop_bulk_followers()
+
+    def _pop_bulk_followers(self):
+        """Number of pairs synchronized along with others since last call"""
+        n, self._bulk_followers = self._bulk_followers, 0
+        return n
+
+    def _synchronize_step(self, doc_pair, session, step):
+        """Call step, blacklisting doc_pair on unexpected errors
+
+        Return True if step succeeded. Expected network errors are raised to
+        interrupt the synchronization of the local folder.
+        """
+        try:
+            step()
+            return True
+        except POSSIBLE_NETWORK_ERROR_TYPES as e:
+            if getattr(e, 'code', None) in UNEXPECTED_HTTP_STATUS:
+                # This is an unexpected: blacklist doc_pair for
+                # a cooldown period
                 log.error("Failed to sync %r, blacklisting doc pair "
                           "for %d seconds",
-                    pair_state, self.error_skip_period, exc_info=True)
-                pair_state.last_sync_error_date = datetime.utcnow()
+                    doc_pair, self.error_skip_period, exc_info=True)
+                doc_pair.last_sync_error_date = datetime.utcnow()
                 session.commit()
+            else:
+                # This is expected and should interrupt the sync process
+                # for this local_folder and should be dealt with
+                # in the main loop
+                raise e
+        except Exception as e:
+            # Unexpected exception: blacklist for a cooldown period
+            log.error("Failed to sync %r, blacklisting doc pair "
+                      "for %d seconds",
+                doc_pair, self.error_skip_period, exc_info=True)
+            doc_pair.last_sync_error_date = datetime.utcnow()
+            session.commit()
+        return False
 
-        return synchronized
+    def _finish_transfers(self, session, block=False):
+        """Apply the state transitions of the completed transfers
+
+        Return the number of pairs synchronized. Network errors are raised
+        once all the completed transfers have been handled.
+        """
+        completed = self._transfers.get_completed(
+            block=block, timeout=self.transfer_poll_timeout)
+        self._save_transfer_states(session)
+        finished = 0
+        error = None
+        for transfer in completed:
+            doc_pair = session.query(LastKnownState).get(transfer.pair_id)
+            if doc_pair is None:
+                log.debug("Ignoring %r of a deleted pair", transfer)
+                continue
+            log.trace("Finishing %r for %r", transfer, doc_pair)
+            try:
+                if self._synchronize_step(doc_pair, session, partial(
+                        transfer.finish, doc_pair, transfer)):
+                    finished += 1
+            except POSSIBLE_NETWORK_ERROR_TYPES as e:
+                error = error or e
+            if len(session.dirty) != 0 or len(session.deleted) != 0:
+                session.commit()
+        if error is not None:
+            raise error
+        return finished
+
+    def _stop_transfers(self, session):
+        """Wait for the running transfers and finish them"""
+        while self._transfers.count_running():
+            try:
+                self._finish_transfers(session, block=True)
+            except POSSIBLE_NETWORK_ERROR_TYPES as e:
+                _log_offline(e, "transfers")
+        self._transfers.stop()
+
+    def _abort_transfers(self):
+        """Stop the workers, keeping the progress of their transfers"""
+        self._transfers.stop()
+        session = self.get_session()
+        try:
+            self._save_transfer_states(session)
+        except Exception:
+            log.warning("Could not save the progress of the transfers",
+                        exc_info=True)
+            session.rollback()
 
     def _get_sync_pid_filepath(self, process_name="sync"):
         return os.path.join(self._controller.config_folder,
@@ -1124,10 +1797,13 @@ class Synchronizer(object):
             return True
         return False
 
-    def loop(self, max_loops=None, delay=None, max_sync_step=None):
+    def loop(self, max_loops=None, delay=None, max_sync_step=None,
+             transfer_workers=None):
         """Forever loop to scan / refresh states and perform sync"""
 
         delay = delay if delay is not None else self.delay
+        if transfer_workers is not None:
+            self.transfer_workers = transfer_workers
 
         if self._frontend is not None:
             self._frontend.notify_sync_started()
@@ -1146,6 +1822,7 @@ class Synchronizer(object):
 
         log.info("Starting synchronization (pid=%d)", pid)
         self.continue_synchronization = True
+        self._transfers = TransferEngine(self.transfer_workers)
 
         previous_time = time()
         session = self.get_session()
@@ -1165,18 +1842,38 @@ class Synchronizer(object):
                 if self._frontend is not None:
                     self._frontend.notify_local_folders(bindings)
 
-                for sb in bindings:
-                    if not sb.has_invalid_credentials():
+                # Poll the change summary only once for all the bindings of
+                # the same user on the same server
+                self._change_feed.start_cycle(
+                    [sb for sb in bindings
+                     if not sb.has_invalid_credentials()])
+                try:
+                    for sb in bindings:
+                        if sb.has_invalid_credentials():
+                            continue
+                        backpressure = self.get_backpressure(sb)
+                        wait = backpressure.get_wait()
+                        if wait > 0:
+                            log.trace("Not polling %s for another %ds as"
+                                      " requested by the server",
+                                      sb.server_url, wait)
+                            continue
                         n_synchronized += self.update_synchronize_server(
-                            sb, session=session, max_sync_step=max_sync_step)
+                            sb, session=session,
+                            max_sync_step=self._get_max_sync_step(
+                                backpressure, max_sync_step))
+                finally:
+                    self._change_feed.end_cycle()
 
                 # safety net to ensure that Nuxeo Drive won't eat all the CPU,
                 # disk and network resources of the machine scanning over an
                 # over the bound folders too often.
                 current_time = time()
                 spent = current_time - previous_time
-                sleep_time = delay - spent
-                if sleep_time > 0 and n_synchronized == 0:
+                polling_delay, slowed_down = self._get_polling_delay(
+                    bindings, delay)
+                sleep_time = polling_delay - spent
+                if sleep_time > 0 and (n_synchronized == 0 or slowed_down):
                     log.debug("Sleeping %0.3fs", sleep_time)
                     sleep(sleep_time)
                 previous_time = time()
@@ -1187,12 +1884,17 @@ class Synchronizer(object):
                 # has updated the connection credentials for a server binding.
                 session.commit()
 
+            self._stop_transfers(session)
         except KeyboardInterrupt:
             self.get_session().rollback()
             log.info("Interrupted synchronization on user's request.")
         except:
             self.get_session().rollback()
             raise
+        finally:
+            # Never leave the workers of this loop behind, whatever the
+            # error: the next loop starts its own
+            self._abort_transfers()
 
         # Clean pid file
         pid_filepath = self._get_sync_pid_filepath()
@@ -1207,14 +1909,47 @@ class Synchronizer(object):
         if self._frontend is not None:
             self._frontend.notify_sync_stopped()
 
+    def get_backpressure(self, server_binding):
+        """Slow down signals of the server of a binding"""
+        return self._controller.circuit_breakers.get(
+            server_binding.server_url).backpressure
+
+    def _get_max_sync_step(self, backpressure, max_sync_step):
+        max_sync_step = (max_sync_step if max_sync_step is not None
+                         else self.max_sync_step)
+        if backpressure.is_slowed_down():
+            return max(1, max_sync_step // self.slow_down_factor)
+        return max_sync_step
+
+    def _get_max_transfers(self, server_binding):
+        """Number of transfers to run at once for a binding, None if all"""
+        if (server_binding is None or not self.get_backpressure(
+                server_binding).is_slowed_down()):
+            return None
+        return max(1, self._transfers.n_workers // self.slow_down_factor)
+
+    def _get_polling_delay(self, bindings, delay):
+        """Delay between two loops and whether a server asked to slow down
+
+        The delay is the longest of the default one and of the delays
+        suggested by the servers in their change summaries.
+        """
+        slowed_down = False
+        for sb in bindings:
+            backpressure = self.get_backpressure(sb)
+            if backpressure.is_slowed_down():
+                slowed_down = True
+            if backpressure.suggested_delay:
+                delay = max(delay, backpressure.suggested_delay)
+        return delay, slowed_down
+
     def _get_remote_changes(self, server_binding, session=None):
         """Fetch incremental change summary from the server"""
         session = self.get_session() if session is None else session
-        remote_client = self.get_remote_fs_client(server_binding)
-
-        summary = remote_client.get_changes(
-            last_sync_date=server_binding.last_sync_date,
-            last_root_definitions=server_binding.last_root_definitions)
+        summary = self._change_feed.get_changes(server_binding)
+        # Optional polling delay in seconds suggested by the server
+        self.get_backpressure(server_binding).suggest_delay(
+            summary.get(SUGGESTED_DELAY_KEY))
 
         root_definitions = summary['activeSynchronizationRootDefinitions']
         sync_date = summary['syncDate']
@@ -1378,19 +2113,38 @@ class Synchronizer(object):
             # pending tasks
             n_pending = self._notify_pending(server_binding)
 
+            bytes_saved = self.bytes_saved.get(server_binding.local_folder, 0)
             n_synchronized = self.synchronize(limit=max_sync_step,
                 server_binding=server_binding)
             synchronization_duration = time() - tick
+            bytes_saved = self.bytes_saved.get(
+                server_binding.local_folder, 0) - bytes_saved
             log.debug("[%s] - [%s]: synchronized: %d, pending: %d, "
+                      "copied locally: %d bytes, "
                       "local: %0.3fs, remote: %0.3fs sync: %0.3fs",
                       server_binding.local_folder,
                       server_binding.server_url,
-                      n_synchronized, n_pending,
+                      n_synchronized, n_pending, bytes_saved,
                       local_refresh_duration,
                       remote_refresh_duration,
                       synchronization_duration)
             return n_synchronized
 
+        except ServerOverloaded as e:
+            # The server is up but asked to slow down: the binding is not
+            # polled again before the end of the requested delay
+            log.debug("Server %s is overloaded, retrying in %ds",
+                      server_binding.server_url, e.retry_after)
+            if not local_scan_is_done:
+                self.scan_local(server_binding, session=session)
+            return 0
+        except CircuitOpenError as e:
+            # The server is known to be down: do not even scan the local
+            # folders until the next probe
+            _log_offline(e, "synchronization loop")
+            if self._frontend is not None:
+                self._frontend.notify_offline(server_binding, e)
+            return 0
         except POSSIBLE_NETWORK_ERROR_TYPES as e:
             # Do not fail when expecting possible network related errors
             self._handle_network_error(server_binding, e)
@@ -1423,6 +2177,23 @@ class Synchronizer(object):
                 or_more=reached_limit)
         return n_pending
 
+    def _notify_throughput(self, server_binding, force=False):
+        """Report the transfer rates of the binding to the frontend
+
+        Rates are in bytes per second, for all the concurrent transfers.
+        """
+        if self._frontend is None or server_binding is None:
+            return
+        now = time()
+        if (not force and now - self._last_throughput_notification
+                < self.throughput_notification_period):
+            return
+        self._last_throughput_notification = now
+        limiter = self._controller.get_bandwidth_limiter(server_binding)
+        self._frontend.notify_throughput(
+            server_binding, limiter.get_throughput(UPLOAD),
+            limiter.get_throughput(DOWNLOAD))
+
     def _handle_network_error(self, server_binding, e):
         _log_offline(e, "synchronization loop")
         msg = "Traceback of ignored network error: "
@@ -1434,8 +2205,12 @@ class Synchronizer(object):
             self._frontend.notify_offline(
                 server_binding, e)
 
-        self._controller.invalidate_client_cache(
-            server_binding.server_url)
+        # Keep the clients (and their operation registry) on transient
+        # network failures: the circuit breaker of the server takes care of
+        # probing it until it is back
+        if not is_transient_error(e):
+            self._controller.invalidate_client_cache(
+                server_binding.server_url)
 
     def get_remote_fs_client(self, server_binding):
         return self._controller.get_remote_fs_client(server_binding)
@@ -0,0 +1,454 @@
+"""In-memory stand-in for the Nuxeo Drive FileSystemItem API
+
+Useful to test the synchronization logic without any Nuxeo server: the remote
+clients built by the controller are backed by a shared FakeFileSystem instance
+that records every Automation call so that tests can check the number of
+round trips performed by each operation.
+"""
+import hashlib
+import shutil
+import urllib2
+from cStringIO import StringIO
+from functools import partial
+from threading import RLock
+from urllib import addinfourl
+
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.streaming import to_body
+
+
+TOP_LEVEL_ID = (u'org.nuxeo.drive.service.impl'
+                u'.DefaultTopLevelFolderItemFactory#')
+SYNC_ROOT_ID_PREFIX = u'defaultSyncRootFolderItemFactory#default#'
+FILE_ID_PREFIX = u'defaultFileSystemItemFactory#default#'
+DOWNLOAD_URL_PREFIX = u'nxbigfile/default/'
+
+
+class FakeFileSystem(object):
+    """Tree of remote file system items shared by fake remote clients"""
+
+    def __init__(self):
+        self.items = {}
+        self.contents = {}
+        self.batches = {}
+        self.events = []
+        self.calls = []
+        self._counter = 0
+        # Fake clients can be used by concurrent transfer workers
+        self.lock = RLock()
+        # Slow down signals: polling delay suggested in the change summary
+        # and Retry-After of 503 responses to all the calls when not None
+        self.suggested_delay = None
+        self.retry_after = None
+        # Indexes of the upload chunks for which the connection is reset once
+        self.failing_chunks = set()
+        # Number of bytes of a download after which the connection is reset
+        # once, by file system item id
+        self.interrupted_downloads = {}
+        # Whether the downloads can be resumed with range requests
+        self.accept_ranges = True
+        # Fake clock in milliseconds: each change moves it forward by one
+        # second to match the resolution of the modification dates
+        self.clock = 1000000000000
+        self.items[TOP_LEVEL_ID] = {
+            'id': TOP_LEVEL_ID,
+            'parentId': None,
+            'name': u'Nuxeo Drive',
+            'folder': True,
+            'path': u'/' + TOP_LEVEL_ID,
+            'canRename': False,
+            'canDelete': False,
+            'canCreateChild': False,
+            'lastModificationDate': self.clock,
+        }
+
+    def reset_calls(self):
+        del self.calls[:]
+
+    def count_calls(self, name=None):
+        if name is None:
+            return len(self.calls)
+        return len([c for c in self.calls if c == name])
+
+    def add_sync_root(self, name):
+        return self._add_item(TOP_LEVEL_ID, name, True,
+                              prefix=SYNC_ROOT_ID_PREFIX)
+
+    def add_folder(self, parent_id, name):
+        return self._add_item(parent_id, name, True)
+
+    def add_file(self, parent_id, name, content=b''):
+        return self._add_item(parent_id, name, False, content=content)
+
+    def update_file(self, fs_item_id, content):
+        self.contents[fs_item_id] = content
+        self._touch(fs_item_id)
+
+    def copy(self, fs_item_id, parent_id):
+        item = self.items[fs_item_id]
+        return self.add_file(parent_id, item['name'],
+                             self.contents[fs_item_id])
+
+    def get_doc_id(self, fs_item_id):
+        return fs_item_id.rsplit(u'#', 1)[1]
+
+    def find_by_doc_id(self, doc_id):
+        for fs_item_id in self.items:
+            if fs_item_id.endswith(u'#' + doc_id):
+                return fs_item_id
+        return None
+
+    def rename(self, fs_item_id, name):
+        self.items[fs_item_id]['name'] = name
+        self._touch(fs_item_id)
+
+    def move(self, fs_item_id, parent_id):
+        item = self.items[fs_item_id]
+        item['parentId'] = parent_id
+        self._update_paths(fs_item_id)
+        self._touch(fs_item_id)
+
+    def delete(self, fs_item_id):
+        for child_id in self.children_ids(fs_item_id):
+            self.delete(child_id)
+        del self.items[fs_item_id]
+        self.contents.pop(fs_item_id, None)
+        self._tick()
+        self.events.append({
+            'fileSystemItemId': fs_item_id,
+            'eventDate': self.clock,
+            'fileSystemItem': None,
+        })
+
+    def children_ids(self, fs_item_id):
+        return sorted([i['id'] for i in self.items.values()
+                       if i['parentId'] == fs_item_id],
+                      key=lambda i: self.items[i]['name'])
+
+    def find(self, name, parent_id=None):
+        for item in self.items.values():
+            if item['name'] != name:
+                continue
+            if parent_id is not None and item['parentId'] != parent_id:
+                continue
+            return item['id']
+        return None
+
+    def to_fs_item(self, fs_item_id):
+        item = self.items.get(fs_item_id)
+        if item is None:
+            return None
+        fs_item = dict(item)
+        if not item['folder']:
+            content = self.contents[fs_item_id]
+            fs_item['digest'] = hashlib.md5(content).hexdigest()
+            fs_item['digestAlgorithm'] = u'md5'
+            fs_item['downloadURL'] = DOWNLOAD_URL_PREFIX + fs_item_id
+            fs_item['canUpdate'] = True
+        return fs_item
+
+    def get_changes(self, last_sync_date):
+        if last_sync_date is None:
+            changes = []
+        else:
+            changes = [e for e in self.events
+                       if e['eventDate'] > last_sync_date]
+        summary = {
+            'fileSystemChanges': changes,
+            'syncDate': self.clock,
+            'hasTooManyChanges': False,
+            'activeSynchronizationRootDefinitions': u'',
+        }
+        if self.suggested_delay is not None:
+            summary['suggestedDelay'] = self.suggested_delay
+        return summary
+
+    def _add_item(self, parent_id, name, folder, content=None,
+                  prefix=FILE_ID_PREFIX):
+        self._counter += 1
+        fs_item_id = u'%s%08d' % (prefix, self._counter)
+        parent = self.items[parent_id]
+        item = {
+            'id': fs_item_id,
+            'parentId': parent_id,
+            'name': name,
+            'folder': folder,
+            'path': parent['path'] + u'/' + fs_item_id,
+            'canRename': True,
+            'canDelete': True,
+        }
+        if folder:
+            item['canCreateChild'] = True
+        else:
+            self.contents[fs_item_id] = content
+        self.items[fs_item_id] = item
+        self._touch(fs_item_id)
+        return fs_item_id
+
+    def _update_paths(self, fs_item_id):
+        item = self.items[fs_item_id]
+        parent = self.items[item['parentId']]
+        item['path'] = parent['path'] + u'/' + fs_item_id
+        for child_id in self.children_ids(fs_item_id):
+            self._update_paths(child_id)
+
+    def _tick(self):
+        self.clock += 1000
+
+    def _touch(self, fs_item_id):
+        self._tick()
+        self.items[fs_item_id]['lastModificationDate'] = self.clock
+        self.events.append({
+            'fileSystemItemId': fs_item_id,
+            'eventDate': self.clock,
+            'fileSystemItem': self.to_fs_item(fs_item_id),
+        })
+
+
+class FakeRemoteFileSystemClient(RemoteFileSystemClient):
+    """Remote file system client backed by a FakeFileSystem
+
+    Only the network layer is faked: the client logic (e.g. the conversion
+    of the file system items or the batch upload protocol) is the real one.
+    """
+
+    def __init__(self, server_url, user_id, device_id, client_version,
+                 fs=None, **kwargs):
+        self.fs = fs
+        super(FakeRemoteFileSystemClient, self).__init__(
+            server_url, user_id, device_id, client_version, **kwargs)
+
+    def fetch_api(self):
+        self.operations = {}
+
+    def execute(self, command, op_input=None, timeout=-1,
+                check_params=True, void_op=False, context=None, **params):
+        if self._error is not None:
+            raise self._error
+        self.circuit_breaker.before_call()
+        self._check_overload()
+        with self.fs.lock:
+            if command == self.batch_execute_url:
+                command = params.pop('operationId')
+                batch_id = params.pop('batchId')
+                file_index = params.pop('fileIdx')
+                files = self.fs.batches.pop(batch_id)
+                blobs = [self._get_blob(files[i])
+                         for i in range(len(files))]
+                if file_index is None:
+                    params['blobs'] = blobs
+                else:
+                    params['name'], params['content'] = blobs[
+                        int(file_index)]
+            self.fs.calls.append(command)
+            if op_input is not None:
+                params['op_input'] = op_input
+            if context is not None:
+                params['context'] = context
+            handler = getattr(self, '_op_' + command.replace(
+                'NuxeoDrive.', '').replace('.', '_'))
+            return handler(**params)
+
+    def execute_with_blobs(self, command, blobs, context=None, **params):
+        blobs = [(filename, to_body(blob_content).getvalue())
+                 for blob_content, filename in blobs]
+        if len(blobs) == 1:
+            params['name'], params['content'] = blobs[0]
+        else:
+            params['blobs'] = blobs
+        return self.execute(command, context=context, **params)
+
+    def _get_blob(self, uploaded_file):
+        name, chunk_count, chunks = uploaded_file
+        if len(chunks) != chunk_count:
+            raise urllib2.HTTPError(
+                self.server_url, 500, 'Missing chunks', {}, None)
+        return name, b''.join(chunks[i] for i in range(chunk_count))
+
+    def _check_overload(self):
+        if self.fs.retry_after is not None:
+            raise self._overloaded(urllib2.HTTPError(
+                self.server_url, 503, 'Service Unavailable',
+                {'Retry-After': str(self.fs.retry_after)}, None))
+
+    def upload_body(self, batch_id, body, filename, file_index=0,
+                    chunk_index=None, chunk_count=None, file_size=None):
+        if self._error is not None:
+            raise self._error
+        if chunk_index is None:
+            chunk_index, chunk_count = 0, 1
+        with self.fs.lock:
+            self.fs.calls.append(self.batch_upload_url)
+            if chunk_index in self.fs.failing_chunks:
+                self.fs.failing_chunks.discard(chunk_index)
+                raise urllib2.URLError('Connection reset by peer')
+            files = self.fs.batches.setdefault(batch_id, {})
+            _, _, chunks = files.setdefault(int(file_index),
+                                            (filename, chunk_count, {}))
+            chunks[chunk_index] = body.getvalue()
+        return {'uploaded': 'true', 'batchId': batch_id}
+
+    def _do_get(self, url, file_out=None, download=None, hasher=None):
+        if self._error is not None:
+            raise self._error
+        self.circuit_breaker.before_call()
+        self._check_overload()
+        self.fs.calls.append('download')
+        fs_item_id = url.split(DOWNLOAD_URL_PREFIX, 1)[1]
+        content = self.fs.contents[fs_item_id]
+        if file_out is None:
+            return content, None
+        offset = 0
+        if download is not None:
+            offset = download.accept(self._get_response(url, content,
+                                                        download.offset))
+        interrupted_after = self.fs.interrupted_downloads.pop(fs_item_id,
+                                                              None)
+        with self._open_part_file(file_out, offset, hasher) as f:
+            if interrupted_after is not None:
+                f.write(content[offset:offset + interrupted_after])
+                raise urllib2.URLError('Connection reset by peer')
+            f.write(content[offset:])
+            if hasher is not None:
+                hasher.update(content[offset:])
+        return None, file_out
+
+    def _get_response(self, url, content, offset):
+        """Headers only response to a download starting at offset"""
+        if offset and self.fs.accept_ranges:
+            headers = {'Content-Range': 'bytes %d-%d/%d' % (
+                offset, len(content) - 1, len(content))}
+            code = 206
+        else:
+            headers = {'Content-Length': str(len(content))}
+            code = 200
+        return addinfourl(StringIO(), headers, url, code)
+
+    # Fake operations
+
+    def _op_GetTopLevelFolder(self):
+        return self.fs.to_fs_item(TOP_LEVEL_ID)
+
+    def _op_GetFileSystemItem(self, id):
+        return self.fs.to_fs_item(id)
+
+    def _op_GetChildren(self, id):
+        return [self.fs.to_fs_item(i) for i in self.fs.children_ids(id)]
+
+    def _op_FileSystemItemExists(self, id):
+        return id in self.fs.items
+
+    def _op_GetChangeSummary(self, lastSyncDate=None,
+                             lastSyncActiveRootDefinitions=None):
+        return self.fs.get_changes(lastSyncDate)
+
+    def _op_CreateFolder(self, parentId, name):
+        return self.fs.to_fs_item(self.fs.add_folder(parentId, name))
+
+    def _op_CreateFile(self, parentId, name, content):
+        return self.fs.to_fs_item(self.fs.add_file(parentId, name, content))
+
+    def _op_UpdateFile(self, id, name, content):
+        self.fs.update_file(id, content)
+        return self.fs.to_fs_item(id)
+
+    def _op_Delete(self, id):
+        self.fs.delete(id)
+
+    def _op_Rename(self, id, name):
+        self.fs.rename(id, name)
+        return self.fs.to_fs_item(id)
+
+    def _op_CanMove(self, srcId, destId):
+        return True
+
+    def _op_Move(self, srcId, destId):
+        self.fs.move(srcId, destId)
+        return self.fs.to_fs_item(srcId)
+
+    def _op_GenerateConflictedItemName(self, name):
+        return name + u' (conflicted)'
+
+    def _op_FileManager_Import(self, context, blobs=None, name=None,
+                               content=None):
+        if blobs is None:
+            blobs = [(name, content)]
+        parent_id = self.fs.find_by_doc_id(context['currentDocument'])
+        return {'entity-type': 'documents', 'entries': [
+            {'entity-type': 'document', 'uid': self.fs.get_doc_id(
+                self.fs.add_file(parent_id, blob_name, blob_content))}
+            for blob_name, blob_content in blobs]}
+
+    def _op_Document_Copy(self, op_input, target):
+        source_id = self.fs.find_by_doc_id(op_input.split(u':', 1)[1])
+        parent_id = self.fs.find_by_doc_id(target)
+        copy_id = self.fs.copy(source_id, parent_id)
+        return {'entity-type': 'document', 'uid': self.fs.get_doc_id(copy_id)}
+
+
+class FakeRemoteDocumentClient(object):
+    """Minimal document client used by the controller to bind a server"""
+
+    def __init__(self, server_url, user_id, device_id, client_version,
+                 password=None, token=None, **kwargs):
+        self.server_url = server_url
+
+    def request_token(self, revoke=False):
+        return None if revoke else u'fake-token'
+
+    def revoke_token(self):
+        self.request_token(revoke=True)
+
+
+class RoundTripRecorder(object):
+    """Record the calls to a FakeFileSystem by synchronization handler
+
+    The synchronize_one method and the handlers of synchronizer are wrapped:
+    rounds lists the (handler name, calls) of each synchronize_one call, the
+    calls including the refresh of the pair and, without transfer workers,
+    its transfers. The handler is the first one called, e.g. conflicts are
+    handled as remote creations.
+    """
+
+    def __init__(self, synchronizer, fs):
+        self.fs = fs
+        self.rounds = []
+        self._handler = None
+        synchronizer.synchronize_one = self._wrap_synchronize_one(
+            synchronizer.synchronize_one)
+        for name in dir(type(synchronizer)):
+            if (name.startswith('_synchronize_')
+                and name != '_synchronize_step'):
+                setattr(synchronizer, name, self._wrap_handler(
+                    name, getattr(synchronizer, name)))
+
+    def reset(self):
+        del self.rounds[:]
+
+    def _wrap_synchronize_one(self, synchronize_one):
+        def synchronize_one_recorded(doc_pair, session=None):
+            start = len(self.fs.calls)
+            self._handler = None
+            try:
+                return synchronize_one(doc_pair, session=session)
+            finally:
+                self.rounds.append((self._handler, self.fs.calls[start:]))
+        return synchronize_one_recorded
+
+    def _wrap_handler(self, name, handler):
+        def handler_recorded(*args, **kwargs):
+            if self._handler is None:
+                self._handler = name
+            return handler(*args, **kwargs)
+        return handler_recorded
+
+
+def install_fake_remote(controller, fs):
+    """Make the controller build remote clients backed by fs"""
+    controller.remote_fs_client_factory = partial(
+        FakeRemoteFileSystemClient, fs=fs)
+    controller.remote_doc_client_factory = FakeRemoteDocumentClient
+
+
+def remove_tree(path):
+    shutil.rmtree(path, ignore_errors=True)
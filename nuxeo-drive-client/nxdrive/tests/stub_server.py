@@ -0,0 +1,333 @@
+"""Local stand-in for a Nuxeo server speaking the Automation HTTP API
+
+The server runs in a background thread on a random local port and records
+every request it receives so that tests can assert the number of round trips
+performed by the clients without any real Nuxeo instance.
+"""
+import gzip
+import hashlib
+import json
+import socket
+import threading
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from cStringIO import StringIO
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+
+
+CONTEXT_PATH = '/nuxeo/'
+AUTOMATION_PATH = CONTEXT_PATH + 'site/automation/'
+
+
+class StubResponse(object):
+    """Raw HTTP response to be sent back by a stub handler"""
+
+    def __init__(self, status=200, body=b'', headers=None,
+                 content_type='application/octet-stream',
+                 close_connection=False):
+        self.status = status
+        self.body = body
+        self.headers = dict(headers) if headers is not None else {}
+        self.headers.setdefault('Content-Type', content_type)
+        # Silently close the connection after the response as a server
+        # dropping idle connections would do
+        self.close_connection = close_connection
+
+
+def json_response(value, status=200, headers=None):
+    return StubResponse(status=status, body=json.dumps(value),
+                        headers=headers, content_type='application/json')
+
+
+def file_fs_item(fs_item_id, name, content=b'', parent_id=u'root'):
+    """File system item of a file, as returned by the NuxeoDrive operations"""
+    return {
+        'id': fs_item_id, 'parentId': parent_id, 'name': name,
+        'path': u'/%s/%s' % (parent_id, fs_item_id), 'folder': False,
+        'lastModificationDate': 0,
+        'digest': hashlib.md5(content).hexdigest(),
+        'digestAlgorithm': u'md5', 'canRename': True, 'canDelete': True,
+        'canUpdate': True,
+        'downloadURL': u'nxbigfile/default/' + fs_item_id,
+    }
+
+
+class StubRequest(object):
+    """Request received by the stub server"""
+
+    def __init__(self, method, path, query, headers, body, operation=None):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.operation = operation
+
+    def __repr__(self):
+        return "StubRequest<%s %s>" % (self.method, self.path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response in one go as a real server would do
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.stub.on_connection(self.connection)
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            self.server.stub.on_connection_closed(self.connection)
+
+    def log_message(self, format, *args):
+        # Keep the test output clean
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        parsed = urlparse(self.path)
+        request = StubRequest(method, parsed.path, parsed.query,
+                              self.headers, body)
+        try:
+            response = self.server.stub.handle(request)
+        except Exception as e:
+            response = json_response({'message': repr(e)}, status=500)
+        body = response.body
+        headers = dict(response.headers)
+        if self.server.stub.should_compress(request, response):
+            body = _gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(response.status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if response.close_connection:
+            self.close_connection = 1
+
+
+def _gzip(data):
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Connections reset by the clients or by stop() are expected
+        pass
+
+
+class StubNuxeoServer(object):
+    """Minimal Nuxeo server to test the Automation clients
+
+    Operations are registered with a handler called with the params and the
+    input of the JSON request; the returned value is serialized as the JSON
+    response unless it is a StubResponse. Other URLs (e.g. batch upload or
+    downloads) can be served with custom routes matched by path prefix.
+
+    If compression_min_size is not None, responses of at least that size
+    are gzipped for the clients accepting it, as a Tomcat connector would.
+    """
+
+    def __init__(self, compression_min_size=None):
+        self.compression_min_size = compression_min_size
+        self.operations = {}
+        self.routes = []
+        self.requests = []
+        self.connections = 0
+        self._open_connections = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%d%s' % (host, port, CONTEXT_PATH)
+
+    def register_operation(self, op_id, handler, params=(), optional=()):
+        descriptors = [{'name': name, 'type': 'string', 'required': True}
+                       for name in params]
+        descriptors += [{'name': name, 'type': 'string', 'required': False}
+                        for name in optional]
+        self.operations[op_id] = (handler, descriptors)
+
+    def add_route(self, method, path_prefix, handler):
+        """Serve the requests whose path relative to the context match"""
+        self.routes.append((method, CONTEXT_PATH + path_prefix, handler))
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+        # Release the handler threads waiting on kept alive connections
+        with self._lock:
+            open_connections = list(self._open_connections)
+        for connection in open_connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def reset(self):
+        with self._lock:
+            del self.requests[:]
+            self.connections = 0
+
+    def count_requests(self, operation=None):
+        with self._lock:
+            if operation is None:
+                return len(self.requests)
+            return len([r for r in self.requests
+                        if r.operation == operation])
+
+    def should_compress(self, request, response):
+        if (self.compression_min_size is None
+            or len(response.body) < self.compression_min_size
+            or 'Content-Encoding' in response.headers):
+            return False
+        accepted = request.headers.get('Accept-Encoding', '')
+        return 'gzip' in [e.strip() for e in accepted.split(',')]
+
+    def on_connection(self, connection):
+        with self._lock:
+            self.connections += 1
+            self._open_connections.add(connection)
+
+    def on_connection_closed(self, connection):
+        with self._lock:
+            self._open_connections.discard(connection)
+
+    def handle(self, request):
+        if request.path.startswith(AUTOMATION_PATH):
+            request.operation = request.path[len(AUTOMATION_PATH):] or None
+        with self._lock:
+            self.requests.append(request)
+        for method, path_prefix, handler in self.routes:
+            if (request.method == method
+                and request.path.startswith(path_prefix)):
+                return handler(request)
+        if request.path == AUTOMATION_PATH and request.method == 'GET':
+            return json_response(self._get_registry())
+        if request.operation in self.operations:
+            handler, _ = self.operations[request.operation]
+            payload = json.loads(request.body) if request.body else {}
+            result = handler(payload.get('params', {}),
+                             payload.get('input'))
+            if isinstance(result, StubResponse):
+                return result
+            if result is None:
+                return StubResponse(status=204)
+            return json_response(result)
+        return json_response({'message': 'Not found: ' + request.path},
+                             status=404)
+
+    def _get_registry(self):
+        return {
+            'paths': {},
+            'chains': [],
+            'operations': [{'id': op_id, 'params': descriptors}
+                           for op_id, (_, descriptors)
+                           in sorted(self.operations.items())],
+        }
+
+
+class StubBatchUpload(object):
+    """Automation batch upload endpoints of a StubNuxeoServer
+
+    Files are uploaded in a single request or chunk by chunk (X-Upload-Type
+    chunked) and kept in memory until their batch is executed:
+    execute_handler(operation_id, params, filename, content) is then called
+    and its result sent back as JSON. As for a Nuxeo server, executing a
+    batch with missing chunks fails.
+
+    The chunk indexes of failing_chunks are answered with an error once, to
+    simulate interrupted uploads. received records the (batch id, chunk
+    index) of each upload request.
+    """
+
+    def __init__(self, server, execute_handler=None):
+        self.execute_handler = (
+            execute_handler if execute_handler is not None
+            else lambda operation_id, params, filename, content: {'id': u'1'})
+        self.batches = {}
+        self.received = []
+        self.failing_chunks = set()
+        self._lock = threading.Lock()
+        server.add_route('POST', 'site/automation/batch/upload', self.upload)
+        server.add_route('POST', 'site/automation/batch/execute',
+                         self.execute)
+
+    def upload(self, request):
+        headers = request.headers
+        batch_id = headers['X-Batch-Id']
+        if headers.get('X-Upload-Type') == 'chunked':
+            index = int(headers['X-Upload-Chunk-Index'])
+            count = int(headers['X-Upload-Chunk-Count'])
+        else:
+            index, count = 0, 1
+        with self._lock:
+            self.received.append((batch_id, index))
+            if index in self.failing_chunks:
+                self.failing_chunks.discard(index)
+                return json_response({'message': 'Upload interrupted'},
+                                     status=500)
+            files = self.batches.setdefault(batch_id, {})
+            filename = urllib2.unquote(headers['X-File-Name'])
+            _, _, chunks = files.setdefault(headers['X-File-Idx'],
+                                            (filename, count, {}))
+            chunks[index] = request.body
+        return json_response({'uploaded': 'true', 'batchId': batch_id})
+
+    def execute(self, request):
+        params = json.loads(request.body)['params']
+        operation_id = params.pop('operationId')
+        batch_id = params.pop('batchId')
+        file_index = params.pop('fileIdx')
+        with self._lock:
+            files = self.batches.pop(batch_id, {})
+        if file_index not in files:
+            return json_response({'message': 'Unknown batch ' + batch_id},
+                                 status=500)
+        filename, count, chunks = files[file_index]
+        if len(chunks) != count:
+            return json_response({'message': 'Missing chunks'}, status=500)
+        content = b''.join(chunks[i] for i in range(count))
+        return json_response(self.execute_handler(
+            operation_id, params, filename.decode('utf-8'), content))
@@ -0,0 +1,174 @@
+"""Bandwidth shaping tests"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.bandwidth import BandwidthLimiter
+from nxdrive.client.bandwidth import BandwidthLimits
+from nxdrive.client.bandwidth import DOWNLOAD
+from nxdrive.client.bandwidth import ThroughputMeter
+from nxdrive.client.bandwidth import TokenBucket
+from nxdrive.client.bandwidth import UPLOAD
+from nxdrive.tests.stub_server import StubBatchUpload
+from nxdrive.tests.stub_server import StubNuxeoServer
+from nxdrive.tests.stub_server import StubResponse
+from nxdrive.tests.stub_server import file_fs_item
+
+
+CONTENT = b'0123456789' * 30000
+
+# A Wednesday
+BUSINESS_TIME = datetime(2014, 1, 8, 10, 30)
+NIGHT_TIME = datetime(2014, 1, 8, 22, 0)
+WEEK_END_TIME = datetime(2014, 1, 11, 10, 30)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.waits = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_rate(self):
+        bucket = TokenBucket(1000, clock=self.clock, sleep=self.clock.sleep)
+        # A full bucket lets a burst through
+        self.assertEquals(bucket.consume(1000), 0)
+        self.assertEquals(bucket.consume(500), 0.5)
+        self.assertEquals(bucket.consume(1000), 1)
+        self.clock.now += 2
+        self.assertEquals(bucket.consume(1000), 0)
+        # Tokens do not accumulate beyond the capacity
+        self.clock.now += 10
+        self.assertEquals(bucket.consume(2000), 1)
+
+    def test_shared_debt(self):
+        # A consumer borrowing tokens delays the next ones
+        bucket = TokenBucket(1000, capacity=0, clock=self.clock,
+                             sleep=lambda seconds: None)
+        self.assertEquals(bucket.consume(500), 0.5)
+        self.assertEquals(bucket.consume(500), 1)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(clock=self.clock, sleep=self.clock.sleep)
+        self.assertEquals(bucket.consume(10 ** 9), 0)
+        bucket.set_rate(1000)
+        bucket.consume(3000)
+        self.assertEquals(self.clock.waits, [2])
+
+
+class TestBandwidthLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = BUSINESS_TIME
+
+    def test_schedule(self):
+        limits = BandwidthLimits(upload=100, off_hours_upload=1000)
+        self.assertEquals(limits.get_limit(UPLOAD, BUSINESS_TIME), 100)
+        self.assertEquals(limits.get_limit(UPLOAD, NIGHT_TIME), 1000)
+        self.assertEquals(limits.get_limit(UPLOAD, WEEK_END_TIME), 1000)
+        self.assertEquals(limits.get_limit(DOWNLOAD, BUSINESS_TIME), None)
+
+    def test_throttle(self):
+        limiter = BandwidthLimiter(
+            BandwidthLimits(upload=1000, off_hours_upload=4000),
+            clock=self.clock, sleep=self.clock.sleep, now=lambda: self.time)
+        limiter.throttle(UPLOAD, 3000)
+        self.assertEquals(self.clock.waits, [2])
+        # The off hours limit applies as soon as the business hours end
+        self.time = NIGHT_TIME
+        limiter.throttle(UPLOAD, 6000)
+        self.assertEquals(self.clock.waits, [2, 0.5])
+        limiter.throttle(DOWNLOAD, 10 ** 9)
+        self.assertEquals(len(self.clock.waits), 2)
+
+    def test_throughput(self):
+        meter = ThroughputMeter(window=5, clock=self.clock)
+        meter.record(1000)
+        self.clock.now += 1
+        meter.record(4000)
+        self.assertEquals(meter.get_rate(), 1000)
+        self.clock.now += 5
+        self.assertEquals(meter.get_rate(), 0)
+
+
+class TestThrottledTransfers(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubNuxeoServer()
+        self.server.register_operation(
+            'NuxeoDrive.CreateFile', lambda params, op_input: None,
+            params=('parentId',))
+        self.server.register_operation('NuxeoDrive.GetFileSystemItem',
+                                       self.get_fs_item, params=('id',))
+        self.server.add_route('GET', 'nxbigfile/',
+                              lambda request: StubResponse(body=CONTENT))
+        self.created = []
+        StubBatchUpload(self.server, self.create_file)
+        self.server.start()
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests-bandwidth')
+        self.path = os.path.join(self.folder, u'File.bin')
+        with open(self.path, 'wb') as f:
+            f.write(CONTENT)
+        # Transfers do not actually wait: the waits tell the time it would
+        # have taken
+        self.waits = []
+        self.lock = threading.Lock()
+        limits = BandwidthLimits(upload=100000, download=100000,
+                                 off_hours_upload=100000,
+                                 off_hours_download=100000)
+        self.limiter = BandwidthLimiter(limits, sleep=self.sleep)
+        self.client = RemoteFileSystemClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={}, bandwidth_limiter=self.limiter)
+        self.client.inline_upload_max_size = 0
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.waits.append(seconds)
+
+    def create_file(self, operation_id, params, filename, content):
+        self.created.append(content)
+        return file_fs_item(u'1', filename, content)
+
+    def get_fs_item(self, params, op_input):
+        return file_fs_item(params['id'], u'File.bin', CONTENT)
+
+    def test_upload(self):
+        self.client.stream_file(u'parent', self.path)
+        self.assertEquals(self.created, [CONTENT])
+        # 300 KB at 100 KB/s after a burst of 100 KB: 2 seconds
+        self.assertAlmostEqual(max(self.waits), 2, delta=0.2)
+        self.assertEquals(self.limiter.get_throughput(UPLOAD),
+                          len(CONTENT) / 5.0)
+        self.assertEquals(self.limiter.get_throughput(DOWNLOAD), 0)
+
+    def test_download(self):
+        target = os.path.join(self.folder, u'Downloaded.bin')
+        part = self.client.stream_content(u'file', target)
+        with open(part, 'rb') as f:
+            self.assertEquals(f.read(), CONTENT)
+        self.assertAlmostEqual(max(self.waits), 2, delta=0.2)
+        self.assertEquals(self.limiter.get_throughput(DOWNLOAD),
+                          len(CONTENT) / 5.0)
@@ -0,0 +1,118 @@
+from nose.tools import assert_equals
+
+from nxdrive.change_feed import ChangeFeed
+
+
+class FakeBinding(object):
+
+    def __init__(self, local_folder, server_url=u'http://server/nuxeo/',
+                 remote_user=u'user', last_sync_date=None,
+                 last_root_definitions=None):
+        self.local_folder = local_folder
+        self.server_url = server_url
+        self.remote_user = remote_user
+        self.last_sync_date = last_sync_date
+        self.last_root_definitions = last_root_definitions
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def get_changes(self, last_sync_date=None, last_root_definitions=None):
+        self.calls.append((last_sync_date, last_root_definitions))
+        return {
+            'fileSystemChanges': [
+                {'fileSystemItemId': 'a', 'eventDate': 100},
+                {'fileSystemItemId': 'b', 'eventDate': 200},
+            ],
+            'syncDate': 300,
+            'hasTooManyChanges': False,
+            'activeSynchronizationRootDefinitions': u'default:root',
+        }
+
+
+def get_feed():
+    client = FakeClient()
+    return ChangeFeed(lambda sb: client), client
+
+
+def test_poll_without_cycle():
+    feed, client = get_feed()
+    sb = FakeBinding(u'/folder 1', last_sync_date=150)
+    feed.get_changes(sb)
+    feed.get_changes(sb)
+    assert_equals(client.calls, [(150, None), (150, None)])
+
+
+def test_one_poll_per_user_and_cycle():
+    feed, client = get_feed()
+    sb_1 = FakeBinding(u'/folder 1', last_sync_date=150)
+    sb_2 = FakeBinding(u'/folder 2', last_sync_date=50)
+    sb_3 = FakeBinding(u'/folder 3')
+    other_user = FakeBinding(u'/folder 4', remote_user=u'other',
+                             last_sync_date=150)
+    feed.start_cycle([sb_1, sb_2, sb_3, other_user])
+
+    summary_1 = feed.get_changes(sb_1)
+    summary_2 = feed.get_changes(sb_2)
+    summary_3 = feed.get_changes(sb_3)
+    # The server is polled from the oldest checkpoint of the group
+    assert_equals(client.calls, [(50, None)])
+
+    # Each binding only gets the changes it has not processed yet
+    assert_equals([c['fileSystemItemId']
+                   for c in summary_1['fileSystemChanges']], ['b'])
+    assert_equals([c['fileSystemItemId']
+                   for c in summary_2['fileSystemChanges']], ['a', 'b'])
+    assert_equals(len(summary_3['fileSystemChanges']), 2)
+    for summary in (summary_1, summary_2, summary_3):
+        assert_equals(summary['syncDate'], 300)
+
+    # Checkpointing a binding does not trigger a new poll in the same cycle
+    sb_1.last_sync_date = 300
+    feed.get_changes(sb_1)
+    assert_equals(len(client.calls), 1)
+
+    feed.get_changes(other_user)
+    assert_equals(client.calls, [(50, None), (150, None)])
+
+    feed.end_cycle()
+    feed.get_changes(sb_1)
+    assert_equals(client.calls[-1], (300, None))
+
+
+def test_root_definitions_are_kept_apart():
+    feed, client = get_feed()
+    sb_1 = FakeBinding(u'/folder 1', last_sync_date=150,
+                       last_root_definitions=u'default:root')
+    sb_2 = FakeBinding(u'/folder 2', last_sync_date=150)
+    feed.start_cycle([sb_1, sb_2])
+    feed.get_changes(sb_1)
+    feed.get_changes(sb_2)
+    assert_equals(client.calls, [(150, u'default:root'), (150, None)])
+
+
+def test_lagging_binding_polls_alone():
+    feed, client = get_feed()
+    feed.max_lag = 100
+    sb_1 = FakeBinding(u'/folder 1', last_sync_date=250)
+    sb_2 = FakeBinding(u'/folder 2', last_sync_date=150)
+    stale = FakeBinding(u'/folder 3', last_sync_date=10)
+    feed.start_cycle([stale, sb_1, sb_2])
+
+    # The stale binding does not make the others fetch its backlog
+    summary = feed.get_changes(stale)
+    feed.get_changes(sb_1)
+    feed.get_changes(sb_2)
+    assert_equals(client.calls, [(10, None), (150, None)])
+    assert_equals(len(summary['fileSystemChanges']), 2)
+
+    # Once caught up, it shares the polls of the group again
+    for sb in (stale, sb_1, sb_2):
+        sb.last_sync_date = 300
+    feed.start_cycle([stale, sb_1, sb_2])
+    for sb in (stale, sb_1, sb_2):
+        feed.get_changes(sb)
+    assert_equals(client.calls[2:], [(300, None)])
@@ -0,0 +1,78 @@
+"""Compressed HTTP responses tests against a stub server"""
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.tests.stub_server import StubNuxeoServer
+from nxdrive.tests.stub_server import StubResponse
+
+
+CHANGES = {'fileSystemChanges': [{'eventId': 'documentModified',
+                                  'fileSystemItemName': u'File %d.txt' % i}
+                                 for i in range(1000)]}
+
+CONTENT = b'Some highly compressible content\n' * 10000
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubNuxeoServer(compression_min_size=1024)
+        self.server.register_operation(
+            'Stub.Changes', lambda params, op_input: CHANGES)
+        self.server.register_operation(
+            'Stub.Deflate', lambda params, op_input: self.deflated(
+                zlib.compress(b'{"deflated": true}')))
+        self.server.register_operation(
+            'Stub.RawDeflate', lambda params, op_input: self.deflated(
+                zlib.compress(b'{"deflated": true}')[2:-4]))
+        self.server.add_route('GET', 'nxbigfile/', lambda request:
+                              StubResponse(body=CONTENT))
+        self.server.start()
+        self.client = RemoteFileSystemClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={})
+        self.local_folder = tempfile.mkdtemp(u'-nxdrive-tests-compression')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.local_folder)
+
+    def deflated(self, body):
+        return StubResponse(body=body, content_type='application/json',
+                            headers={'Content-Encoding': 'deflate'})
+
+    def test_compressed_json(self):
+        handler = self.client.decompression_handler
+        self.assertEquals(self.client.execute('Stub.Changes'), CHANGES)
+        request = self.server.requests[-1]
+        self.assertEquals(request.headers.get('Accept-Encoding'),
+                          'gzip, deflate')
+        self.assertTrue(handler.wire_bytes * 10 < handler.decoded_bytes)
+
+        self.assertEquals(self.client.execute('Stub.Deflate'),
+                          {'deflated': True})
+        self.assertEquals(self.client.execute('Stub.RawDeflate'),
+                          {'deflated': True})
+
+        # Compressed responses are fully consumed: the connection is reused
+        self.assertEquals(self.server.connections, 1)
+
+    def test_downloads(self):
+        url = self.server.url + 'nxbigfile/default/file-id/blobholder:0/'
+        file_out = os.path.join(self.local_folder, u'Document.txt')
+        self.client._do_get(url + 'Document.txt', file_out=file_out)
+        self.assertEquals(self.server.requests[-1].headers.get(
+            'Accept-Encoding'), 'gzip, deflate')
+        with open(file_out, 'rb') as f:
+            self.assertEquals(f.read(), CONTENT)
+
+        # Content types already compressed are not worth compressing again
+        content, _ = self.client._do_get(url + 'Picture.jpg')
+        self.assertEquals(self.server.requests[-1].headers.get(
+            'Accept-Encoding'), 'identity')
+        self.assertEquals(content, CONTENT)
+        self.assertEquals(self.server.connections, 1)
@@ -0,0 +1,111 @@
+"""Persistent connection tests against a stub server"""
+import os
+import tempfile
+import unittest
+from cookielib import CookieJar
+
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.tests.stub_server import StubNuxeoServer
+from nxdrive.tests.stub_server import StubResponse
+from nxdrive.tests.stub_server import json_response
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubNuxeoServer()
+        self.server.register_operation(
+            'Stub.Ping', lambda params, op_input: {'pong': True})
+        self.server.register_operation(
+            'Stub.Close', lambda params, op_input: json_response(
+                {'pong': True}, headers={'Connection': 'close'}))
+        self.server.register_operation(
+            'Stub.Drop', lambda params, op_input: StubResponse(
+                body=b'{}', content_type='application/json',
+                close_connection=True))
+        self.server.register_operation(
+            'Stub.Cookie', lambda params, op_input: json_response(
+                {}, headers={'Set-Cookie': 'AWSELB=affinity; Path=/'}))
+        self.server.add_route('POST', 'site/automation/batch/upload',
+                              self.upload)
+        self.uploaded = []
+        self.server.start()
+        self.tmp_files = []
+
+    def tearDown(self):
+        self.server.stop()
+        for path in self.tmp_files:
+            os.remove(path)
+
+    def upload(self, request):
+        self.uploaded.append(request.body)
+        return json_response({'uploaded': 'true'})
+
+    def get_client(self, pool=None, cookie_jar=None):
+        client = RemoteDocumentClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={}, connection_pool=pool, cookie_jar=cookie_jar)
+        return client
+
+    def test_connection_reuse(self):
+        client = self.get_client()
+        for _ in range(10):
+            self.assertEquals(client.execute('Stub.Ping'), {'pong': True})
+        self.assertEquals(self.server.count_requests(), 11)
+        self.assertEquals(self.server.connections, 1)
+
+    def test_shared_pool(self):
+        pool = ConnectionPool()
+        client_1 = self.get_client(pool=pool)
+        client_2 = self.get_client(pool=pool)
+        client_1.execute('Stub.Ping')
+        client_2.execute('Stub.Ping')
+        self.assertEquals(self.server.connections, 1)
+
+    def test_pool_size(self):
+        client = self.get_client(pool=ConnectionPool(max_idle_per_host=0))
+        for _ in range(5):
+            client.execute('Stub.Ping')
+        self.assertEquals(self.server.connections, 6)
+
+    def test_idle_eviction(self):
+        client = self.get_client(pool=ConnectionPool(idle_timeout=-1))
+        for _ in range(5):
+            client.execute('Stub.Ping')
+        self.assertEquals(self.server.connections, 6)
+
+    def test_server_closing_connections(self):
+        client = self.get_client()
+        client.execute('Stub.Close')
+        self.assertEquals(client.execute('Stub.Ping'), {'pong': True})
+        self.assertEquals(self.server.connections, 2)
+
+        # Connection dropped without notice: the stale connection is not
+        # reused
+        client.execute('Stub.Drop')
+        self.assertEquals(client.execute('Stub.Ping'), {'pong': True})
+        self.assertEquals(self.server.connections, 3)
+
+    def test_streaming_upload(self):
+        client = self.get_client()
+        fd, path = tempfile.mkstemp()
+        self.tmp_files.append(path)
+        content = b'0123456789' * 10000
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        for i in range(3):
+            client.upload('batch-%d' % i, path, filename=u'File.txt')
+        self.assertEquals(self.uploaded, [content] * 3)
+        self.assertEquals(self.server.connections, 1)
+
+    def test_shared_cookies(self):
+        cookie_jar = CookieJar()
+        client = self.get_client(cookie_jar=cookie_jar)
+        client.execute('Stub.Cookie')
+        self.assertEquals([c.value for c in cookie_jar], ['affinity'])
+        client.execute('Stub.Ping')
+        last_request = self.server.requests[-1]
+        self.assertEquals(last_request.headers.get('Cookie'),
+                          'AWSELB=affinity')
+        self.assertEquals(self.server.connections, 1)
@@ -0,0 +1,141 @@
+"""Resumable downloads tests against a stub server"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.remote_file_system_client import CorruptedFile
+from nxdrive.client.remote_file_system_client import PartialDownload
+from nxdrive.tests.stub_server import StubNuxeoServer
+from nxdrive.tests.stub_server import StubResponse
+
+
+CONTENT = b'0123456789' * 10000
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d+)-$')
+
+
+class TestResumableDownloads(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubNuxeoServer()
+        self.server.register_operation('NuxeoDrive.GetFileSystemItem',
+                                       self.get_fs_item, params=('id',))
+        self.server.add_route('GET', 'nxbigfile/', self.download)
+        self.server.start()
+        self.content = CONTENT
+        self.digest = hashlib.md5(CONTENT).hexdigest()
+        self.accept_ranges = True
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests-downloads')
+        self.file_path = os.path.join(self.folder, u'File.bin')
+        self.part_path = os.path.join(self.folder, u'.File.bin.part')
+        self.client = RemoteFileSystemClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={})
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def get_fs_item(self, params, op_input):
+        return {
+            'id': params['id'], 'parentId': u'root', 'name': u'File.bin',
+            'path': u'/root/' + params['id'], 'folder': False,
+            'lastModificationDate': 0, 'digest': self.digest,
+            'digestAlgorithm': u'md5', 'canRename': True,
+            'canDelete': True, 'canUpdate': True,
+            'downloadURL': u'nxbigfile/default/' + params['id'],
+        }
+
+    def download(self, request):
+        match = RANGE_PATTERN.match(request.headers.get('Range', ''))
+        if match is None or not self.accept_ranges:
+            return StubResponse(body=self.content)
+        start = int(match.group(1))
+        if start >= len(self.content):
+            return StubResponse(status=416)
+        return StubResponse(status=206, body=self.content[start:], headers={
+            'Content-Range': 'bytes %d-%d/%d' % (
+                start, len(self.content) - 1, len(self.content))})
+
+    def get_downloads(self):
+        return [r for r in self.server.requests
+                if r.path.startswith('/nuxeo/nxbigfile/')]
+
+    def make_part(self, content):
+        with open(self.part_path, 'wb') as f:
+            f.write(content)
+
+    def test_resume(self):
+        saved = []
+        download = PartialDownload(digest=self.digest, on_save=lambda d:
+                                   saved.append((d.digest, d.size)))
+        self.make_part(CONTENT[:30000])
+        self.assertEquals(self.client.stream_content(
+            u'file', self.file_path, download=download), self.part_path)
+        with open(self.part_path, 'rb') as f:
+            self.assertEquals(f.read(), CONTENT)
+        request, = self.get_downloads()
+        self.assertEquals(request.headers['Range'], 'bytes=30000-')
+        self.assertEquals(request.headers['Accept-Encoding'], 'identity')
+        self.assertEquals(saved, [(self.digest, len(CONTENT))])
+        # The digest of the whole content is computed while downloading
+        self.assertEquals(download.content_digest, self.digest)
+        self.assertEquals(download.digest_algorithm, u'md5')
+
+        # Already complete: nothing is downloaded again
+        self.server.reset()
+        self.client.stream_content(u'file', self.file_path,
+                                   download=download)
+        self.assertEquals(self.get_downloads(), [])
+
+        self.assertEquals(download.content_digest, self.digest)
+
+        # Size unknown: the server tells there is nothing left
+        download.size = None
+        download.content_digest = None
+        self.client.stream_content(u'file', self.file_path,
+                                   download=download)
+        self.assertEquals(len(self.get_downloads()), 1)
+        self.assertEquals(download.content_digest, self.digest)
+        with open(self.part_path, 'rb') as f:
+            self.assertEquals(f.read(), CONTENT)
+
+    def test_no_range_support(self):
+        self.accept_ranges = False
+        self.make_part(CONTENT[:30000])
+        download = PartialDownload(digest=self.digest)
+        self.client.stream_content(u'file', self.file_path,
+                                   download=download)
+        with open(self.part_path, 'rb') as f:
+            self.assertEquals(f.read(), CONTENT)
+        self.assertEquals(download.size, len(CONTENT))
+
+    def test_remote_file_changed(self):
+        # The part file belongs to a former version of the remote file
+        self.make_part(b'X' * 30000)
+        download = PartialDownload(digest=u'former digest')
+        self.client.stream_content(u'file', self.file_path,
+                                   download=download)
+        request, = self.get_downloads()
+        self.assertFalse('Range' in request.headers)
+        self.assertEquals(download.digest, self.digest)
+        with open(self.part_path, 'rb') as f:
+            self.assertEquals(f.read(), CONTENT)
+
+    def test_corrupted_file(self):
+        self.make_part(b'X' * 30000)
+        download = PartialDownload(digest=self.digest)
+        self.assertRaises(CorruptedFile, self.client.stream_content,
+                          u'file', self.file_path, download=download)
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertEquals(download.digest, None)
+        self.assertEquals(download.content_digest, None)
+        # The next attempt downloads everything again
+        self.client.stream_content(u'file', self.file_path,
+                                   download=download)
+        self.assertFalse('Range' in self.get_downloads()[-1].headers)
+        self.assertEquals(download.content_digest, self.digest)
@@ -0,0 +1,879 @@
+"""Synchronization tests run against an in-memory fake server"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from nxdrive.client import LocalClient
+from nxdrive.client.bandwidth import DOWNLOAD
+from nxdrive.client.bandwidth import UPLOAD
+from nxdrive.client.local_client import FileInfo
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.tests.fake_remote import FakeFileSystem
+from nxdrive.tests.fake_remote import RoundTripRecorder
+from nxdrive.tests.fake_remote import install_fake_remote
+from nxdrive.tests.fake_remote import remove_tree
+from nxdrive.transfer import Transfer
+from nxdrive.transfer import TransferEngine
+
+
+class FakeSynchronizationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.local_test_folder = tempfile.mkdtemp(u'-nxdrive-tests-fake')
+        self.local_nxdrive_folder = os.path.join(
+            self.local_test_folder, u'Nuxeo Drive')
+        os.mkdir(self.local_nxdrive_folder)
+        self.nxdrive_conf_folder = os.path.join(
+            self.local_test_folder, u'nuxeo-drive-conf')
+        os.mkdir(self.nxdrive_conf_folder)
+
+        self.fs = FakeFileSystem()
+        self.workspace_id = self.fs.add_sync_root(u'Workspace')
+
+        self.controller = Controller(self.nxdrive_conf_folder, echo=False)
+        install_fake_remote(self.controller, self.fs)
+        self.sb = self.controller.bind_server(
+            self.local_nxdrive_folder, u'http://fake-server:8080/nuxeo/',
+            u'user', u'password')
+        self.syn = self.controller.synchronizer
+        self.local_client = LocalClient(
+            os.path.join(self.local_nxdrive_folder, u'Workspace'))
+
+    def tearDown(self):
+        self.controller.unbind_all()
+        self.controller.dispose()
+        remove_tree(self.local_test_folder)
+
+    def get_state(self, path):
+        session = self.controller.get_session()
+        return session.query(LastKnownState).filter_by(
+            local_folder=self.sb.local_folder,
+            local_path=u'/Workspace' + path).one()
+
+
+class TestFakeLocalMove(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeLocalMove, self).setUp()
+        fs = self.fs
+        self.folder_1_id = fs.add_folder(self.workspace_id, u'Folder 1')
+        self.folder_2_id = fs.add_folder(self.workspace_id, u'Folder 2')
+        self.sub_folder_id = fs.add_folder(self.folder_1_id, u'Sub-Folder')
+        self.file_1_id = fs.add_file(self.folder_1_id, u'File 1.txt',
+                                     b'Some content 1')
+        self.file_2_id = fs.add_file(self.sub_folder_id, u'File 2.txt',
+                                     b'Some content 2')
+        self.syn.update_synchronize_server(self.sb)
+        self.assertTrue(self.local_client.exists(
+            u'/Folder 1/Sub-Folder/File 2.txt'))
+
+    def test_local_move_folder_reuses_descendant_states(self):
+        local_client = self.local_client
+        local_client.move(u'/Folder 1', u'/Folder 2')
+        self.fs.reset_calls()
+
+        # Only the folder move is detected
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.assertEquals(self.fs.items[self.folder_1_id]['parentId'],
+                          self.folder_2_id)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.Move'), 1)
+
+        # The descendants are realigned without transferring any content nor
+        # rescanning the whole remote tree
+        self.assertEquals(self.fs.count_calls('download'), 0)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.GetChildren'), 1)
+
+        file_2 = self.get_state(u'/Folder 2/Folder 1/Sub-Folder/File 2.txt')
+        self.assertEquals(file_2.remote_ref, self.file_2_id)
+        self.assertEquals(file_2.pair_state, 'synchronized')
+        self.assertEquals(file_2.remote_parent_path,
+                          self.fs.items[self.sub_folder_id]['path'])
+        sub_folder = self.get_state(u'/Folder 2/Folder 1/Sub-Folder')
+        self.assertEquals(sub_folder.remote_ref, self.sub_folder_id)
+        self.assertEquals(sub_folder.pair_state, 'synchronized')
+
+        # Nothing left to do on the next pass
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 0)
+        self.assertEquals(len(self.fs.items), 7)
+        self.assertEquals(self.fs.count_calls('download'), 0)
+
+    def test_local_rename_folder_with_modified_child(self):
+        local_client = self.local_client
+        local_client.rename(u'/Folder 1', u'Renamed Folder')
+        local_client.update_content(u'/Renamed Folder/File 1.txt',
+                                    b'Updated content')
+
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.fs.items[self.folder_1_id]['name'],
+                          u'Renamed Folder')
+        self.assertEquals(self.fs.contents[self.file_1_id],
+                          b'Updated content')
+        file_1 = self.get_state(u'/Renamed Folder/File 1.txt')
+        self.assertEquals(file_1.pair_state, 'synchronized')
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 0)
+
+
+class TestFakeServerDown(FakeSynchronizationTestCase):
+
+    def test_circuit_open(self):
+        self.syn.update_synchronize_server(self.sb)
+        client = self.syn.get_remote_fs_client(self.sb)
+        breaker = self.controller.circuit_breakers.get(self.sb.server_url)
+        for _ in range(breaker.failure_threshold):
+            breaker.on_failure()
+        self.local_client.make_file(u'/', u'New File.txt', b'New content')
+        self.fs.reset_calls()
+
+        # Neither the server nor the local folder are scanned while the
+        # server is known to be down
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 0)
+        self.assertEquals(self.fs.calls, [])
+        session = self.controller.get_session()
+        self.assertEquals(session.query(LastKnownState).filter_by(
+            local_path=u'/Workspace/New File.txt').count(), 0)
+
+        # The same client resumes once the server is back
+        breaker.on_success()
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.assertTrue(self.syn.get_remote_fs_client(self.sb) is client)
+        self.assertEquals(self.get_state(u'/New File.txt').pair_state,
+                          'synchronized')
+
+
+class TestFakeServerBackpressure(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeServerBackpressure, self).setUp()
+        self.syn.update_synchronize_server(self.sb)
+        self.backpressure = self.syn.get_backpressure(self.sb)
+
+    def test_suggested_delay(self):
+        bindings = [self.sb]
+        self.assertEquals(self.syn._get_polling_delay(bindings, 5),
+                          (5, False))
+        self.assertEquals(self.syn._get_max_sync_step(self.backpressure,
+                                                      None), 10)
+        self.fs.suggested_delay = 30
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.syn._get_polling_delay(bindings, 5),
+                          (30, True))
+        self.assertEquals(self.syn._get_max_sync_step(self.backpressure,
+                                                      None), 2)
+
+        # Back to normal when the server stops suggesting a delay
+        self.fs.suggested_delay = None
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.syn._get_polling_delay(bindings, 5),
+                          (5, False))
+
+    def test_overloaded_server(self):
+        self.fs.retry_after = 3600
+        self.local_client.make_file(u'/', u'New File.txt', b'New content')
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 0)
+        self.assertTrue(self.backpressure.get_wait() > 3000)
+        # The local folder is still scanned
+        self.assertEquals(self.get_state(u'/New File.txt').remote_ref, None)
+
+        # The binding is not polled until the end of the requested delay
+        self.fs.retry_after = None
+        self.fs.reset_calls()
+        self.syn.loop(max_loops=0, delay=0)
+        self.assertEquals(self.fs.calls, [])
+        self.assertFalse('New File.txt' in
+                         [item['name'] for item in self.fs.items.values()])
+
+
+class TestFakeConcurrentTransfers(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeConcurrentTransfers, self).setUp()
+        self.syn._transfers = TransferEngine(3)
+        self.syn.update_synchronize_server(self.sb)
+
+    def tearDown(self):
+        self.syn._transfers.stop()
+        super(TestFakeConcurrentTransfers, self).tearDown()
+
+    def sync(self):
+        return self.syn.update_synchronize_server(self.sb, max_sync_step=100)
+
+    def test_concurrent_transfers(self):
+        for i in range(10):
+            self.fs.add_file(self.workspace_id, u'Remote %d.txt' % i,
+                             b'Remote content %d' % i)
+            self.local_client.make_file(u'/', u'Local %d.txt' % i,
+                                        b'Local content %d' % i)
+        self.assertEquals(self.sync(), 20)
+        self.assertEquals(self.syn._transfers.count_running(), 0)
+        for i in range(10):
+            self.assertEquals(self.local_client.get_content(
+                u'/Remote %d.txt' % i), b'Remote content %d' % i)
+            file_id = self.fs.find(u'Local %d.txt' % i, self.workspace_id)
+            self.assertEquals(self.fs.contents[file_id],
+                              b'Local content %d' % i)
+            self.assertEquals(self.get_state(u'/Local %d.txt' % i).pair_state,
+                              'synchronized')
+
+        # Concurrent updates in both directions
+        for i in range(10):
+            self.local_client.update_content(u'/Local %d.txt' % i,
+                                             b'Updated %d' % i)
+            self.fs.update_file(self.fs.find(u'Remote %d.txt' % i),
+                                b'Remotely updated %d' % i)
+        self.assertEquals(self.sync(), 20)
+        for i in range(10):
+            self.assertEquals(self.local_client.get_content(
+                u'/Remote %d.txt' % i), b'Remotely updated %d' % i)
+            self.assertEquals(self.fs.contents[self.fs.find(
+                u'Local %d.txt' % i)], b'Updated %d' % i)
+        self.assertEquals(self.sync(), 0)
+        self.assertEquals(len(self.fs.items), 22)
+
+    def test_slowed_down_server(self):
+        transfers = self.syn._transfers
+        self.assertEquals(self.syn._get_max_transfers(self.sb), None)
+        self.fs.suggested_delay = 30
+        self.sync()
+        self.assertEquals(self.syn._get_max_transfers(self.sb), 1)
+
+        # Record the transfers already running when a new one is admitted
+        running = []
+        submit = transfers.submit
+
+        def record_submit(transfer):
+            running.append(transfers.count_running())
+            return submit(transfer)
+
+        transfers.submit = record_submit
+        for i in range(6):
+            self.fs.add_file(self.workspace_id, u'Remote %d.txt' % i,
+                             b'Remote content %d' % i)
+        self.assertEquals(self.sync(), 6)
+        self.assertEquals(running, [0] * 6)
+
+
+class TestFakeLoop(FakeSynchronizationTestCase):
+
+    def test_workers_stopped_on_error(self):
+        self.syn.transfer_workers = 2
+        release = threading.Event()
+
+        def failing_update(*args, **kwargs):
+            self.syn._transfers.submit(Transfer(
+                1, release.wait, lambda doc_pair, transfer: None))
+            release.set()
+            raise RuntimeError("Unexpected error")
+
+        self.syn.update_synchronize_server = failing_update
+        self.assertRaises(RuntimeError, self.syn.loop, max_loops=0, delay=0)
+        self.assertEquals(self.syn._transfers._workers, [])
+        self.assertEquals([t for t in threading.enumerate()
+                           if t.name.startswith('TransferWorker')], [])
+
+
+class ThroughputFrontend(object):
+
+    def __init__(self):
+        self.throughputs = []
+
+    def notify_online(self, server_binding):
+        pass
+
+    def notify_pending(self, server_binding, n_pending, or_more=False):
+        pass
+
+    def notify_throughput(self, server_binding, upload_rate, download_rate):
+        self.throughputs.append((upload_rate, download_rate))
+
+
+class TestFakeBandwidthLimits(FakeSynchronizationTestCase):
+
+    def test_limits(self):
+        folder = self.sb.local_folder
+        self.controller.set_bandwidth_limits(folder, upload=1000,
+                                             off_hours_download=2000)
+        limiter = self.controller.get_bandwidth_limiter(self.sb)
+        self.assertEquals(limiter.limits.business,
+                          {UPLOAD: 1000, DOWNLOAD: None})
+        self.assertEquals(limiter.limits.off_hours,
+                          {UPLOAD: None, DOWNLOAD: 2000})
+        # The limits are persisted
+        self.controller.bandwidth_limiters.discard(folder)
+        limiter = self.controller.get_bandwidth_limiter(self.sb)
+        self.assertEquals(limiter.limits.off_hours[DOWNLOAD], 2000)
+
+        # The running transfers follow the new limits
+        self.controller.set_bandwidth_limits(folder)
+        self.assertEquals(limiter.limits.business,
+                          {UPLOAD: None, DOWNLOAD: None})
+
+    def test_throughput(self):
+        frontend = ThroughputFrontend()
+        self.syn.register_frontend(frontend)
+        limiter = self.controller.get_bandwidth_limiter(self.sb)
+        limiter.throttle(DOWNLOAD, 5000)
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(frontend.throughputs[-1], (0, 1000))
+
+
+class TestFakeChunkedUploads(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeChunkedUploads, self).setUp()
+        self.syn.update_synchronize_server(self.sb)
+        self.syn.get_remote_fs_client(self.sb).upload_chunk_size = 10
+
+    def test_resume_interrupted_upload(self):
+        content = b'0123456789' * 5 + b'0123'
+        self.local_client.make_file(u'/', u'Big File.txt', content)
+        self.fs.failing_chunks.add(3)
+        self.fs.reset_calls()
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 0)
+        self.assertEquals(self.fs.count_calls('batch/upload'), 4)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 0)
+        pair = self.get_state(u'/Big File.txt')
+        self.assertEquals(pair.pair_state, 'locally_created')
+        self.assertEquals(pair.upload_state.uploaded_chunks, 3)
+        self.assertEquals(pair.upload_state.file_size, len(content))
+
+        # Only the missing chunks are sent
+        self.fs.reset_calls()
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.assertEquals(self.fs.count_calls('batch/upload'), 3)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 1)
+        file_id = self.fs.find(u'Big File.txt', self.workspace_id)
+        self.assertEquals(self.fs.contents[file_id], content)
+        pair = self.get_state(u'/Big File.txt')
+        self.assertEquals(pair.pair_state, 'synchronized')
+        self.assertEquals(pair.upload_state, None)
+
+    def test_progress_saved_by_synchronization_thread(self):
+        self.syn._transfers = TransferEngine(2)
+        self.addCleanup(self.syn._transfers.stop)
+        threads = []
+        save_upload_state = self.syn._save_upload_state
+
+        def record_save(*args):
+            threads.append(threading.current_thread())
+            return save_upload_state(*args)
+
+        self.syn._save_upload_state = record_save
+        self.local_client.make_file(u'/', u'Big File.txt', b'0123456789' * 5)
+        self.fs.failing_chunks.add(3)
+        self.syn.update_synchronize_server(self.sb)
+        # The workers do not write to the database themselves
+        self.assertEquals(len(threads), 4)
+        self.assertEquals(set(threads), set([threading.current_thread()]))
+        pair = self.get_state(u'/Big File.txt')
+        self.assertEquals(pair.upload_state.uploaded_chunks, 3)
+
+    def test_file_changed_during_upload(self):
+        self.local_client.make_file(u'/', u'Big File.txt', b'A' * 35)
+        self.fs.failing_chunks.add(2)
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(
+            self.get_state(u'/Big File.txt').upload_state.uploaded_chunks, 2)
+
+        # The upload starts over with the new content
+        self.local_client.update_content(u'/Big File.txt', b'B' * 35)
+        self.fs.reset_calls()
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.assertEquals(self.fs.count_calls('batch/upload'), 4)
+        file_id = self.fs.find(u'Big File.txt', self.workspace_id)
+        self.assertEquals(self.fs.contents[file_id], b'B' * 35)
+
+    def test_file_modified_while_uploaded(self):
+        self.local_client.make_file(u'/', u'Big File.txt', b'A' * 35)
+        client = self.syn.get_remote_fs_client(self.sb)
+        upload_body = client.upload_body
+
+        def modify_file(*args, **kwargs):
+            result = upload_body(*args, **kwargs)
+            if kwargs.get('chunk_index') == 0:
+                client.upload_body = upload_body
+                self.local_client.update_content(u'/Big File.txt',
+                                                 b'B' * 35)
+            return result
+
+        client.upload_body = modify_file
+        self.fs.reset_calls()
+        self.syn.update_synchronize_server(self.sb)
+        # The torn content is detected and uploaded again
+        file_id = self.fs.find(u'Big File.txt', self.workspace_id)
+        self.assertEquals(self.fs.contents[file_id], b'B' * 35)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 1)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.UpdateFile'), 1)
+        # The remote state is taken from the responses of the operations:
+        # the file system item is only fetched to refresh the pair before
+        # uploading it again
+        self.assertEquals(
+            self.fs.count_calls('NuxeoDrive.GetFileSystemItem'), 1)
+        pair = self.get_state(u'/Big File.txt')
+        self.assertEquals(pair.pair_state, 'synchronized')
+        self.assertEquals(pair.remote_digest, pair.local_digest)
+
+
+class TestFakeResumableDownloads(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeResumableDownloads, self).setUp()
+        self.syn.update_synchronize_server(self.sb)
+        self.content = b'0123456789' * 100
+        self.file_id = self.fs.add_file(self.workspace_id, u'Big File.txt',
+                                        self.content)
+        self.part_path = os.path.join(self.local_client.base_folder,
+                                      u'.Big File.txt.part')
+
+    def test_resume_interrupted_download(self):
+        self.fs.interrupted_downloads[self.file_id] = 300
+        self.syn.update_synchronize_server(self.sb)
+        self.assertFalse(self.local_client.exists(u'/Big File.txt'))
+        self.assertEquals(os.path.getsize(self.part_path), 300)
+        state = self.get_remote_state().download_state
+        self.assertEquals(state.remote_digest,
+                          self.fs.to_fs_item(self.file_id)['digest'])
+        self.assertEquals(state.file_size, len(self.content))
+
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.assertEquals(self.local_client.get_content(u'/Big File.txt'),
+                          self.content)
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertEquals(self.get_state(u'/Big File.txt').download_state,
+                          None)
+
+    def test_remote_update_during_download(self):
+        self.fs.interrupted_downloads[self.file_id] = 300
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(os.path.getsize(self.part_path), 300)
+
+        # The part file is downloaded again from the start
+        self.fs.update_file(self.file_id, b'Updated content')
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.assertEquals(self.local_client.get_content(u'/Big File.txt'),
+                          b'Updated content')
+
+    def test_digest_computed_while_downloading(self):
+        digested = []
+        get_digest = FileInfo.get_digest
+
+        def record_get_digest(info):
+            if not info.folderish and info._digest is None:
+                digested.append(info.path)
+            return get_digest(info)
+
+        FileInfo.get_digest = record_get_digest
+        self.addCleanup(setattr, FileInfo, 'get_digest', get_digest)
+
+        # Created then updated: the downloaded files are never read again
+        self.fs.interrupted_downloads[self.file_id] = 300
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.fs.update_file(self.file_id, b'Updated content')
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 1)
+        self.assertEquals(digested, [])
+        pair = self.get_state(u'/Big File.txt')
+        self.assertEquals(pair.pair_state, 'synchronized')
+        self.assertEquals(pair.local_digest,
+                          self.fs.to_fs_item(self.file_id)['digest'])
+
+    def get_remote_state(self):
+        session = self.controller.get_session()
+        return session.query(LastKnownState).filter_by(
+            remote_ref=self.file_id).one()
+
+
+class TestFakeConcurrentChanges(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeConcurrentChanges, self).setUp()
+        self.file_id = self.fs.add_file(self.workspace_id, u'Doc.txt',
+                                        b'Initial content')
+        self.syn.update_synchronize_server(self.sb)
+        self.client = self.syn.get_remote_fs_client(self.sb)
+
+    def on_transfer(self, name, change):
+        """Call change once the next call to the client method is done"""
+        method = getattr(self.client, name)
+
+        def transfer(*args, **kwargs):
+            setattr(self.client, name, method)
+            result = method(*args, **kwargs)
+            change()
+            return result
+
+        setattr(self.client, name, transfer)
+
+    def update_remotely(self, content):
+        # Also scanned while being transferred, as by the next
+        # synchronization steps
+        self.fs.update_file(self.file_id, content)
+        self.syn.scan_remote(self.sb)
+
+    def test_remote_update_during_download(self):
+        self.fs.update_file(self.file_id, b'Updated content')
+        self.on_transfer('stream_content', lambda: self.update_remotely(
+            b'Updated again'))
+        self.fs.reset_calls()
+        self.syn.update_synchronize_server(self.sb)
+        # The outdated content is dropped, then downloaded again
+        self.assertEquals(self.local_client.get_content(u'/Doc.txt'),
+                          b'Updated again')
+        self.assertEquals(
+            [i.name for i in self.local_client.get_children_info(u'/')],
+            [u'Doc.txt'])
+        self.assertEquals(self.fs.count_calls('download'), 2)
+        pair = self.get_state(u'/Doc.txt')
+        self.assertEquals(pair.pair_state, 'synchronized')
+        self.assertEquals(pair.local_digest, pair.remote_digest)
+
+    def test_local_update_during_download(self):
+        self.fs.update_file(self.file_id, b'Updated content')
+        self.on_transfer('stream_content', lambda: (
+            self.local_client.update_content(u'/Doc.txt', b'Local edit')))
+        self.syn.update_synchronize_server(self.sb)
+        # The local edit is kept aside as a conflict
+        self.assertEquals(self.local_client.get_content(u'/Doc.txt'),
+                          b'Updated content')
+        self.assertEquals(
+            self.local_client.get_content(u'/Doc.txt (conflicted)'),
+            b'Local edit')
+
+    def test_remote_update_during_upload(self):
+        self.local_client.update_content(u'/Doc.txt', b'Local edit')
+        self.on_transfer('stream_update', lambda: self.update_remotely(
+            b'Remote edit'))
+        self.syn.scan_local(self.sb)
+        self.syn.synchronize(self.sb, limit=1)
+        pair = self.get_state(u'/Doc.txt')
+        self.assertEquals(pair.pair_state, 'conflicted')
+        self.assertNotEquals(pair.local_digest, pair.remote_digest)
+
+        # Both sides are compared again with the server
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.local_client.get_content(u'/Doc.txt'),
+                          b'Remote edit')
+        self.assertEquals(
+            self.local_client.get_content(u'/Doc.txt (conflicted)'),
+            b'Local edit')
+
+
+class TestFakeLocalCopies(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeLocalCopies, self).setUp()
+        self.content = b'Template content ' * 100
+        self.fs.add_file(self.workspace_id, u'Template.txt', self.content)
+        self.folder_id = self.fs.add_folder(self.workspace_id, u'Copies')
+        self.syn.update_synchronize_server(self.sb)
+        self.fs.reset_calls()
+
+    def test_remotely_created_copy(self):
+        self.fs.add_file(self.folder_id, u'Copy.txt', self.content)
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.local_client.get_content(u'/Copies/Copy.txt'),
+                          self.content)
+        self.assertEquals(self.fs.count_calls('download'), 0)
+        self.assertEquals(self.syn.bytes_saved,
+                          {self.sb.local_folder: len(self.content)})
+        pair = self.get_state(u'/Copies/Copy.txt')
+        self.assertEquals(pair.pair_state, 'synchronized')
+        self.assertEquals(pair.local_digest, pair.remote_digest)
+
+    def test_remotely_modified_to_known_content(self):
+        file_id = self.fs.add_file(self.folder_id, u'Draft.txt', b'Draft')
+        self.syn.update_synchronize_server(self.sb)
+        self.fs.reset_calls()
+        self.fs.update_file(file_id, self.content)
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(
+            self.local_client.get_content(u'/Copies/Draft.txt'),
+            self.content)
+        self.assertEquals(self.fs.count_calls('download'), 0)
+        self.assertEquals(self.get_state(u'/Copies/Draft.txt').pair_state,
+                          'synchronized')
+
+    def test_part_file_left_as_is(self):
+        file_id = self.fs.add_file(self.folder_id, u'Draft.txt', b'Draft')
+        self.syn.update_synchronize_server(self.sb)
+        # Left by an interrupted download of another content
+        folder = os.path.join(self.local_client.base_folder, u'Copies')
+        part_path = os.path.join(folder, u'.Draft.txt.part')
+        with open(part_path, 'wb') as f:
+            f.write(b'Other draft')
+
+        # Copied to its own temporary file, next to the part file
+        self.fs.update_file(file_id, self.content)
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(
+            self.local_client.get_content(u'/Copies/Draft.txt'),
+            self.content)
+        self.assertEquals(self.fs.count_calls('download'), 1)
+        with open(part_path, 'rb') as f:
+            self.assertEquals(f.read(), b'Other draft')
+        self.assertEquals(sorted(os.listdir(folder)),
+                          [u'.Draft.txt.part', u'Draft.txt'])
+
+    def test_source_changed_since_scanned(self):
+        # Modified without changing its modification time: the stale
+        # digest of the pair does not match its content anymore
+        path = os.path.join(self.local_client.base_folder, u'Template.txt')
+        mtime = os.path.getmtime(path)
+        self.local_client.update_content(u'/Template.txt', b'Other content')
+        os.utime(path, (mtime, mtime))
+
+        self.fs.add_file(self.folder_id, u'Copy.txt', self.content)
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.local_client.get_content(u'/Copies/Copy.txt'),
+                          self.content)
+        self.assertEquals(self.fs.count_calls('download'), 1)
+        self.assertEquals(self.syn.bytes_saved, {})
+        self.assertFalse(os.path.exists(os.path.join(
+            self.local_client.base_folder, u'Copies', u'.Copy.txt.part')))
+
+
+class TestFakeRemoteCopies(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeRemoteCopies, self).setUp()
+        self.content = b'Project content ' * 100
+        self.file_id = self.fs.add_file(self.workspace_id, u'Project.txt',
+                                        self.content)
+        folder_id = self.fs.add_folder(self.workspace_id, u'Project')
+        self.fs.add_file(folder_id, u'Spec.txt', b'Specifications')
+        self.fs.add_file(folder_id, u'Plan.txt', b'Plan')
+        self.syn.update_synchronize_server(self.sb)
+        self.fs.reset_calls()
+        self.base_folder = self.local_client.base_folder
+
+    def test_local_copy_of_file(self):
+        shutil.copy(os.path.join(self.base_folder, u'Project.txt'),
+                    os.path.join(self.base_folder, u'Project copy.txt'))
+        self.syn.update_synchronize_server(self.sb)
+        copy_id = self.fs.find(u'Project copy.txt')
+        self.assertEquals(self.fs.contents[copy_id], self.content)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 0)
+        self.assertEquals(self.fs.count_calls('Document.Copy'), 1)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.Rename'), 1)
+        pair = self.get_state(u'/Project copy.txt')
+        self.assertEquals(pair.pair_state, 'synchronized')
+        self.assertEquals(pair.remote_ref, copy_id)
+
+    def test_local_copy_of_folder(self):
+        shutil.copytree(os.path.join(self.base_folder, u'Project'),
+                        os.path.join(self.base_folder, u'Project 2'))
+        self.syn.update_synchronize_server(self.sb)
+        folder_id = self.fs.find(u'Project 2')
+        self.assertEquals(
+            [self.fs.contents[i] for i in self.fs.children_ids(folder_id)],
+            [b'Plan', b'Specifications'])
+        # Metadata calls only
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 0)
+        self.assertEquals(self.fs.count_calls('Document.Copy'), 2)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.Rename'), 0)
+        self.assertEquals(self.get_state(u'/Project 2/Plan.txt').pair_state,
+                          'synchronized')
+
+    def test_remote_source_changed(self):
+        # Changed without the synchronizer knowing yet
+        self.fs.contents[self.file_id] = b'Changed content'
+        shutil.copy(os.path.join(self.base_folder, u'Project.txt'),
+                    os.path.join(self.base_folder, u'Project copy.txt'))
+        self.syn.update_synchronize_server(self.sb)
+        copy_id = self.fs.find(u'Project copy.txt')
+        self.assertEquals(self.fs.contents[copy_id], self.content)
+        self.assertEquals(self.fs.count_calls('Document.Copy'), 1)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.Delete'), 1)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 1)
+        self.assertEquals(len(self.fs.children_ids(self.workspace_id)), 3)
+
+
+class TestFakeBulkCreations(FakeSynchronizationTestCase):
+
+    def setUp(self):
+        super(TestFakeBulkCreations, self).setUp()
+        self.syn.bulk_upload_max_size = 100
+        self.syn.update_synchronize_server(self.sb)
+        self.fs.reset_calls()
+
+    def make_files(self, n, prefix=u'Small'):
+        for i in range(n):
+            self.local_client.make_file(u'/', u'%s %d.txt' % (prefix, i),
+                                        b'Content %d' % i)
+
+    def test_burst_of_small_files(self):
+        self.make_files(10)
+        self.local_client.make_file(u'/', u'Large.bin', b'x' * 1000)
+        self.assertEquals(self.syn.update_synchronize_server(
+            self.sb, max_sync_step=100), 11)
+        # A single request for the small files, the large one on its own
+        self.assertEquals(self.fs.count_calls('FileManager.Import'), 1)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 1)
+        self.assertEquals(self.fs.count_calls('batch/upload'), 0)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.GetChildren'), 0)
+        for i in range(10):
+            pair = self.get_state(u'/Small %d.txt' % i)
+            self.assertEquals(pair.pair_state, 'synchronized')
+            self.assertEquals(pair.remote_ref,
+                              self.fs.find(u'Small %d.txt' % i))
+            self.assertEquals(self.fs.contents[pair.remote_ref],
+                              b'Content %d' % i)
+            self.assertEquals(pair.remote_digest, pair.local_digest)
+            self.assertNotEquals(pair.last_remote_updated, None)
+
+        # Nothing left to do with the next changes
+        self.fs.reset_calls()
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 0)
+        self.assertEquals(self.fs.count_calls('download'), 0)
+        self.assertEquals(self.fs.count_calls('batch/upload'), 0)
+        self.assertEquals(len(self.fs.items), 13)
+
+    def test_burst_larger_than_inline_size(self):
+        self.syn.get_remote_fs_client(self.sb).inline_upload_max_size = 50
+        self.make_files(10)
+        self.assertEquals(self.syn.update_synchronize_server(
+            self.sb, max_sync_step=100), 10)
+        # Uploaded in one batch first
+        self.assertEquals(self.fs.count_calls('batch/upload'), 10)
+        self.assertEquals(self.fs.count_calls('FileManager.Import'), 1)
+        for i in range(10):
+            pair = self.get_state(u'/Small %d.txt' % i)
+            self.assertEquals(pair.pair_state, 'synchronized')
+            self.assertEquals(self.fs.contents[pair.remote_ref],
+                              b'Content %d' % i)
+
+    def test_batch_size(self):
+        self.syn.bulk_upload_max_files = 4
+        self.make_files(10)
+        self.assertEquals(self.syn.update_synchronize_server(
+            self.sb, max_sync_step=100), 10)
+        self.assertEquals(self.fs.count_calls('FileManager.Import'), 3)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 0)
+        self.assertEquals(self.syn.update_synchronize_server(self.sb), 0)
+
+    def test_imported_document_not_found(self):
+        client = self.syn.get_remote_fs_client(self.sb)
+        get_info = client.get_info
+
+        def get_info_but_one(fs_item_id, **kwargs):
+            if self.fs.items[fs_item_id]['name'] == u'Small 1.txt':
+                return None
+            return get_info(fs_item_id, **kwargs)
+
+        client.get_info = get_info_but_one
+        self.make_files(3)
+        self.syn.update_synchronize_server(self.sb, max_sync_step=100)
+        self.assertEquals(self.fs.count_calls('FileManager.Import'), 1)
+        for i in (0, 2):
+            self.assertEquals(self.get_state(u'/Small %d.txt' % i).pair_state,
+                              'synchronized')
+        # Only the unresolved pair fails
+        pair = self.get_state(u'/Small 1.txt')
+        self.assertEquals(pair.remote_ref, None)
+        self.assertNotEquals(pair.last_sync_error_date, None)
+
+        # Bound to its document by the next scan, not created again
+        client.get_info = get_info
+        self.syn.error_skip_period = 0
+        self.syn.update_synchronize_server(self.sb)
+        pair = self.get_state(u'/Small 1.txt')
+        self.assertEquals(pair.pair_state, 'synchronized')
+        self.assertEquals(pair.remote_ref, self.fs.find(u'Small 1.txt'))
+        self.assertEquals(self.fs.count_calls('FileManager.Import'), 1)
+        self.assertEquals(self.fs.count_calls('NuxeoDrive.CreateFile'), 0)
+        self.assertEquals(len(self.fs.children_ids(self.workspace_id)), 3)
+
+    def test_concurrent_bulk_creations(self):
+        self.syn._transfers = TransferEngine(3)
+        self.addCleanup(self.syn._transfers.stop)
+        self.syn.bulk_upload_max_files = 4
+        self.make_files(10)
+        self.assertEquals(self.syn.update_synchronize_server(
+            self.sb, max_sync_step=100), 10)
+        # The files being created are not picked twice
+        self.assertTrue(self.fs.count_calls('FileManager.Import') >= 2)
+        self.assertEquals(len(self.fs.children_ids(self.workspace_id)), 10)
+        for i in range(10):
+            self.assertEquals(self.get_state(u'/Small %d.txt' % i).pair_state,
+                              'synchronized')
+
+
+GET_INFO = 'NuxeoDrive.GetFileSystemItem'
+
+
+class TestFakeRoundTrips(FakeSynchronizationTestCase):
+    """Automation calls made by each synchronization handler
+
+    Each handler is given the remote info refreshed by synchronize_one and
+    is expected to stick to the listed calls: any additional round trip is
+    a regression.
+    """
+
+    def setUp(self):
+        super(TestFakeRoundTrips, self).setUp()
+        self.folder_id = self.fs.add_folder(self.workspace_id, u'Folder')
+        self.file_id = self.fs.add_file(self.workspace_id, u'File.txt',
+                                        b'Some content')
+        self.syn.update_synchronize_server(self.sb)
+        self.recorder = RoundTripRecorder(self.syn, self.fs)
+
+    def assertRoundTrips(self, expected):
+        self.recorder.reset()
+        self.syn.update_synchronize_server(self.sb)
+        self.assertEquals(self.recorder.rounds, expected)
+
+    def test_remotely_created(self):
+        self.fs.add_file(self.folder_id, u'New File.txt', b'New content')
+        self.assertRoundTrips([
+            ('_synchronize_remotely_created', [GET_INFO, 'download'])])
+        self.fs.add_folder(self.folder_id, u'New Folder')
+        self.assertRoundTrips([
+            ('_synchronize_remotely_created',
+             [GET_INFO, 'NuxeoDrive.GetChildren'])])
+
+    def test_remotely_modified(self):
+        self.fs.update_file(self.file_id, b'Updated content')
+        self.assertRoundTrips([
+            ('_synchronize_remotely_modified', [GET_INFO, 'download'])])
+        self.fs.rename(self.file_id, u'Renamed File.txt')
+        self.assertRoundTrips([('_synchronize_remotely_modified',
+                                [GET_INFO])])
+
+    def test_remotely_deleted(self):
+        self.fs.delete(self.file_id)
+        self.assertRoundTrips([('_synchronize_remotely_deleted',
+                                [GET_INFO])])
+
+    def test_locally_created(self):
+        self.local_client.make_folder(u'/Folder', u'New Folder')
+        self.assertRoundTrips([('_synchronize_locally_created',
+                                ['NuxeoDrive.CreateFolder'])])
+        self.local_client.make_file(u'/Folder', u'New File.txt',
+                                    b'New content')
+        self.assertRoundTrips([
+            ('_synchronize_locally_created', ['NuxeoDrive.CreateFile'])])
+
+    def test_locally_modified(self):
+        self.local_client.update_content(u'/File.txt', b'Updated content')
+        self.assertRoundTrips([
+            ('_synchronize_locally_modified',
+             [GET_INFO, 'NuxeoDrive.UpdateFile'])])
+
+    def test_locally_deleted(self):
+        self.local_client.delete(u'/File.txt')
+        self.assertRoundTrips([
+            ('_synchronize_locally_deleted', [GET_INFO, 'NuxeoDrive.Delete'])])
+
+    def test_local_rename(self):
+        self.local_client.rename(u'/File.txt', u'Renamed File.txt')
+        self.recorder.reset()
+        self.syn.update_synchronize_server(self.sb)
+        # The source and the target pairs are resolved by a single rename,
+        # whichever comes first
+        calls = [call for _, calls in self.recorder.rounds
+                 for call in calls]
+        self.assertEquals(calls, [GET_INFO, 'NuxeoDrive.Rename'])
+        self.assertEquals(self.fs.items[self.file_id]['name'],
+                          u'Renamed File.txt')
@@ -226,6 +226,30 @@ class TestIntegrationRemoteFileSystemClient(IntegrationTestCase):
         remote_client.delete(fs_item_id)
         self.assertFalse(remote_client.exists(fs_item_id))
 
+    def test_copy(self):
+        remote_client = self.remote_file_system_client_1
+
+        # Create a file and a folder
+        fs_item_id = remote_client.make_file(self.workspace_id,
+            'Document 1.txt', "Content of doc 1.")
+        folder_id = remote_client.make_folder(self.workspace_id, 'Folder 1')
+
+        # Copy the file server side, renamed
+        copy_info = remote_client.copy(fs_item_id, folder_id,
+                                       name='Document 2.txt')
+        self.assertNotEquals(copy_info.uid, fs_item_id)
+        self.assertEquals(copy_info.parent_uid, folder_id)
+        self.assertEquals(copy_info.name, 'Document 2.txt')
+        self.assertEquals(copy_info.digest,
+                          remote_client.get_info(fs_item_id).digest)
+        self.assertEquals(remote_client.get_content(copy_info.uid),
+            "Content of doc 1.")
+
+        # Items not backed by documents cannot be copied into
+        toplevel_folder_info = remote_client.get_filesystem_root_info()
+        self.assertEquals(remote_client.copy(fs_item_id,
+                                             toplevel_folder_info.uid), None)
+
     def test_exists(self):
         remote_client = self.remote_file_system_client_1
 
@@ -326,8 +350,10 @@ class TestIntegrationRemoteFileSystemClient(IntegrationTestCase):
 
         # Create a document by streaming a text file
         file_path = remote_client.make_tmp_file("Some content.")
-        fs_item_id = remote_client.stream_file(self.workspace_id, file_path,
-                                               filename='My streamed file.txt')
+        fs_item_info = remote_client.stream_file(
+            self.workspace_id, file_path, filename='My streamed file.txt')
+        fs_item_id = fs_item_info.uid
+        self.assertEquals(fs_item_info.name, 'My streamed file.txt')
         self.assertEquals(remote_client.get_info(fs_item_id).name,
                         'My streamed file.txt')
         self.assertEquals(remote_client.get_content(fs_item_id),
@@ -335,8 +361,11 @@ class TestIntegrationRemoteFileSystemClient(IntegrationTestCase):
 
         # Update a document by streaming a new text file
         file_path = remote_client.make_tmp_file("Other content.")
-        remote_client.stream_update(fs_item_id, file_path,
-                                    filename='My updated file.txt')
+        fs_item_info = remote_client.stream_update(
+            fs_item_id, file_path, filename='My updated file.txt')
+        self.assertEquals(fs_item_info.digest,
+                          self._get_digest(fs_item_info.digest_algorithm,
+                                           "Other content."))
         self.assertEquals(remote_client.get_info(fs_item_id).name,
                         'My updated file.txt')
         self.assertEquals(remote_client.get_content(fs_item_id),
@@ -345,7 +374,8 @@ class TestIntegrationRemoteFileSystemClient(IntegrationTestCase):
         # Create a document by streaming a binary file
         file_path = os.path.join(self.upload_tmp_dir, 'testFile.pdf')
         copyfile('nxdrive/tests/resources/testFile.pdf', file_path)
-        fs_item_id = remote_client.stream_file(self.workspace_id, file_path)
+        fs_item_id = remote_client.stream_file(self.workspace_id,
+                                               file_path).uid
         local_client = LocalClient(self.upload_tmp_dir)
         fs_item_info = remote_client.get_info(fs_item_id)
         self.assertEquals(fs_item_info.name, 'testFile.pdf')
@@ -0,0 +1,54 @@
+"""JSON codec selection tests"""
+import sys
+import types
+import unittest
+
+from nxdrive.client import json_codec
+
+
+PAYLOAD = (u'{"id": "defaultFileSystemItemFactory#default#1",'
+           u' "name": "\\u00e9t\\u00e9.odt", "folder": false,'
+           u' "lastModificationDate": 1400000000000,'
+           u' "downloadURL": "nxbigfile/default/1/blobholder:0/file.odt"}')
+
+
+class TestJSONCodec(unittest.TestCase):
+
+    def get_codecs(self):
+        codecs = []
+        for name, _ in json_codec.CODECS:
+            try:
+                codecs.append(json_codec.get_codec([name]))
+            except ValueError:
+                pass
+        return codecs
+
+    def test_stdlib_fallback(self):
+        self.assertEquals(json_codec.get_codec(['json']).name, 'json')
+        self.assertRaises(ValueError, json_codec.get_codec, ['unknown'])
+
+    def test_old_ujson(self):
+        # No escape_forward_slashes before ujson 1.34
+        old_ujson = types.ModuleType('ujson')
+        old_ujson.loads = lambda s: None
+        old_ujson.dumps = lambda obj, ensure_ascii=True: ''
+        saved = sys.modules.get('ujson')
+        sys.modules['ujson'] = old_ujson
+        try:
+            self.assertEquals(json_codec.get_codec().name, 'json')
+        finally:
+            if saved is None:
+                del sys.modules['ujson']
+            else:
+                sys.modules['ujson'] = saved
+
+    def test_codecs_consistency(self):
+        reference = json_codec.get_codec(['json'])
+        expected = reference.loads(PAYLOAD)
+        for codec in self.get_codecs():
+            value = codec.loads(PAYLOAD)
+            self.assertEquals(value, expected)
+            self.assertTrue(isinstance(value['id'], unicode))
+            self.assertEquals(reference.loads(codec.dumps(value)), expected)
+            self.assertTrue('/' in codec.dumps(value))
+            self.assertRaises(ValueError, codec.loads, '{"truncated": ')
@@ -0,0 +1,50 @@
+"""Lazy trace logging tests"""
+import logging
+import unittest
+
+from nxdrive.logging_config import TRACE
+from nxdrive.logging_config import get_logger
+from nxdrive.logging_config import lazy
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self, level=TRACE)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestLazyLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.log = get_logger('nxdrive.tests.lazy')
+        self.handler = RecordingHandler()
+        self.log.addHandler(self.handler)
+        self.calls = []
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+        self.log.setLevel(logging.NOTSET)
+
+    def expensive(self, value):
+        self.calls.append(value)
+        return value
+
+    def test_disabled_trace(self):
+        self.log.setLevel(logging.DEBUG)
+        self.log.trace("Value: %r", lazy(self.expensive, u'value'))
+        self.assertEquals(self.calls, [])
+        self.assertEquals(self.handler.messages, [])
+
+    def test_enabled_trace(self):
+        self.log.setLevel(TRACE)
+        self.log.trace("Value: %r, %s", lazy(self.expensive, u'value'),
+                       lazy(self.expensive, u'\xe9t\xe9'))
+        self.assertEquals(self.calls, [u'value', u'\xe9t\xe9'])
+        self.assertEquals(self.handler.messages,
+                          ["Value: u'value', \xc3\xa9t\xc3\xa9"])
+        self.log.trace(u"Unicode: %s", lazy(self.expensive, u'\xe9t\xe9'))
+        self.assertEquals(self.handler.messages[-1], u"Unicode: \xe9t\xe9")
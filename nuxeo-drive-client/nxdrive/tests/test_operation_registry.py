@@ -0,0 +1,118 @@
+"""Operation registry cache tests against a stub server"""
+import shutil
+import tempfile
+import unittest
+
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.operation_registry import OperationRegistry
+from nxdrive.client.operation_registry import OperationRegistryCache
+from nxdrive.tests.stub_server import StubNuxeoServer
+
+
+class TestOperationRegistryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_folder = tempfile.mkdtemp(u'-nxdrive-tests-registry')
+        self.server = StubNuxeoServer()
+        self.server.register_operation(
+            'Stub.Ping', lambda params, op_input: {'pong': True},
+            optional=['value'])
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_folder)
+
+    def get_client(self, cache, version=u'1.0'):
+        return RemoteDocumentClient(
+            self.server.url, u'user', u'device', version, password=u'secret',
+            proxies={}, registry_cache=cache)
+
+    def count_registry_requests(self):
+        return len([r for r in self.server.requests
+                    if r.method == 'GET' and r.operation is None])
+
+    def test_shared_registry(self):
+        cache = OperationRegistryCache(self.cache_folder)
+        client_1 = self.get_client(cache)
+        self.assertEquals(self.count_registry_requests(), 1)
+        client_2 = self.get_client(cache)
+        self.assertEquals(self.count_registry_requests(), 1)
+        self.assertTrue('Stub.Ping' in client_2.operations)
+        self.assertEquals(client_2.execute('Stub.Ping'), {'pong': True})
+
+        # Persisted across restarts
+        client_3 = self.get_client(OperationRegistryCache(self.cache_folder))
+        self.assertEquals(self.count_registry_requests(), 1)
+        self.assertEquals(client_3.operations, client_1.operations)
+
+        # Client upgrades invalidate the cached registry
+        self.get_client(OperationRegistryCache(self.cache_folder),
+                        version=u'2.0')
+        self.assertEquals(self.count_registry_requests(), 2)
+
+    def test_lazy_refresh(self):
+        cache = OperationRegistryCache(self.cache_folder)
+        self.get_client(cache)
+
+        # Server upgrade with a new operation and a new parameter
+        self.server.register_operation(
+            'Stub.New', lambda params, op_input: {'new': True})
+        self.server.register_operation(
+            'Stub.Ping', lambda params, op_input: {'pong': True},
+            optional=['value', 'other'])
+
+        client = self.get_client(cache)
+        self.assertEquals(self.count_registry_requests(), 1)
+        self.assertEquals(client.execute('Stub.New'), {'new': True})
+        self.assertEquals(self.count_registry_requests(), 2)
+        self.assertEquals(client.execute('Stub.Ping', other=u'value'),
+                          {'pong': True})
+        self.assertEquals(self.count_registry_requests(), 2)
+
+        # Actually unknown operations are still rejected without fetching
+        # the up to date registry again
+        self.assertRaises(ValueError, client.execute, 'Stub.Unknown')
+        self.assertEquals(self.count_registry_requests(), 2)
+        client = self.get_client(cache)
+        self.assertTrue('Stub.New' in client.operations)
+        self.assertEquals(self.count_registry_requests(), 2)
+
+
+class TestOperationRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = OperationRegistry([{
+            'id': 'Document.Query',
+            'params': [
+                {'name': 'query', 'type': 'string', 'required': True},
+                {'name': 'pageSize', 'type': 'integer', 'required': False},
+                {'name': 'sortOrder', 'type': 'stringlist',
+                 'required': False},
+                {'name': 'value', 'type': 'serializable',
+                 'required': False},
+            ],
+        }])
+
+    def test_check_params(self):
+        check = self.registry.check_params
+        check('Document.Query', {'query': u'SELECT * FROM Document'})
+        check('Document.Query', {'query': u'SELECT * FROM Document',
+                                 'pageSize': 10, 'sortOrder': None,
+                                 'value': object()})
+        self.assertRaises(ValueError, check, 'Document.Unknown', {})
+        self.assertRaises(ValueError, check, 'Document.Query', {})
+        self.assertRaises(ValueError, check, 'Document.Query',
+                          {'query': u'SELECT', 'unknown': u'param'})
+
+    def test_check_param_types(self):
+        check = self.registry.check_params
+        self.assertRaises(ValueError, check, 'Document.Query',
+                          {'query': {'not': 'a string'}})
+        self.assertRaises(ValueError, check, 'Document.Query',
+                          {'query': u'SELECT', 'pageSize': [10]})
+        self.assertRaises(ValueError, check, 'Document.Query',
+                          {'query': u'SELECT', 'sortOrder': {}})
+        # Scalar values are converted by the server
+        check('Document.Query', {'query': u'SELECT', 'pageSize': u'10',
+                                 'sortOrder': u'dc:title'})
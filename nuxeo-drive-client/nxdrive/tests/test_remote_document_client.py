@@ -0,0 +1,214 @@
+"""Request count tests for the document client against a stub server"""
+import re
+import unittest
+
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.common import NotFound
+from nxdrive.tests.stub_server import StubNuxeoServer
+from nxdrive.tests.stub_server import json_response
+
+
+class StubRepository(object):
+    """In-memory documents served through Document.Fetch / Query"""
+
+    def __init__(self, with_parent_ref=True):
+        self.with_parent_ref = with_parent_ref
+        self.docs = []
+        self.root = self.add(None, u'default-domain', folderish=True)
+
+    def add(self, parent, name, folderish=False, state='project',
+            facets=(), is_version=False, is_proxy=False,
+            with_is_version=True):
+        uid = u'uid-%04d' % len(self.docs)
+        path = (parent['path'] if parent is not None else u'') + u'/' + name
+        doc = {
+            'entity-type': 'document',
+            'uid': uid,
+            'path': path,
+            'type': 'Folder' if folderish else 'File',
+            'state': state,
+            'facets': list(facets) + (['Folderish'] if folderish else []),
+            'isVersion': is_version,
+            'isProxy': is_proxy,
+            'lastModified': '2014-01-01T10:00:00.00Z',
+            'properties': {'dc:title': name, 'file:content': None},
+        }
+        if not with_is_version:
+            del doc['isVersion']
+        if parent is not None and self.with_parent_ref:
+            doc['parentRef'] = parent['uid']
+        doc['_version'] = is_version
+        doc['_parent'] = parent['uid'] if parent is not None else None
+        self.docs.append(doc)
+        return doc
+
+    def to_json(self, doc):
+        return dict((k, v) for k, v in doc.items() if not k.startswith('_'))
+
+    def fetch(self, params, op_input):
+        ref = params['value']
+        for doc in self.docs:
+            if ref in (doc['uid'], doc['path']):
+                return self.to_json(doc)
+        return json_response({'message': 'Not found'}, status=404)
+
+    def query(self, params, op_input):
+        query = params['query']
+        match = re.search(r"ecm:parentId = '([^']*)'", query)
+        uid_match = re.search(r"ecm:uuid = '([^']*)'", query)
+        if match is not None:
+            docs = [d for d in self.docs if d['_parent'] == match.group(1)]
+        elif uid_match is not None:
+            # exists: the only query applying the filters
+            docs = [d for d in self.docs if d['uid'] == uid_match.group(1)]
+            if 'ecm:isCheckedInVersion = 0' in query:
+                docs = [d for d in docs if not d['_version']]
+            if "ecm:currentLifeCycleState != 'deleted'" in query:
+                docs = [d for d in docs if d['state'] != 'deleted']
+        else:
+            paths = re.findall(r"ecm:path = '([^']*)'", query)
+            docs = [d for d in self.docs if d['path'] in paths]
+        if 'pageSize' not in params:
+            return {'entity-type': 'documents',
+                    'entries': [self.to_json(d) for d in docs]}
+        page_size = int(params['pageSize'])
+        page_index = int(params.get('currentPageIndex', 0))
+        start = page_index * page_size
+        return {
+            'entity-type': 'documents',
+            'isPaginable': True,
+            'pageSize': page_size,
+            'currentPageIndex': page_index,
+            'isNextPageAvailable': start + page_size < len(docs),
+            'entries': [self.to_json(d)
+                        for d in docs[start:start + page_size]],
+        }
+
+
+class TestRemoteDocumentClientRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubNuxeoServer()
+        self.setup_repository(True)
+        self.server.start()
+        self.client = RemoteDocumentClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={})
+        self.server.reset()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def setup_repository(self, with_parent_ref):
+        repo = self.repo = StubRepository(with_parent_ref=with_parent_ref)
+        self.folder = repo.add(repo.root, u'Folder', folderish=True)
+        for i in range(50):
+            repo.add(self.folder, u'File %02d.txt' % i)
+        self.deleted = repo.add(self.folder, u'Deleted.txt', state='deleted')
+        self.version = repo.add(self.folder, u'Version.txt',
+                                facets=['Immutable'], is_version=True)
+        self.proxy = repo.add(self.folder, u'Proxy.txt',
+                              facets=['Immutable'], is_proxy=True)
+        self.server.register_operation('Document.Fetch', repo.fetch,
+                                       params=['value'])
+        self.server.register_operation(
+            'Document.Query', repo.query, params=['query'],
+            optional=['language', 'pageSize', 'currentPageIndex'])
+
+    def test_get_children_info_by_uid(self):
+        children = self.client.get_children_info(self.folder['uid'])
+        self.assertEquals(len(children), 53)
+        self.assertEquals(set(c.parent_uid for c in children),
+                          set([self.folder['uid']]))
+        self.assertEquals(self.server.count_requests(), 1)
+
+    def test_iter_children_info_pages(self):
+        for i in range(200):
+            self.repo.add(self.folder, u'Other File %03d.txt' % i)
+        children = self.client.iter_children_info(self.folder['uid'],
+                                                  page_size=100)
+        first = next(children)
+        self.assertEquals(first.parent_uid, self.folder['uid'])
+        # Pages are only fetched on demand
+        self.assertEquals(self.server.count_requests(), 1)
+        self.assertEquals(len(list(children)), 252)
+        self.assertEquals(self.server.count_requests(), 3)
+
+        self.server.reset()
+        children = self.client.get_children_info(self.folder['uid'])
+        self.assertEquals(len(children), 253)
+        self.assertEquals(self.server.count_requests(), 1)
+
+    def test_children_without_pagination(self):
+        # Older servers do not register the pagination params
+        self.server.register_operation('Document.Query', self.repo.query,
+                                       params=['query'], optional=['language'])
+        client = RemoteDocumentClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={})
+        self.server.reset()
+        children = list(client.iter_children_info(self.folder['uid'],
+                                                  page_size=10))
+        self.assertEquals(len(children), 53)
+        self.assertEquals(self.server.count_requests('Document.Query'), 1)
+
+    def test_query_results_without_parent_ref(self):
+        self.setup_repository(False)
+        client = self.client
+        entries = client.query(u"SELECT * FROM Document WHERE"
+                               u" ecm:parentId = '%s'" % self.folder['uid'])
+        children = client._filtered_results(entries['entries'])
+        self.assertEquals(len(children), 53)
+        self.assertEquals(set(c.parent_uid for c in children),
+                          set([self.folder['uid']]))
+        # One query for the children and one for all their parents
+        self.assertEquals(self.server.count_requests('Document.Query'), 2)
+        self.assertEquals(self.server.count_requests(), 2)
+
+    def test_get_info(self):
+        info = self.client.get_info(self.folder['uid'])
+        self.assertEquals(info.uid, self.folder['uid'])
+        self.assertEquals(info.parent_uid, self.repo.root['uid'])
+        self.assertTrue(info.folderish)
+        self.assertEquals(self.server.count_requests(), 1)
+
+    def test_get_info_missing(self):
+        self.assertRaises(NotFound, self.client.get_info, u'missing-uid')
+        self.assertEquals(self.client.get_info(u'missing-uid',
+                                               raise_if_missing=False), None)
+        self.assertEquals(self.server.count_requests(), 2)
+
+    def test_get_info_filters(self):
+        client = self.client
+        self.assertEquals(client.get_info(self.deleted['uid'],
+                                          raise_if_missing=False), None)
+        info = client.get_info(self.deleted['uid'], use_trash=False)
+        self.assertEquals(info.name, u'Deleted.txt')
+        self.assertEquals(client.get_info(self.version['uid'],
+                                          raise_if_missing=False), None)
+        info = client.get_info(self.version['uid'], include_versions=True)
+        self.assertEquals(info.name, u'Version.txt')
+        # Proxies are immutable too but are not versions
+        info = client.get_info(self.proxy['uid'])
+        self.assertEquals(info.name, u'Proxy.txt')
+        self.assertEquals(self.server.count_requests(), 5)
+
+    def test_get_info_filters_without_is_version(self):
+        # Older servers do not tell whether a document is a version
+        version = self.repo.add(self.folder, u'Old Version.txt',
+                                facets=['Immutable'], is_version=True,
+                                with_is_version=False)
+        proxy = self.repo.add(self.folder, u'Old Proxy.txt',
+                              facets=['Immutable'], is_proxy=True,
+                              with_is_version=False)
+        client = self.client
+        self.assertEquals(client.get_info(version['uid'],
+                                          raise_if_missing=False), None)
+        self.assertEquals(client.get_info(proxy['uid']).name,
+                          u'Old Proxy.txt')
+        # Only the queries filter versions out
+        self.assertEquals(self.server.count_requests('Document.Query'), 2)
+        self.server.reset()
+        info = client.get_info(version['uid'], include_versions=True)
+        self.assertEquals(info.name, u'Old Version.txt')
+        self.assertEquals(self.server.count_requests(), 1)
@@ -0,0 +1,207 @@
+"""Retry policy and circuit breaker tests against a stub server"""
+import unittest
+import urllib2
+
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.retry import CircuitBreaker
+from nxdrive.client.retry import CircuitBreakers
+from nxdrive.client.retry import CircuitOpenError
+from nxdrive.client.retry import RetryPolicy
+from nxdrive.client.retry import ServerOverloaded
+from nxdrive.client.retry import get_retry_after
+from nxdrive.tests.stub_server import StubNuxeoServer
+from nxdrive.tests.stub_server import json_response
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_state_transitions(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('http://server/', failure_threshold=2,
+                                 reset_timeout=10, max_reset_timeout=30,
+                                 clock=clock)
+        breaker.before_call()
+        breaker.on_failure()
+        breaker.before_call()
+        breaker.on_failure()
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        # Failed probe: open for twice as long (with up to 10% of jitter)
+        clock.now += 11
+        breaker.before_call()
+        self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only one probe at a time
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        breaker.on_failure()
+        clock.now += 19
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        clock.now += 3
+        breaker.before_call()
+        breaker.on_success()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+
+    def test_backoff(self):
+        policy = RetryPolicy(max_attempts=4, base_delay=1, max_delay=3)
+        for _ in range(100):
+            self.assertTrue(0 <= policy.get_delay(0) <= 1)
+            self.assertTrue(0 <= policy.get_delay(1) <= 2)
+            self.assertTrue(0 <= policy.get_delay(5) <= 3)
+        error = urllib2.URLError('Connection refused')
+        self.assertTrue(policy.should_retry(error, 2))
+        self.assertFalse(policy.should_retry(error, 3))
+        self.assertFalse(policy.should_retry(ValueError(), 0))
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.failures = 0
+        self.overload = None
+        self.server = StubNuxeoServer()
+        for op_id in ('Document.Fetch', 'Document.Create'):
+            self.server.register_operation(op_id, self.handle,
+                                           optional=['value'])
+        self.server.start()
+        self.delays = []
+        self.clock = FakeClock()
+        self.breakers = CircuitBreakers(failure_threshold=3, clock=self.clock)
+        self.client = RemoteDocumentClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={}, circuit_breakers=self.breakers,
+            retry_policy=RetryPolicy(sleep=self.delays.append))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def handle(self, params, op_input):
+        if self.overload is not None:
+            status, headers = self.overload
+            self.overload = None
+            return json_response({'message': 'Overloaded'}, status=status,
+                                 headers=headers)
+        if self.failures > 0:
+            self.failures -= 1
+            return json_response({'message': 'Bad Gateway'}, status=502)
+        return {'ok': True}
+
+    def test_retry_idempotent_operations(self):
+        self.failures = 2
+        self.assertEquals(self.client.execute('Document.Fetch'),
+                          {'ok': True})
+        self.assertEquals(self.server.count_requests('Document.Fetch'), 3)
+        self.assertEquals(len(self.delays), 2)
+
+        # Operations with side effects are never sent twice
+        self.failures = 1
+        self.assertRaises(urllib2.HTTPError, self.client.execute,
+                          'Document.Create')
+        self.assertEquals(self.server.count_requests('Document.Create'), 1)
+
+    def test_circuit_breaker(self):
+        self.failures = 3
+        self.assertRaises(urllib2.HTTPError, self.client.execute,
+                          'Document.Fetch')
+        self.assertEquals(self.server.count_requests(), 4)
+
+        # The server is not called anymore while the circuit is open
+        self.assertRaises(CircuitOpenError, self.client.execute,
+                          'Document.Fetch')
+        self.assertRaises(CircuitOpenError, self.client.execute,
+                          'Document.Create')
+        self.assertEquals(self.server.count_requests(), 4)
+
+        # A single probe resumes the calls without fetching the operation
+        # registry again
+        self.clock.now += 60
+        self.assertEquals(self.client.execute('Document.Create'),
+                          {'ok': True})
+        self.assertEquals(self.client.execute('Document.Fetch'),
+                          {'ok': True})
+        self.assertEquals(self.server.count_requests(), 6)
+        registry_requests = [r for r in self.server.requests
+                             if r.operation is None]
+        self.assertEquals(len(registry_requests), 1)
+
+    def test_unexpected_error_during_probe(self):
+        self.failures = 3
+        self.assertRaises(urllib2.HTTPError, self.client.execute,
+                          'Document.Fetch')
+        breaker = self.breakers.get(self.client.server_url)
+        opener = self.client.opener
+
+        class FailingOpener(object):
+
+            def open(self, req, timeout=None):
+                raise ValueError("Unexpected error")
+
+        self.client.opener = FailingOpener()
+        self.clock.now += 60
+        self.assertRaises(ValueError, self.client.execute, 'Document.Fetch')
+        # The probe is over: the circuit is open again, not half open
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, self.client.execute,
+                          'Document.Fetch')
+
+        self.client.opener = opener
+        self.clock.now += 120
+        self.assertEquals(self.client.execute('Document.Fetch'),
+                          {'ok': True})
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_short_retry_after(self):
+        self.overload = (503, {'Retry-After': '2'})
+        self.assertEquals(self.client.execute('Document.Fetch'),
+                          {'ok': True})
+        self.assertEquals(self.delays, [2])
+        self.assertEquals(self.server.count_requests('Document.Fetch'), 2)
+
+    def test_long_retry_after(self):
+        backpressure = self.client.backpressure
+        self.assertFalse(backpressure.is_slowed_down())
+        self.overload = (503, {'Retry-After': '120'})
+        self.assertRaises(ServerOverloaded, self.client.execute,
+                          'Document.Fetch')
+        self.assertEquals(self.server.count_requests('Document.Fetch'), 1)
+        self.assertEquals(backpressure.get_wait(), 120)
+        self.assertTrue(backpressure.is_slowed_down())
+        # Shared by all the clients of the server
+        self.assertTrue(self.breakers.get(self.server.url).backpressure
+                        is backpressure)
+
+        # Operations with side effects are not retried, even shortly
+        self.overload = (429, {'Retry-After': '1'})
+        try:
+            self.client.execute('Document.Create')
+            self.fail("ServerOverloaded should have been raised")
+        except ServerOverloaded as e:
+            self.assertEquals(e.code, 429)
+            self.assertEquals(e.retry_after, 1)
+        self.assertEquals(self.server.count_requests('Document.Create'), 1)
+
+        # The server is up: the circuit stays closed
+        self.assertEquals(self.client.execute('Document.Fetch'),
+                          {'ok': True})
+        self.clock.now += 121
+        self.assertEquals(backpressure.get_wait(), 0)
+
+    def test_retry_after_formats(self):
+        def error(value):
+            headers = {'Retry-After': value} if value is not None else {}
+            return urllib2.HTTPError('http://server/', 503, 'Unavailable',
+                                     headers, None)
+        self.assertEquals(get_retry_after(error('30')), 30)
+        self.assertEquals(get_retry_after(error(None)), 30)
+        self.assertEquals(get_retry_after(error('garbage'), default=10), 10)
+        self.assertEquals(get_retry_after(
+            error('Wed, 21 Oct 2015 07:28:00 GMT')), 0)
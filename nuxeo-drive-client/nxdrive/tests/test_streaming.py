@@ -0,0 +1,388 @@
+"""Streaming request bodies tests against a stub server"""
+import email
+import hashlib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client import streaming
+from nxdrive.client.base_automation_client import ChunkedUpload
+from nxdrive.client.streaming import BufferBody
+from nxdrive.client.streaming import FileBody
+from nxdrive.client.streaming import IterableBody
+from nxdrive.client.streaming import MultipartBody
+from nxdrive.client.streaming import to_body
+from nxdrive.tests.stub_server import StubBatchUpload
+from nxdrive.tests.stub_server import StubNuxeoServer
+from nxdrive.tests.stub_server import file_fs_item
+from nxdrive.tests.stub_server import json_response
+
+
+CONTENT = b'0123456789' * 10000
+
+
+class TestBodies(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests-streaming')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_file(self, content):
+        path = os.path.join(self.folder, u'File.txt')
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_buffer_body(self):
+        data = bytearray(CONTENT)
+        body = BufferBody(data, chunk_size=4096)
+        self.assertEquals(len(body), len(CONTENT))
+        chunks = list(body)
+        self.assertEquals(len(chunks), 25)
+        # Chunks are views over the buffer, not copies
+        self.assertTrue(all(isinstance(c, memoryview) for c in chunks))
+        data[0:1] = b'X'
+        self.assertEquals(chunks[0][0], b'X')
+        self.assertEquals(BufferBody(u'caf\xe9').getvalue(), b'caf\xc3\xa9')
+
+    def test_file_body(self):
+        path = self.make_file(CONTENT)
+        body = FileBody(path, buffer_size=1000)
+        self.assertEquals(body.length, len(CONTENT))
+        self.assertTrue(body.replayable)
+        self.assertEquals(body.getvalue(), CONTENT)
+        self.assertEquals(body.getvalue(), CONTENT)
+
+        body = FileBody(path, offset=1000, length=500)
+        self.assertEquals(body.getvalue(), CONTENT[1000:1500])
+        self.assertEquals(self.send(body), CONTENT[1000:1500])
+        self.assertEquals(FileBody(path, offset=99000).getvalue(),
+                          CONTENT[99000:])
+
+        with open(path, 'rb') as f:
+            f.read(10)
+            body = to_body(f)
+            self.assertFalse(body.replayable)
+            self.assertEquals(body.length, len(CONTENT) - 10)
+            self.assertEquals(body.getvalue(), CONTENT[10:])
+
+        # The file was truncated after the Content-Length was computed
+        body = FileBody(path)
+        self.make_file(b'Short')
+        self.assertRaises(IOError, body.getvalue)
+
+    def test_hashed_file_body(self):
+        path = self.make_file(CONTENT)
+        digest = hashlib.md5(CONTENT).hexdigest()
+        body = FileBody(path, buffer_size=1000, hasher=hashlib.md5())
+        self.assertEquals(body.hexdigest(), None)
+        # sendfile is not used to hash the content on the way
+        self.assertEquals(self.send(body, zero_copy=True), CONTENT)
+        self.assertEquals(body.hexdigest(), digest)
+        # Sending the body again does not hash the content twice
+        self.assertEquals(body.getvalue(), CONTENT)
+        self.assertEquals(body.hexdigest(), digest)
+
+        # The hash of a chunk continues the one of the previous chunks
+        hasher = hashlib.md5(CONTENT[:1000])
+        body = FileBody(path, offset=1000, hasher=hasher)
+        self.assertEquals(self.send(body), CONTENT[1000:])
+        self.assertEquals(body.hexdigest(), digest)
+        self.assertEquals(hasher.hexdigest(),
+                          hashlib.md5(CONTENT[:1000]).hexdigest())
+
+    def send(self, body, zero_copy=False, timeout=None):
+        sender, receiver = socket.socketpair()
+        sender.settimeout(timeout)
+        received = []
+
+        def receive():
+            while True:
+                data = receiver.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        try:
+            body.send_to(sender, zero_copy=zero_copy)
+        finally:
+            sender.close()
+            thread.join()
+            receiver.close()
+        return b''.join(received)
+
+    def test_send_file(self):
+        content = os.urandom(1000000)
+        path = self.make_file(content)
+        # Reused buffer smaller and larger than the file
+        for buffer_size in (4096, 2000000):
+            body = FileBody(path, buffer_size=buffer_size)
+            self.assertEquals(self.send(body), content)
+        with open(path, 'rb') as f:
+            f.seek(1000)
+            self.assertEquals(self.send(FileBody(f)), content[1000:])
+        body = FileBody(path)
+        self.make_file(b'Short')
+        self.assertRaises(IOError, self.send, body)
+
+    def test_sendfile(self):
+        if streaming.sendfile is None:
+            raise unittest.SkipTest('pysendfile is not installed')
+        content = os.urandom(1000000)
+        path = self.make_file(content)
+        # A socket with a timeout is non blocking
+        self.assertEquals(self.send(FileBody(path, buffer_size=100000),
+                                    zero_copy=True, timeout=10), content)
+        with open(path, 'rb') as f:
+            f.seek(1000)
+            self.assertEquals(self.send(FileBody(f), zero_copy=True),
+                              content[1000:])
+            self.assertEquals(f.tell(), len(content))
+
+    def test_iterable_body(self):
+        self.assertRaises(ValueError, to_body, iter([b'a', b'b']))
+        body = to_body(iter([b'ab', b'cd']), length=4)
+        self.assertFalse(body.replayable)
+        self.assertEquals(body.getvalue(), b'abcd')
+        self.assertRaises(IOError, IterableBody([b'abc'], 2).getvalue)
+        self.assertRaises(IOError, IterableBody([b'abc'], 4).getvalue)
+
+    def test_multipart_body(self):
+        body = MultipartBody(b'XXX', [
+            ([('Content-Type', 'application/json+nxrequest'),
+              ('Content-ID', 'request')], b'{}'),
+            ([('Content-Type', 'text/plain'), ('Content-ID', 'input')],
+             bytearray(CONTENT)),
+        ])
+        value = body.getvalue()
+        self.assertEquals(len(body), len(value))
+        self.assertTrue(body.replayable)
+        message = email.message_from_string(
+            b'Content-Type: multipart/related; boundary="XXX"\r\n\r\n'
+            + value)
+        parts = message.get_payload()
+        self.assertEquals([p['Content-ID'] for p in parts],
+                          ['request', 'input'])
+        self.assertEquals(parts[0].get_payload(), b'{}')
+        self.assertEquals(parts[1].get_payload(), CONTENT)
+
+
+class TestStreamingUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubNuxeoServer()
+        self.server.register_operation(
+            'Blob.Attach', lambda params, op_input: None,
+            params=('document',))
+        # Multipart requests are not decoded by the stub operations
+        self.server.add_route('POST', 'site/automation/Blob.Attach',
+                              lambda request: json_response({}))
+        self.server.add_route('POST', 'site/automation/batch/upload',
+                              self.upload)
+        self.server.add_route('POST', 'site/automation/batch/execute',
+                              lambda request: json_response({'id': u'1'}))
+        self.uploaded = []
+        self.server.start()
+        self.upload_tmp_dir = tempfile.mkdtemp(u'-nxdrive-tests-uploads')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.upload_tmp_dir)
+
+    def upload(self, request):
+        self.uploaded.append(request.body)
+        return json_response({'uploaded': 'true'})
+
+    def get_client(self, client_class=RemoteDocumentClient):
+        return client_class(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={}, upload_tmp_dir=self.upload_tmp_dir)
+
+    def test_upload_from_memory(self):
+        client = self.get_client(RemoteFileSystemClient)
+        self.assertEquals(client.make_file(u'parent', u'File.txt',
+                                           bytearray(CONTENT)), u'1')
+        client.update_content(u'1', CONTENT, filename=u'File.txt')
+        self.assertEquals(self.uploaded, [CONTENT, CONTENT])
+        # No temporary file is needed any more
+        self.assertEquals(os.listdir(self.upload_tmp_dir), [])
+
+    def test_upload_file(self):
+        client = self.get_client()
+        path = os.path.join(self.upload_tmp_dir, u'File.txt')
+        with open(path, 'wb') as f:
+            f.write(CONTENT)
+        client.upload('batch', path)
+        self.assertEquals(self.uploaded, [CONTENT])
+        os.remove(path)
+
+    def test_upload_from_iterable(self):
+        client = self.get_client()
+        chunks = (CONTENT[i:i + 1000] for i in range(0, len(CONTENT), 1000))
+        client.upload_body('batch', to_body(chunks, len(CONTENT)),
+                           u'File.txt')
+        self.assertEquals(self.uploaded, [CONTENT])
+        self.assertEquals(self.server.connections, 1)
+
+    def test_execute_with_blob(self):
+        client = self.get_client()
+        client.execute_with_blob('Blob.Attach', bytearray(CONTENT),
+                                 u'File.txt', document=u'1')
+        request = self.server.requests[-1]
+        self.assertEquals(int(request.headers['Content-Length']),
+                          len(request.body))
+        message = email.message_from_string(
+            b'Content-Type: %s\r\n\r\n' % request.headers['Content-Type']
+            + request.body)
+        json_part, blob_part = message.get_payload()
+        self.assertEquals(json_part.get_payload(),
+                          b'{"params": {"document": "1"}}')
+        self.assertEquals(blob_part['Content-Type'], 'text/plain')
+        self.assertEquals(blob_part.get_payload(), CONTENT)
+
+    def test_execute_with_blobs(self):
+        client = self.get_client()
+        client.execute_with_blobs(
+            'Blob.Attach', [(CONTENT, u'File 1.txt'), (b'2', u'File 2.bin')],
+            context={'currentDocument': u'1'}, document=u'1')
+        request = self.server.requests[-1]
+        message = email.message_from_string(
+            b'Content-Type: %s\r\n\r\n' % request.headers['Content-Type']
+            + request.body)
+        json_part, blob_1, blob_2 = message.get_payload()
+        self.assertEquals(json.loads(json_part.get_payload()), {
+            'params': {'document': '1'},
+            'context': {'currentDocument': '1'}})
+        self.assertEquals(blob_1['Content-ID'], 'input')
+        self.assertEquals(blob_1.get_payload(), CONTENT)
+        self.assertEquals(blob_2['Content-ID'], 'input1')
+        self.assertEquals(blob_2['Content-Type'], 'application/octet-stream')
+        self.assertEquals(blob_2.get_payload(), b'2')
+
+
+class TestChunkedUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubNuxeoServer()
+        self.server.register_operation(
+            'NuxeoDrive.CreateFile', lambda params, op_input: None,
+            params=('parentId',))
+        self.created = []
+        self.batch_upload = StubBatchUpload(self.server, self.create_file)
+        self.server.start()
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests-chunks')
+        self.path = os.path.join(self.folder, u'File.txt')
+        with open(self.path, 'wb') as f:
+            f.write(CONTENT)
+        self.client = RemoteFileSystemClient(
+            self.server.url, u'user', u'device', u'0.0', password=u'secret',
+            proxies={})
+        self.client.upload_chunk_size = 30000
+        # Not even the smallest files are sent inline
+        self.client.inline_upload_max_size = 0
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def create_file(self, operation_id, params, filename, content):
+        self.created.append((filename, content))
+        return file_fs_item(u'1', filename, content)
+
+    def create_file_inline(self, request):
+        message = email.message_from_string(
+            b'Content-Type: %s\r\n\r\n' % request.headers['Content-Type']
+            + request.body)
+        json_part, blob_part = message.get_payload()
+        params = json.loads(json_part.get_payload())['params']
+        filename = urllib2.unquote(
+            blob_part['Content-Disposition'].split("''", 1)[1])
+        return json_response(self.create_file(
+            'NuxeoDrive.CreateFile', params, filename,
+            blob_part.get_payload()))
+
+    def test_chunked_upload(self):
+        self.assertEquals(self.client.stream_file(u'parent', self.path).uid,
+                          u'1')
+        self.assertEquals(self.created, [(u'File.txt', CONTENT)])
+        self.assertEquals([i for _, i in self.batch_upload.received],
+                          [0, 1, 2, 3])
+        request = self.server.requests[-2]
+        self.assertEquals(request.headers['X-Upload-Type'], 'chunked')
+        self.assertEquals(request.headers['X-Upload-Chunk-Count'], '4')
+        self.assertEquals(request.headers['X-File-Size'],
+                          str(len(CONTENT)))
+        self.assertEquals(len(request.body), 10000)
+
+        # Small files are still uploaded in one request
+        self.client.upload_chunk_size = len(CONTENT)
+        self.client.stream_file(u'parent', self.path)
+        self.assertFalse('X-Upload-Type' in self.server.requests[-2].headers)
+        self.assertEquals(self.created[-1], (u'File.txt', CONTENT))
+
+    def test_inline_upload(self):
+        self.server.add_route('POST', 'site/automation/NuxeoDrive.CreateFile',
+                              self.create_file_inline)
+        self.client.upload_chunk_size = len(CONTENT)
+        self.client.inline_upload_max_size = len(CONTENT)
+        self.server.reset()
+        upload = ChunkedUpload(chunk_size=len(CONTENT),
+                               digest_algorithm='md5')
+        self.assertEquals(self.client.stream_file(u'parent', self.path,
+                                                  upload=upload).uid, u'1')
+        # A single request, without any batch
+        self.assertEquals(self.server.count_requests(), 1)
+        self.assertEquals(self.batch_upload.received, [])
+        self.assertEquals(self.created, [(u'File.txt', CONTENT)])
+        self.assertEquals(upload.content_digest,
+                          hashlib.md5(CONTENT).hexdigest())
+
+        # Larger files still go through a batch
+        self.client.inline_upload_max_size = len(CONTENT) - 1
+        self.client.stream_file(u'parent', self.path)
+        self.assertEquals(len(self.batch_upload.received), 1)
+        self.assertEquals(self.created[-1], (u'File.txt', CONTENT))
+
+    def test_resume(self):
+        saved = []
+        upload = ChunkedUpload(chunk_size=30000,
+                               on_save=lambda u: saved.append(
+                                   u.uploaded_chunks),
+                               digest_algorithm='md5')
+        self.batch_upload.failing_chunks.add(2)
+        self.assertRaises(urllib2.HTTPError, self.client.stream_file,
+                          u'parent', self.path, upload=upload)
+        self.assertEquals(saved, [0, 1, 2])
+        self.assertEquals(self.created, [])
+
+        batch_id = upload.batch_id
+        self.assertEquals(self.client.stream_file(u'parent', self.path,
+                                                  upload=upload).uid, u'1')
+        self.assertEquals(self.batch_upload.received,
+                          [(batch_id, i) for i in (0, 1, 2, 2, 3)])
+        self.assertEquals(self.created, [(u'File.txt', CONTENT)])
+        # The chunks sent by the first attempt are hashed again
+        self.assertEquals(upload.content_digest,
+                          hashlib.md5(CONTENT).hexdigest())
+
+    def test_lost_batch(self):
+        # The server does not know the batch any more: start again
+        upload = ChunkedUpload(batch_id=u'expired', file_size=len(CONTENT),
+                               chunk_size=30000, uploaded_chunks=4)
+        self.assertRaises(urllib2.HTTPError, self.client.stream_file,
+                          u'parent', self.path, upload=upload)
+        self.assertEquals(upload.batch_id, None)
+        self.client.stream_file(u'parent', self.path, upload=upload)
+        self.assertEquals(len(self.batch_upload.received), 4)
+        self.assertEquals(self.created, [(u'File.txt', CONTENT)])
@@ -0,0 +1,74 @@
+"""Transfer engine tests"""
+import threading
+import unittest
+
+from nxdrive.transfer import Transfer
+from nxdrive.transfer import TransferEngine
+
+
+def finish(doc_pair, transfer):
+    pass
+
+
+class TestTransferEngine(unittest.TestCase):
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def test_inline(self):
+        self.engine = TransferEngine()
+        self.assertFalse(self.engine.is_concurrent())
+        transfer = Transfer(1, lambda: 42, finish)
+        self.assertFalse(self.engine.submit(transfer))
+        self.assertEquals(transfer.get_result(), 42)
+        self.assertFalse(self.engine.is_full())
+        self.assertEquals(self.engine.get_completed(block=True), [])
+
+    def test_workers(self):
+        self.engine = TransferEngine(2)
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def work(value):
+            started.release()
+            release.wait()
+            return value
+
+        self.assertTrue(self.engine.submit(Transfer(
+            1, lambda: work(1), finish, keys=[('pair', 1), ('local', 'a')])))
+        self.assertFalse(self.engine.is_full())
+        # Fewer transfers are admitted for a server asking to slow down
+        self.assertTrue(self.engine.is_full(max_running=1))
+        self.assertTrue(self.engine.submit(Transfer(
+            2, lambda: work(2), finish, keys=[('pair', 2)])))
+        # Both transfers run at the same time
+        started.acquire()
+        started.acquire()
+        self.assertTrue(self.engine.is_full())
+        self.assertEquals(self.engine.count_running(), 2)
+        self.assertTrue(self.engine.is_busy([('local', 'a')]))
+        self.assertFalse(self.engine.is_busy([('local', 'b')]))
+        self.assertEquals(self.engine.get_completed(), [])
+
+        release.set()
+        completed = []
+        while self.engine.count_running():
+            completed.extend(self.engine.get_completed(block=True,
+                                                       timeout=10))
+        self.assertEquals(sorted(t.get_result() for t in completed), [1, 2])
+        self.assertFalse(self.engine.is_busy([('local', 'a')]))
+        self.assertFalse(self.engine.is_full())
+
+    def test_error(self):
+        self.engine = TransferEngine(1)
+
+        def work():
+            raise IOError('Connection reset')
+
+        self.engine.submit(Transfer(1, work, finish))
+        transfer, = self.engine.get_completed(block=True, timeout=10)
+        self.assertRaises(IOError, transfer.get_result)
+        # The worker is still available
+        self.engine.submit(Transfer(2, lambda: 2, finish))
+        transfer, = self.engine.get_completed(block=True, timeout=10)
+        self.assertEquals(transfer.get_result(), 2)
@@ -0,0 +1,158 @@
+"""Run the file transfers of the synchronization concurrently."""
+import sys
+from Queue import Empty
+from Queue import Queue
+from threading import Lock
+from threading import Thread
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+class Transfer(object):
+    """Network transfer of a doc pair
+
+    work is run by a worker thread and must not touch the doc pairs: it only
+    streams content (e.g. stream_file, stream_update, stream_content), at
+    most saving the progress of an upload with its own session.
+    finish(doc_pair, transfer) is then called by the synchronization thread
+    to apply the state transitions, get_result raising the error of work if
+    any.
+
+    keys identify the resources the transfer works on (the pair itself, its
+    local and remote names, ...): a pair is not processed while a transfer
+    with a common key is running.
+    """
+
+    def __init__(self, pair_id, work, finish, keys=()):
+        self.pair_id = pair_id
+        self.work = work
+        self.finish = finish
+        self.keys = frozenset(keys)
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self.work()
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def get_result(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+    def __repr__(self):
+        return "Transfer<pair_id=%r>" % self.pair_id
+
+
+class TransferEngine(object):
+    """Pool of worker threads running transfers
+
+    With no workers, submit runs the transfers in the calling thread. The
+    completed transfers are collected by the synchronization thread with
+    get_completed.
+    """
+
+    def __init__(self, n_workers=0):
+        self.n_workers = n_workers
+        self._tasks = Queue()
+        self._completed = Queue()
+        self._running = {}
+        self._busy_keys = set()
+        self._lock = Lock()
+        self._workers = []
+
+    def start(self):
+        for i in range(self.n_workers - len(self._workers)):
+            worker = Thread(target=self._work,
+                            name='TransferWorker-%d' % len(self._workers))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """Let the workers finish their current transfer and exit"""
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def is_concurrent(self):
+        return self.n_workers > 0
+
+    def submit(self, transfer):
+        """Run transfer, return whether it is run by a worker
+
+        If not, transfer is already completed but not collected: the caller
+        is expected to finish it directly.
+        """
+        if not self.is_concurrent():
+            transfer.run()
+            return False
+        if not self._workers:
+            self.start()
+        with self._lock:
+            self._running[transfer.pair_id] = transfer
+            self._busy_keys.update(transfer.keys)
+        log.trace("Submitting %r", transfer)
+        self._tasks.put(transfer)
+        return True
+
+    def is_busy(self, keys):
+        """Tell whether a running transfer works on any of keys"""
+        with self._lock:
+            return not self._busy_keys.isdisjoint(keys)
+
+    def is_full(self, max_running=None):
+        """Tell whether no other transfer can be admitted
+
+        max_running, if any, lowers the number of transfers run at once
+        below the number of workers, e.g. for a server asking to slow down.
+        """
+        if not self.is_concurrent():
+            return False
+        limit = self.n_workers
+        if max_running is not None:
+            limit = min(limit, max_running)
+        with self._lock:
+            return len(self._running) >= limit
+
+    def count_running(self):
+        with self._lock:
+            return len(self._running)
+
+    def get_completed(self, block=False, timeout=None):
+        """Return the transfers completed since the last call
+
+        If block is True, wait for at least one transfer to complete unless
+        none is running.
+        """
+        completed = []
+        if block and self.count_running():
+            try:
+                completed.append(self._completed.get(timeout=timeout))
+            except Empty:
+                pass
+        while True:
+            try:
+                completed.append(self._completed.get_nowait())
+            except Empty:
+                break
+        with self._lock:
+            for transfer in completed:
+                del self._running[transfer.pair_id]
+                self._busy_keys.difference_update(transfer.keys)
+        return completed
+
+    def _work(self):
+        while True:
+            transfer = self._tasks.get()
+            if transfer is None:
+                return
+            transfer.run()
+            self._completed.put(transfer)
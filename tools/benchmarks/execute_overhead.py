@@ -0,0 +1,112 @@
+"""Benchmark the client side overhead of Automation calls
+
+No network is involved: the client is built from a registry cache and its
+opener is replaced by a stub returning canned JSON responses, so the figures
+only measure parameter validation, request building and response parsing.
+
+Usage:
+
+    python tools/benchmarks/execute_overhead.py [n_calls]
+"""
+import sys
+import time
+from StringIO import StringIO
+
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.operation_registry import OperationRegistry
+from nxdrive.client.operation_registry import OperationRegistryCache
+
+
+SERVER_URL = 'http://localhost:8080/nuxeo/'
+
+OPERATIONS = [{
+    'id': 'Document.Query',
+    'params': [
+        {'name': 'query', 'type': 'string', 'required': True},
+        {'name': 'language', 'type': 'string', 'required': False},
+        {'name': 'pageSize', 'type': 'integer', 'required': False},
+        {'name': 'currentPageIndex', 'type': 'integer', 'required': False},
+        {'name': 'sortInfo', 'type': 'stringlist', 'required': False},
+        {'name': 'queryParams', 'type': 'stringlist', 'required': False},
+    ],
+}]
+
+
+class StubResponse(StringIO):
+
+    def __init__(self):
+        StringIO.__init__(self, '{"entries": []}')
+
+    def info(self):
+        return {'content-type': 'application/json'}
+
+
+class StubOpener(object):
+
+    def open(self, req, timeout=None):
+        return StubResponse()
+
+
+def legacy_validate_params(operations, command, params):
+    """Parameter check as it was done before the validators were compiled"""
+    method = operations.get(command)
+    if not method:
+        raise ValueError("'%s' is not a registered operations." % command)
+    required_params = []
+    other_params = []
+    for param in method['params']:
+        if param['required']:
+            required_params.append(param['name'])
+        else:
+            other_params.append(param['name'])
+    for param in params.keys():
+        if (not param in required_params
+            and not param in other_params):
+            raise ValueError("Unexpected param '%s' for operation '%s"
+                             % (param, command))
+    for param in required_params:
+        if not param in params:
+            raise ValueError(
+                "Missing required param '%s' for operation '%s'" % (
+                    param, command))
+
+
+def make_client():
+    cache = OperationRegistryCache()
+    cache.put(SERVER_URL, u'bench', OperationRegistry(OPERATIONS))
+    client = RemoteDocumentClient(SERVER_URL, u'user', u'device', u'bench',
+                                  password=u'secret', proxies={},
+                                  registry_cache=cache)
+    client.opener = StubOpener()
+    return client
+
+
+def timeit(label, n_calls, func, repeat=5):
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in xrange(n_calls):
+            func()
+        durations.append(time.time() - start)
+    duration = min(durations)
+    print("%-36s %10.1f calls/s  %6.2f us/call" % (
+        label, n_calls / duration, duration * 1e6 / n_calls))
+
+
+def main(n_calls=100000):
+    client = make_client()
+    params = {'query': u'SELECT * FROM Document', 'language': 'NXQL',
+              'pageSize': 100, 'currentPageIndex': 0}
+    operations = client.operations
+    registry = client.registry
+    timeit('legacy parameter check', n_calls,
+           lambda: legacy_validate_params(operations, 'Document.Query',
+                                          params))
+    timeit('compiled parameter check', n_calls,
+           lambda: registry.check_params('Document.Query', params))
+    timeit('execute without network', n_calls // 10,
+           lambda: client.execute('Document.Query', **params))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,66 @@
+"""Benchmark Automation calls with and without persistent connections
+
+Runs against the local stub server used by the test suite, so the figures
+measure the client side overhead (connection setup included) rather than
+any Nuxeo server processing time.
+
+Usage:
+
+    python tools/benchmarks/http_keep_alive.py [n_requests] [n_threads]
+"""
+import sys
+import threading
+import time
+
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.tests.stub_server import StubNuxeoServer
+
+
+def make_client(server, pool):
+    return RemoteDocumentClient(server.url, u'user', u'device', u'bench',
+                                password=u'secret', proxies={},
+                                connection_pool=pool)
+
+
+def run(server, pool, n_requests, n_threads):
+    server.reset()
+    clients = [make_client(server, pool) for _ in range(n_threads)]
+    per_thread = n_requests // n_threads
+
+    def work(client):
+        for _ in range(per_thread):
+            client.execute('Bench.Ping', value=u'ping')
+
+    threads = [threading.Thread(target=work, args=(c,)) for c in clients]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - start
+    return per_thread * n_threads / duration, server.connections
+
+
+def main(n_requests=2000, n_threads=1):
+    server = StubNuxeoServer()
+    server.register_operation('Bench.Ping',
+                              lambda params, op_input: {'value': 'pong'},
+                              params=['value'])
+    server.start()
+    try:
+        scenarios = [
+            ('new connection per request', ConnectionPool(0)),
+            ('keep-alive pool', ConnectionPool()),
+        ]
+        for label, pool in scenarios:
+            rate, connections = run(server, pool, n_requests, n_threads)
+            print("%-28s %8.1f req/s  %5d TCP connections" % (
+                label, rate, connections))
+            pool.clear()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
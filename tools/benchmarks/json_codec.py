@@ -0,0 +1,111 @@
+"""Benchmark the JSON codecs on Automation payloads
+
+Recorded responses (e.g. the JSON payloads of the TRACE logs of a real
+synchronization session, one response per file) can be given as arguments.
+Without arguments, representative GetChangeSummary and GetChildren
+payloads are generated.
+
+Usage:
+
+    python tools/benchmarks/json_codec.py [payload.json ...]
+"""
+import os
+import sys
+import time
+
+from nxdrive.client import json_codec
+from nxdrive.client.remote_file_system_client import RemoteFileSystemClient
+
+
+def make_fs_item(i, parent_id):
+    return {
+        'id': u'defaultFileSystemItemFactory#default#%032x' % i,
+        'parentId': parent_id,
+        'name': u'Document \xe9t\xe9 %d.odt' % i,
+        'path': u'/org.nuxeo.drive.service.impl.DefaultTopLevelFolderItem'
+                u'Factory#/defaultSyncRootFolderItemFactory#default#%s/%d'
+                % (parent_id, i),
+        'folder': False,
+        'creator': u'Administrator',
+        'lastModifier': u'Administrator',
+        'creationDate': 1400000000000 + i,
+        'lastModificationDate': 1400000000000 + i,
+        'canRename': True,
+        'canDelete': True,
+        'canUpdate': True,
+        'digestAlgorithm': u'md5',
+        'digest': u'%032x' % (i * 7919),
+        'downloadURL': u'nxbigfile/default/%032x/blobholder:0/'
+                       u'Document%%20%d.odt' % (i, i),
+        'userName': u'Administrator',
+    }
+
+
+def make_payloads(n_items=2000):
+    parent_id = u'defaultSyncRootFolderItemFactory#default#root'
+    children = [make_fs_item(i, parent_id) for i in range(n_items)]
+    changes = {
+        'fileSystemChanges': [{
+            'repositoryId': u'default',
+            'eventId': u'documentModified',
+            'eventDate': 1400000000000 + i,
+            'docUuid': u'%032x' % i,
+            'fileSystemItem': item,
+            'fileSystemItemId': item['id'],
+            'fileSystemItemName': item['name'],
+        } for i, item in enumerate(children)],
+        'activeSynchronizationRootDefinitions': u'default:root',
+        'syncDate': 1400000000000,
+        'hasTooManyChanges': False,
+    }
+    return [('GetChangeSummary', json_codec.dumps(changes)),
+            ('GetChildren', json_codec.dumps(children))]
+
+
+def load_payloads(paths):
+    payloads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            payloads.append((os.path.basename(path), f.read()))
+    return payloads
+
+
+def to_infos(value):
+    if isinstance(value, dict):
+        value = [c.get('fileSystemItem') for c in
+                 value.get('fileSystemChanges', ())]
+    return [RemoteFileSystemClient.file_to_info.im_func(None, item)
+            for item in value if isinstance(item, dict) and 'id' in item]
+
+
+def bench(label, func, repeat=5):
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return min(durations) * 1000
+
+
+def main(paths):
+    payloads = load_payloads(paths) if paths else make_payloads()
+    codecs = []
+    for name, _ in json_codec.CODECS:
+        try:
+            codecs.append(json_codec.get_codec([name]))
+        except ValueError:
+            print("%s is not installed" % name)
+    for label, payload in payloads:
+        print("%s (%d KiB)" % (label, len(payload) // 1024))
+        value = codecs[-1].loads(payload)
+        for codec in codecs:
+            decode = bench('loads', lambda: codec.loads(payload))
+            encode = bench('dumps', lambda: codec.dumps(value))
+            print("  %-6s loads %7.2f ms  dumps %7.2f ms" % (
+                codec.name, decode, encode))
+        print("  RemoteFileInfo objects built in %.2f ms" % bench(
+            'infos', lambda: to_infos(value)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+"""Benchmark the uploads of small files inline versus through a batch
+
+Creates files of increasing size with stream_file, sent either along with
+the operation in a single multipart request or uploaded to a batch first
+and then executed, against a local server simulating a WAN link: each
+request waits for the round trip latency and each connection is throttled
+to the given bandwidth.
+
+The figures were used to choose the size up to which files are sent inline
+(see DEFAULT_INLINE_UPLOAD_MAX_SIZE).
+
+Usage:
+
+    python tools/benchmarks/small_uploads.py [latency_ms] [conn_mb/s]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+from nxdrive.client import RemoteFileSystemClient
+
+SIZES = [1024, 16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+N_FILES = 10
+
+CHUNK_SIZE = 64 * 1024
+
+OPERATIONS = [
+    {'id': 'NuxeoDrive.CreateFile', 'params': [
+        {'name': 'parentId', 'type': 'string', 'required': True},
+        {'name': 'name', 'type': 'string', 'required': False}]},
+]
+
+FS_ITEM = {
+    'id': u'doc', 'parentId': u'root', 'name': u'doc', 'path': u'/doc',
+    'folder': False, 'lastModificationDate': 0, 'digest': None,
+    'digestAlgorithm': u'md5', 'canRename': True, 'canDelete': True,
+    'canUpdate': True, 'downloadURL': u'nxbigfile/default/doc',
+}
+
+
+class WANHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.reply({'operations': OPERATIONS})
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, CHUNK_SIZE))
+            time.sleep(float(len(data)) / self.server.bandwidth)
+            remaining -= len(data)
+        if self.path.endswith('batch/upload'):
+            self.reply({'uploaded': 'true'})
+        else:
+            self.reply(FS_ITEM)
+
+    def reply(self, value):
+        body = json.dumps(value)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WANServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def run(client, path):
+    start = time.time()
+    for _ in range(N_FILES):
+        client.stream_file(u'root', path)
+    return (time.time() - start) / N_FILES
+
+
+def main():
+    latency = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    bandwidth = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    server = WANServer(('127.0.0.1', 0), WANHandler)
+    server.latency = latency / 1000.0
+    server.bandwidth = bandwidth * 1024 * 1024
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/nuxeo/' % server.server_address[1]
+    client = RemoteFileSystemClient(
+        url, u'user', u'device', u'bench', password=u'secret', proxies={})
+    folder = tempfile.mkdtemp(u'-nxdrive-bench')
+    print "Latency: %d ms, bandwidth per connection: %d MB/s" % (
+        latency, bandwidth)
+    print "%10s %10s %10s %6s" % ('size (KB)', 'batch ms', 'inline ms',
+                                  'gain')
+    try:
+        for size in SIZES:
+            path = os.path.join(folder, u'%d.bin' % size)
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+            client.inline_upload_max_size = 0
+            batch = run(client, path)
+            client.inline_upload_max_size = size
+            inline = run(client, path)
+            print "%10d %10.1f %10.1f %5.0f%%" % (
+                size / 1024, batch * 1000, inline * 1000,
+                (batch - inline) / batch * 100)
+    finally:
+        shutil.rmtree(folder)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark the per item cost of logging on the synchronization hot paths
+
+Measures LastKnownState.update_remote (called for each remote item of a
+scan or change summary) and the client side cost of an Automation call
+(stub opener, no network) with the root logger at INFO, DEBUG and TRACE.
+Emitted messages are formatted and written to a null stream as the file
+handler would do.
+
+Usage:
+
+    python tools/benchmarks/trace_logging.py [n_items]
+"""
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from nxdrive.logging_config import TRACE
+from nxdrive.model import LastKnownState
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+
+sys.path.insert(0, os.path.dirname(__file__))
+from execute_overhead import make_client
+
+
+def make_infos(n_items, offset):
+    base = datetime(2014, 1, 1)
+    return [RemoteFileInfo(
+        u'Document %d.odt' % i, u'fs-item-%d' % i, u'parent',
+        u'/parent/%d' % i, False, base + timedelta(seconds=i + offset),
+        u'%032x' % i, u'md5',
+        u'nxbigfile/default/%d' % i, True, True, True, False)
+        for i in range(n_items)]
+
+
+def bench_update_remote(n_items):
+    states = [LastKnownState(u'/tmp/local_folder', remote_info=info)
+              for info in make_infos(n_items, 0)]
+    updated = make_infos(n_items, 1)
+    start = time.time()
+    for state, info in zip(states, updated):
+        state.update_remote(info)
+    return (time.time() - start) * 1e6 / n_items
+
+
+def bench_execute(n_calls):
+    client = make_client()
+    start = time.time()
+    for _ in xrange(n_calls):
+        client.execute('Document.Query', query=u'SELECT * FROM Document')
+    return (time.time() - start) * 1e6 / n_calls
+
+
+def main(n_items=20000):
+    root_logger = logging.getLogger()
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(process)d %(thread)d %(levelname)-8s %(name)-18s"
+        " %(message)s"))
+    root_logger.addHandler(handler)
+    for level in (logging.INFO, logging.DEBUG, TRACE):
+        root_logger.setLevel(level)
+        print("%-6s update_remote %6.2f us/item  execute %6.2f us/call" % (
+            logging.getLevelName(level), bench_update_remote(n_items),
+            bench_execute(n_items // 10)))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,184 @@
+"""Benchmark the transfer throughput by number of transfer workers
+
+Uploads (stream_file) and downloads (stream_content) many small files and a
+few large ones through the transfer engine of the synchronizer against a
+local server simulating a WAN link: each request waits for the round trip
+latency and each connection is throttled to the given bandwidth.
+
+The figures were used to choose the default number of transfer workers of
+the command line (see DEFAULT_TRANSFER_WORKERS).
+
+Usage:
+
+    python tools/benchmarks/transfer_throughput.py [latency_ms] [conn_mb/s]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.transfer import Transfer
+from nxdrive.transfer import TransferEngine
+
+WORKERS = [0, 1, 2, 4, 8]
+
+# (label, number of files, size of each file)
+SCENARIOS = [
+    ('small', 200, 4 * 1024),
+    ('large', 4, 16 * 1024 * 1024),
+]
+
+CHUNK_SIZE = 64 * 1024
+
+OPERATIONS = [
+    {'id': 'NuxeoDrive.CreateFile', 'params': [
+        {'name': 'parentId', 'type': 'string', 'required': True},
+        {'name': 'name', 'type': 'string', 'required': True}]},
+    {'id': 'NuxeoDrive.GetFileSystemItem', 'params': [
+        {'name': 'id', 'type': 'string', 'required': True}]},
+]
+
+
+class WANHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def throttle(self, size):
+        time.sleep(float(size) / self.server.bandwidth)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if '/nxbigfile/' not in self.path:
+            self.reply({'operations': OPERATIONS})
+            return
+        size = int(self.path.rsplit('/', 1)[1])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        chunk = b'x' * CHUNK_SIZE
+        while size > 0:
+            self.throttle(min(size, CHUNK_SIZE))
+            self.wfile.write(chunk[:size])
+            size -= CHUNK_SIZE
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        remaining = int(self.headers.get('Content-Length', 0))
+        body = []
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, CHUNK_SIZE))
+            self.throttle(len(data))
+            remaining -= len(data)
+            if len(body) == 0:
+                body.append(data)
+        if self.path.endswith('batch/upload'):
+            self.reply({'uploaded': 'true'})
+        elif self.path.endswith('NuxeoDrive.GetFileSystemItem'):
+            self.reply(self.fs_item(json.loads(body[0])['params']['id']))
+        else:
+            self.reply(self.fs_item(u'doc'))
+
+    def fs_item(self, fs_item_id):
+        return {
+            'id': fs_item_id, 'parentId': u'root', 'name': fs_item_id,
+            'path': u'/' + fs_item_id, 'folder': False,
+            'lastModificationDate': 0, 'digest': None,
+            'digestAlgorithm': u'md5', 'canRename': True,
+            'canDelete': True, 'canUpdate': True,
+            'downloadURL': u'nxbigfile/default/' + fs_item_id,
+        }
+
+    def reply(self, value):
+        body = json.dumps(value)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WANServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def finish(doc_pair, transfer):
+    transfer.get_result()
+
+
+def run(engine, works):
+    start = time.time()
+    for i, work in enumerate(works):
+        if engine.is_full():
+            for transfer in engine.get_completed(block=True):
+                finish(None, transfer)
+        transfer = Transfer(i, work, finish)
+        if not engine.submit(transfer):
+            finish(None, transfer)
+    while engine.count_running():
+        for transfer in engine.get_completed(block=True):
+            finish(None, transfer)
+    return time.time() - start
+
+
+def main():
+    latency = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    bandwidth = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    server = WANServer(('127.0.0.1', 0), WANHandler)
+    server.latency = latency / 1000.0
+    server.bandwidth = bandwidth * 1024 * 1024
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/nuxeo/' % server.server_address[1]
+    # Shared by the workers, as the client of the synchronization thread
+    pool = ConnectionPool(max_idle_per_host=max(WORKERS))
+    client = RemoteFileSystemClient(
+        url, u'user', u'device', u'bench', password=u'secret', proxies={},
+        connection_pool=pool)
+    folder = tempfile.mkdtemp(u'-nxdrive-bench')
+    print "Latency: %d ms, bandwidth per connection: %d MB/s" % (
+        latency, bandwidth)
+    print "%-6s %-9s %8s %10s %8s" % ('files', 'direction', 'workers',
+                                      'files/s', 'MB/s')
+    try:
+        for label, n_files, size in SCENARIOS:
+            paths = []
+            for i in range(n_files):
+                path = os.path.join(folder, u'%s-%d.bin' % (label, i))
+                with open(path, 'wb') as f:
+                    f.write(b'x' * size)
+                paths.append(path)
+            uploads = [lambda p=p: client.stream_file(u'root', p)
+                       for p in paths]
+            downloads = [lambda p=p: os.remove(client.stream_content(
+                unicode(size), p)) for p in paths]
+            for direction, works in (('upload', uploads),
+                                     ('download', downloads)):
+                for n_workers in WORKERS:
+                    engine = TransferEngine(n_workers)
+                    elapsed = run(engine, works)
+                    engine.stop()
+                    print "%-6s %-9s %8d %10.1f %8.1f" % (
+                        label, direction, n_workers, n_files / elapsed,
+                        n_files * size / elapsed / 1024 / 1024)
+    finally:
+        shutil.rmtree(folder)
+        pool.clear()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
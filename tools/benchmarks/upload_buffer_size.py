@@ -0,0 +1,103 @@
+"""Benchmark the upload throughput of a file by socket write size
+
+Sends a file to a local TCP sink with the file system block size used by
+the former uploads (one new string per read), with a reused readinto buffer
+and with sendfile (when pysendfile is installed) for several buffer sizes.
+The figures were used to choose streaming.UPLOAD_BUFFER_SIZE.
+
+Usage:
+
+    python tools/benchmarks/upload_buffer_size.py [size_in_mb]
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from nxdrive.client import streaming
+from nxdrive.client.streaming import Body
+from nxdrive.client.streaming import FileBody
+
+BUFFER_SIZES = [4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024,
+                4 * 1024 * 1024]
+
+N_RUNS = 3
+
+
+class ReadBody(FileBody):
+    """Former upload loop: a new string for each read"""
+
+    def send_to(self, sock, zero_copy=False):
+        Body.send_to(self, sock)
+
+
+def start_sink():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def serve():
+        buf = bytearray(1024 * 1024)
+        while True:
+            conn, _ = server.accept()
+            while conn.recv_into(buf):
+                pass
+            conn.sendall(b'done')
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()
+
+
+def send(address, body, zero_copy):
+    sock = socket.create_connection(address)
+    # Same as the HTTP connections: a timeout makes the socket non blocking
+    sock.settimeout(60)
+    start = time.time()
+    body.send_to(sock, zero_copy=zero_copy)
+    sock.shutdown(socket.SHUT_WR)
+    sock.recv(4)
+    elapsed = time.time() - start
+    sock.close()
+    return elapsed
+
+
+def measure(address, body, zero_copy=False):
+    best = min(send(address, body, zero_copy) for _ in range(N_RUNS))
+    return body.length / best / 1024 / 1024
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    fd, path = tempfile.mkstemp(suffix='-nxdrive-bench')
+    with os.fdopen(fd, 'wb') as f:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(size):
+            f.write(chunk)
+    address = start_sink()
+    try:
+        fs_block_size = os.statvfs(path).f_bsize
+        print "Sending a %d MB file (file system block size: %d)" % (
+            size, fs_block_size)
+        print "%10s %10s %14s %14s" % ('buffer', 'read MB/s',
+                                       'readinto MB/s', 'sendfile MB/s')
+        for buffer_size in BUFFER_SIZES:
+            read = measure(address, ReadBody(path, buffer_size=buffer_size))
+            body = FileBody(path, buffer_size=buffer_size)
+            readinto = measure(address, body)
+            if streaming.sendfile is not None:
+                zero_copy = '%14.0f' % measure(address, body, zero_copy=True)
+            else:
+                zero_copy = '%14s' % 'n/a'
+            print "%10d %10.0f %14.0f %s" % (buffer_size, read, readinto,
+                                             zero_copy)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
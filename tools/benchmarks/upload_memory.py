@@ -0,0 +1,145 @@
+"""Measure the peak memory used to upload an in-memory buffer
+
+Each scenario runs in its own process against a local sink server that
+discards the request bodies, and reports the peak resident memory of the
+process on top of the buffer itself:
+
+- legacy-blob: the former execute_with_blob, building the whole multipart
+  payload in memory with the email package
+- legacy-tmp-file: the former make_file, writing a temporary file first
+- blob: execute_with_blob streaming the buffer in a multipart request
+- batch: make_file streaming the buffer through a batch upload
+
+Usage:
+
+    python tools/benchmarks/upload_memory.py [size_in_mb]
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+SCENARIOS = ['legacy-blob', 'legacy-tmp-file', 'blob', 'batch']
+
+OPERATIONS = [
+    {'id': 'NuxeoDrive.CreateFile', 'params': [
+        {'name': 'parentId', 'type': 'string', 'required': True},
+        {'name': 'name', 'type': 'string', 'required': True}]},
+]
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.reply({'operations': OPERATIONS})
+
+    def do_POST(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        if self.path.endswith('batch/upload'):
+            self.reply({'uploaded': 'true'})
+        else:
+            self.reply({'id': 'doc'})
+
+    def reply(self, value):
+        body = json.dumps(value)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SinkServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def legacy_execute_with_blob(client, command, blob_content, filename,
+                             **params):
+    """Payload construction of execute_with_blob before streaming bodies"""
+    from email.mime.base import MIMEBase
+    from nxdrive.client import json_codec
+    boundary = 'bench'
+    json_part = MIMEBase("application", "json+nxrequest")
+    json_part.add_header("Content-ID", "request")
+    json_part.set_payload(json_codec.dumps({'params': params}))
+    blob_part = MIMEBase("text", "plain")
+    blob_part.add_header("Content-ID", "input")
+    blob_part.add_header("Content-Transfer-Encoding", "binary")
+    blob_part.set_payload(blob_content)
+    return ("--%s\r\n%s\r\n--%s\r\n%s\r\n--%s--") % (
+        boundary, json_part.as_string(), boundary, blob_part.as_string(),
+        boundary)
+
+
+def run_scenario(scenario, size, url):
+    from nxdrive.client import RemoteFileSystemClient
+    client = RemoteFileSystemClient(url, u'user', u'device', u'bench',
+                                    password=u'secret', proxies={})
+    data = b'x' * (size * 1024 * 1024)
+    baseline = max_rss_mb()
+    start = time.time()
+    if scenario == 'legacy-blob':
+        legacy_execute_with_blob(client, 'NuxeoDrive.CreateFile', data,
+                                 u'File.txt', parentId=u'root',
+                                 name=u'File.txt')
+    elif scenario == 'legacy-tmp-file':
+        path = client.make_tmp_file(data)
+        try:
+            client.execute_with_blob_streaming(
+                'NuxeoDrive.CreateFile', path, filename=u'File.txt',
+                parentId=u'root')
+        finally:
+            os.remove(path)
+    elif scenario == 'blob':
+        client.execute_with_blob('NuxeoDrive.CreateFile', data,
+                                 u'File.txt', parentId=u'root',
+                                 name=u'File.txt')
+    else:
+        client.make_file(u'root', u'File.txt', data)
+    elapsed = time.time() - start
+    print "%-16s %8.0f MB above the buffer  %6.2fs" % (
+        scenario, max_rss_mb() - baseline, elapsed)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--scenario':
+        _, _, scenario, size, url = sys.argv
+        try:
+            run_scenario(scenario, int(size), url)
+        except MemoryError:
+            print "%-16s MemoryError" % scenario
+        return
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    server = SinkServer(('127.0.0.1', 0), SinkHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/nuxeo/' % server.server_address[1]
+    print "Uploading a %d MB in-memory buffer" % size
+    for scenario in SCENARIOS:
+        subprocess.call([sys.executable, __file__, '--scenario', scenario,
+                         str(size), url])
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()